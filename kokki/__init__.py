@@ -2,10 +2,13 @@
 from kokki.base import *
 from kokki.environment import *
 from kokki.exceptions import *
+from kokki.guards import *
 from kokki.kitchen import *
+from kokki.plan import *
 from kokki.providers import *
 from kokki.resources import *
 from kokki.source import *
+from kokki.snapshot import *
 from kokki.system import *
 from kokki.version import *
 
@@ -0,0 +1,258 @@
+__all__ = ["Agent", "AgentServer", "request", "benchmark"]
+
+import errno
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+from kokki.exceptions import Fail, UserFail
+from kokki.kitchen import Kitchen
+from kokki.system import System
+
+DEFAULT_SOCKET = "/var/run/kokki.sock"
+
+def _signature(paths):
+    """mtimes of paths, which changes when any of them is edited"""
+    sig = []
+    for path in paths:
+        try:
+            sig.append((path, os.stat(path).st_mtime))
+        except OSError:
+            sig.append((path, None))
+    return tuple(sig)
+
+def cookbook_signature(path):
+    """The files of a cookbook that are loaded once: metadata and libraries"""
+    files = [os.path.join(path, "metadata.py")]
+    libpath = os.path.join(path, "libraries")
+    if os.path.isdir(libpath):
+        files += [os.path.join(libpath, f) for f in sorted(os.listdir(libpath)) if f.endswith('.py')]
+    return _signature(files)
+
+class LogCollector(logging.Handler):
+    def __init__(self, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+class Agent(object):
+    """Converges this machine on request, keeping what runs load warm.
+
+    The interpreter, imported providers, System facts, the executed kitchen
+    files and the metadata and libraries of cookbooks survive from one run
+    to the next. Kitchen files and cookbooks are loaded again when their
+    files change. System facts (addresses, lsb, EC2 metadata) are gathered
+    again once they are older than facts_max_age seconds and on reload.
+    Every converge gets a fresh Kitchen so resources never leak between
+    runs, and converges are serialized.
+    """
+
+    def __init__(self, filename="kitchen.py", overrides=None, inputs=None, facts_max_age=300):
+        self.filename = filename
+        self.overrides = dict(overrides or {})
+        self.inputs = list(inputs or [])
+        self.log = logging.getLogger("kokki.agent")
+        self.lock = threading.Lock()
+        self.cookbooks = {}
+        self._cookbook_signatures = {}
+        self._globs = None
+        self._globs_signature = None
+        self.facts_max_age = facts_max_age
+        self._facts_time = time.time()
+        self.runs = 0
+        self.last_result = None
+        self.started = time.time()
+
+    def kitchen_globals(self):
+        from kokki.command import kitchen_files, read_kitchen_files
+
+        signature = _signature(os.path.abspath(f) for f in kitchen_files(self.filename))
+        if self._globs is None or signature != self._globs_signature:
+            self.log.info("Loading kitchen %s" % self.filename)
+            self._globs = read_kitchen_files(self.filename, self.log)
+            self._globs_signature = signature
+        return self._globs
+
+    def _expire_cookbooks(self):
+        for path in list(self.cookbooks):
+            if cookbook_signature(path) != self._cookbook_signatures.get(path):
+                self.log.info("Reloading cookbook %s" % self.cookbooks[path].name)
+                del self.cookbooks[path]
+                self._cookbook_signatures.pop(path, None)
+
+    def refresh_facts(self):
+        System.reset()
+        self._facts_time = time.time()
+
+    def build(self, roles, overrides=None, inputs=None, only=None):
+        from kokki.command import build_kitchen
+
+        if self.facts_max_age is not None and time.time() - self._facts_time > self.facts_max_age:
+            self.log.debug("Gathering system facts again")
+            self.refresh_facts()
+        globs = self.kitchen_globals()
+        self._expire_cookbooks()
+        kit = Kitchen()
+        kit.cookbook_cache = self.cookbooks
+        kit = build_kitchen(globs, roles, self.inputs + list(inputs or []), self.log, kit)
+        for path in self.cookbooks:
+            self._cookbook_signatures.setdefault(path, cookbook_signature(path))
+        config = dict(self.overrides)
+        config.update(overrides or {})
+        kit.update_config(config)
+        kit.only = only or None
+        return kit
+
+    def converge(self, roles, overrides=None, inputs=None, plan_only=False, only=None):
+        """Converge roles and return the result as a JSON-able dict"""
+        collector = LogCollector()
+        logger = logging.getLogger("kokki")
+        start = time.time()
+        with self.lock:
+            logger.addHandler(collector)
+            try:
+                kit = self.build(roles, overrides, inputs, only)
+                if plan_only:
+                    plan = kit.compile()
+                    result = dict(ok=True, plan=plan.describe().split("\n"))
+                else:
+                    kit.check_input()
+                    kit.run()
+                    self.runs += 1
+                    result = dict(ok=True,
+                        resources = len(kit.resource_list),
+                        updated = [unicode(r) for r in kit.resource_list if r.is_updated])
+            except (Fail, UserFail), exc:
+                result = dict(ok=False, error=str(exc))
+            except Exception, exc:
+                self.log.error(traceback.format_exc())
+                result = dict(ok=False, error="%s: %s" % (exc.__class__.__name__, exc))
+            finally:
+                logger.removeHandler(collector)
+            result.update(roles=list(roles), duration=time.time() - start, log=collector.lines)
+            if not plan_only:
+                self.last_result = result
+        return result
+
+    def status(self):
+        running = not self.lock.acquire(False)
+        if not running:
+            self.lock.release()
+        last = self.last_result and dict((k, v) for k, v in self.last_result.items() if k != 'log')
+        return dict(ok=True, pid=os.getpid(), uptime=time.time() - self.started, runs=self.runs,
+            running=running, cookbooks=sorted(cb.name for cb in self.cookbooks.values()), last=last)
+
+    def handle(self, req):
+        command = req.get("command", "converge")
+        if command in ("converge", "plan"):
+            return self.converge(req.get("roles", []), req.get("overrides"), req.get("inputs"),
+                plan_only=command == "plan", only=req.get("only"))
+        elif command == "status":
+            return self.status()
+        elif command == "reload":
+            with self.lock:
+                self._globs = None
+                self.cookbooks.clear()
+                self._cookbook_signatures.clear()
+                self.refresh_facts()
+            return dict(ok=True)
+        return dict(ok=False, error="Unknown command %r" % command)
+
+class AgentRequestHandler(StreamRequestHandler):
+    """One JSON request line in, one JSON result line out"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict):
+                raise ValueError("request must be an object")
+        except ValueError, exc:
+            result = dict(ok=False, error="Invalid request: %s" % exc)
+        else:
+            result = self.server.agent.handle(req)
+        self.wfile.write(json.dumps(result) + "\n")
+
+class AgentServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, agent, path=DEFAULT_SOCKET, mode=0600):
+        self.agent = agent
+        self.path = path
+        if os.path.exists(path):
+            # Only replace the socket of an agent that is gone
+            try:
+                request(path, dict(command="status"), timeout=5)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise Fail("An agent is already listening on %s" % path)
+        UnixStreamServer.__init__(self, path, AgentRequestHandler)
+        os.chmod(path, mode)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+def request(path, req, timeout=None):
+    """Send a request to the agent listening on path and return its result"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req) + "\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return json.loads("".join(chunks))
+
+def benchmark(filename, roles, overrides=None, runs=3, python=None):
+    """Time cold kokki runs against converges of a warm agent.
+
+    Cold runs are new processes, like a cron triggered kokki. The first
+    agent converge warms its caches and is not counted. Returns
+    dict(cold=[seconds, ...], warm=[seconds, ...]).
+    """
+    overrides = dict(overrides or {})
+    args = [python or sys.executable, "-m", "kokki.command", "-q", "-f", filename]
+    for name, value in sorted(overrides.items()):
+        args += ["-o", "%s=%s" % (name, value)]
+    args += list(roles)
+
+    cold = []
+    with open(os.devnull, "wb") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            if subprocess.call(args, stdout=devnull, stderr=subprocess.STDOUT) != 0:
+                raise Fail("Cold run %s failed" % " ".join(args))
+            cold.append(time.time() - start)
+
+    agent = Agent(filename, overrides)
+    warm = []
+    for i in range(runs + 1):
+        start = time.time()
+        result = agent.converge(roles)
+        if not result['ok']:
+            raise Fail("Agent run failed: %s" % result['error'])
+        if i:
+            warm.append(time.time() - start)
+    return dict(cold=cold, warm=warm)
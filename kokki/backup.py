@@ -0,0 +1,153 @@
+__all__ = ["BackupStore"]
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+
+from kokki.exceptions import Fail
+from kokki.filecache import FileCache, file_digest
+from kokki.utils import atomic_write
+
+# ioctl to share extents between two files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+class BackupStore(object):
+    """Deduplicated store of files replaced by kokki.
+
+    Every unique content is kept once under blobs/, reflinked from the
+    original where the filesystem allows and copied otherwise. Blobs never
+    share an inode with the live file, which may be edited in place. Each
+    run appends the files it backed up to runs/<run>.manifest. Old runs
+    are pruned by count, age or total size of the blobs they keep.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.blob_path = os.path.join(path, "blobs")
+        self.run_path = os.path.join(path, "runs")
+        self.log = logging.getLogger("kokki.backup")
+        for p in (self.blob_path, self.run_path):
+            if not os.path.exists(p):
+                os.makedirs(p, 0700)
+
+    def blob(self, digest):
+        return os.path.join(self.blob_path, digest[:2], digest)
+
+    def backup(self, run, path):
+        """Store path and record it in the manifest of run, returns the digest"""
+        digest = FileCache.get_instance().digest(path)
+        blob = self.blob(digest)
+        if not os.path.exists(blob):
+            if not os.path.exists(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob), 0700)
+            self._store(path, blob)
+
+        st = os.stat(path)
+        entry = dict(path=os.path.abspath(path), digest=digest, mode=st.st_mode & 07777,
+            uid=st.st_uid, gid=st.st_gid, time=time.time())
+        with open(self._manifest_path(run), "a") as fp:
+            fp.write(json.dumps(entry) + "\n")
+        return digest
+
+    def _store(self, path, blob):
+        tmp = blob + ".tmp"
+        try:
+            with open(path, "rb") as src:
+                with open(tmp, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.rename(tmp, blob)
+            return
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        shutil.copyfile(path, tmp)
+        os.rename(tmp, blob)
+
+    def _manifest_path(self, run):
+        if not run or os.sep in run or run.startswith('.'):
+            raise Fail("Invalid backup run name %r" % run)
+        return os.path.join(self.run_path, run + ".manifest")
+
+    def runs(self):
+        return sorted(name[:-len(".manifest")] for name in os.listdir(self.run_path)
+            if name.endswith(".manifest"))
+
+    def manifest(self, run):
+        """Return the files backed up by run, the first backup of each path wins"""
+        path = self._manifest_path(run)
+        if not os.path.exists(path):
+            raise Fail("Backup run %s not found" % run)
+        entries = {}
+        with open(path, "rb") as fp:
+            for line in fp:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries.setdefault(entry['path'], entry)
+        return sorted(entries.values(), key=lambda e:e['path'])
+
+    def restore(self, run, paths=None):
+        """Put back the files as they were before run changed them"""
+        restored = []
+        for entry in self.manifest(run):
+            if paths and entry['path'] not in paths:
+                continue
+            blob = self.blob(entry['digest'])
+            if not os.path.exists(blob) or file_digest(blob) != entry['digest']:
+                raise Fail("Backup of %s in run %s is missing or damaged" % (entry['path'], run))
+            with open(blob, "rb") as fp:
+                atomic_write(entry['path'], fp.read())
+            os.chmod(entry['path'], entry['mode'])
+            if os.getuid() == 0:
+                os.chown(entry['path'], entry['uid'], entry['gid'])
+            self.log.info("Restored %s from run %s" % (entry['path'], run))
+            restored.append(entry['path'])
+        return restored
+
+    def prune(self, keep=None, max_age=None, max_size=None):
+        """Remove old runs and the blobs only they referenced.
+
+        keep is the number of most recent runs to always keep, max_age is
+        in days and max_size in bytes of blobs.
+        """
+        runs = self.runs()
+        now = time.time()
+        removed = set()
+        if keep is not None and len(runs) > keep:
+            removed.update(runs[:len(runs) - keep])
+        if max_age is not None:
+            for run in runs:
+                if now - os.path.getmtime(self._manifest_path(run)) > max_age * 86400:
+                    removed.add(run)
+
+        remaining = [run for run in runs if run not in removed]
+        if max_size is not None:
+            while remaining and self._size(remaining) > max_size:
+                removed.add(remaining.pop(0))
+
+        for run in removed:
+            os.unlink(self._manifest_path(run))
+        if removed:
+            self.log.info("Pruned backup runs %s" % ", ".join(sorted(removed)))
+            self._collect(remaining)
+        return sorted(removed)
+
+    def _digests(self, runs):
+        digests = set()
+        for run in runs:
+            digests.update(entry['digest'] for entry in self.manifest(run))
+        return digests
+
+    def _size(self, runs):
+        return sum(os.path.getsize(self.blob(digest)) for digest in self._digests(runs)
+            if os.path.exists(self.blob(digest)))
+
+    def _collect(self, runs):
+        referenced = self._digests(runs)
+        for dirname in os.listdir(self.blob_path):
+            for digest in os.listdir(os.path.join(self.blob_path, dirname)):
+                if digest not in referenced:
+                    os.unlink(os.path.join(self.blob_path, dirname, digest))
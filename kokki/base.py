@@ -68,6 +68,8 @@ class Resource(object):
     __metaclass__ = ResourceMetaclass
 
     is_updated = False
+    # Set on resources that are meant to manage a path together with others
+    shares_path = False
 
     action = ForcedListArgument(default="nothing")
     ignore_failures = BooleanArgument(default=False)
@@ -75,6 +77,7 @@ class Resource(object):
     subscribes = ResourceArgument(default=[])
     not_if = ResourceArgument()
     only_if = ResourceArgument()
+    tags = ForcedListArgument(default=[])
 
     actions = ["nothing"]
 
@@ -89,6 +92,7 @@ class Resource(object):
             obj = super(Resource, cls).__new__(cls)
             env.resources[r_type][name] = obj
             env.resource_list.append(obj)
+            env.plan = None
             return obj
 
         obj = env.resources[r_type][name]
@@ -106,6 +110,8 @@ class Resource(object):
         self.env = env or Environment.get_instance()
         self.provider = provider or getattr(self, 'provider', None)
         self.log = logging.getLogger("kokki.resource")
+        # cookbook.recipe that defined the resource, for --only recipe:
+        self.recipe = getattr(self.env, 'current_recipe', None)
 
         self.arguments = {}
         for key, value in kwargs.items():
@@ -162,6 +168,7 @@ class Resource(object):
                         self.arguments[key] = arg.validate(value)
                     except InvalidArgument, exc:
                         raise InvalidArgument("%s %s" % (self, exc))
+                    self.env.plan = None
         self.validate()
 
     def __repr__(self):
@@ -179,6 +186,7 @@ class Resource(object):
             subscribes = self.subscribes,
             notifies = self.notifies,
             env = self.env,
+            recipe = self.recipe,
         )
 
     def __setstate__(self, state):
@@ -189,6 +197,7 @@ class Resource(object):
         self.subscribes = state['subscribes']
         self.notifies = state['notifies']
         self.env = state['env']
+        self.recipe = state.get('recipe')
 
         self.log = logging.getLogger("kokki.resource")
 
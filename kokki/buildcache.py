@@ -0,0 +1,57 @@
+__all__ = ["BuildCache"]
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+class BuildCache(object):
+    """Artifacts of builds from source, keyed by everything the build depends on.
+
+    Entries live in <path>/<name>/<key>/ where key is a digest of the
+    build inputs. An entry is written to a temporary directory and renamed
+    into place, so the cache can be shared by several nodes (over NFS for
+    example) and a concurrent build of the same key is simply discarded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger("kokki.buildcache")
+
+    @staticmethod
+    def key(**inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def entry_path(self, name, key):
+        return os.path.join(self.path, name, key)
+
+    def lookup(self, name, key):
+        """Return the artifact paths of an entry, or None when it isn't cached"""
+        path = self.entry_path(name, key)
+        if not os.path.isdir(path):
+            return None
+        return sorted(os.path.join(path, f) for f in os.listdir(path))
+
+    def store(self, name, key, files):
+        """Copy files into the entry and return their cached paths"""
+        path = self.entry_path(name, key)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(prefix=".%s-" % key[:12], dir=parent)
+        try:
+            for f in files:
+                shutil.copy2(f, tmp)
+            try:
+                os.rename(tmp, path)
+                self.log.info("Cached %d artifacts of %s as %s" % (len(files), name, key))
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # Someone else stored the same build meanwhile
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+        return self.lookup(name, key)
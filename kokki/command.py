@@ -1,6 +1,8 @@
 
+import json
 import logging
 import os
+import pipes
 import sys
 from optparse import OptionParser
 
@@ -10,17 +12,28 @@ from kokki.exceptions import Fail, UserFail
 
 
 def build_parser():
-    parser = OptionParser(usage="Usage: %prog [options] <role> ...")
+    parser = OptionParser(usage="Usage: %prog [options] <role> ...\n       %prog [options] restore [<run> [<path> ...]]\n"
+        "       %prog [options] agent [converge|plan|benchmark <role> ...|status|reload]")
     parser.add_option("-f", "--file", dest="filename",
         help="Look for the command in FILE. If file name is not specified, will look for 'kitchen.py'", metavar="FILE", default="kitchen.py")
     parser.add_option("-l", "--load", dest="config",
-            help="Load dumped kitchen from FILE. Optional prefix fmt: specifies file type (yaml, pickle or json). Default format is yaml.", metavar="FILE", default=None)
+            help="Load dumped kitchen from FILE. Optional prefix fmt: specifies file type (yaml, pickle or snapshot). Default format is yaml.", metavar="FILE", default=None)
     parser.add_option("-d", "--dump", dest="dump",
         help = "Dump a serialized representation of what would be run"
                " to FILE (default to YAML, can specify <format>:<filename>"
-               " e.g. pickle:kitchen.dump)", metavar="FILE", default=None)
+               " e.g. pickle:kitchen.dump or snapshot:kitchen.snap)", metavar="FILE", default=None)
+    parser.add_option("-p", "--plan", dest="plan", help="Print the compiled execution plan and exit", default=False, action="store_true")
+    parser.add_option("--only", dest="only", help="Only run the resources matching SELECTOR (Type, Type[name], recipe:name or tag:name, wildcards allowed) and the resources they notify. May be repeated", metavar="SELECTOR", action="append", default=[])
     parser.add_option("-o", "--override", dest="overrides", help="Config overrides (key=value)", action="append", default=[])
     parser.add_option("-i", "--inputs", dest="inputs", help="Config Input parameters (key=value)", action="append", default=[])
+    parser.add_option("--fleet", dest="fleet", help="Converge NODES (comma separated or @file) from this controller instead of the local machine", metavar="NODES", default=None)
+    parser.add_option("--transport", dest="transport", help="Fleet transport: ssh (default), ssh:USER or local:ROOT", default="ssh")
+    parser.add_option("--concurrency", dest="concurrency", help="Number of fleet nodes converged at once (default 10)", type="int", default=10)
+    parser.add_option("--batch", dest="batch", help="Roll out to the fleet in batches of N nodes", type="int", default=None)
+    parser.add_option("--max-failures", dest="max_failures", help="Stop the rollout once more than N nodes failed (default 0)", type="int", default=0)
+    parser.add_option("-w", "--watch", dest="watch", help="Keep running after the converge and correct drift of managed paths as it happens", default=False, action="store_true")
+    parser.add_option("--debounce", dest="debounce", help="Seconds without changes before drift is corrected in watch mode (default 1)", type="float", default=1.0)
+    parser.add_option("--socket", dest="socket", help="UNIX socket of the agent (default /var/run/kokki.sock)", metavar="PATH", default=None)
     parser.add_option("-v", "--verbose", dest="verbose", default=False, action="store_true")
     parser.add_option("-q", "--quiet", dest="quiet", help="Prevent any log output", default=False, action="store_true")
     return parser
@@ -43,24 +56,31 @@ def load_kitchen_from_dump(options_config, logger):
         import cPickle as pickle
         with open(filename, "rb") as fp:
             return pickle.load(fp)
+    elif fmt == "snapshot":
+        logger.debug(msg='Config file format is snapshot')
+        from kokki.snapshot import load_snapshot
+        with open(filename, "rb") as fp:
+            return load_snapshot(fp.read(), logger.isEnabledFor(logging.DEBUG))
     else:
-        sys.stderr.write("Unknown config format specified '%s'. Can only work with yaml or pickle \n" % fmt)
+        sys.stderr.write("Unknown config format specified '%s'. Can only work with yaml, pickle or snapshot \n" % fmt)
         sys.exit(1)
 
-def load_kitchens(options, args, logger):
+def kitchen_files(filename):
+    """The kitchen files: filename, or the .py files in it when it is a directory"""
+    path = os.path.abspath(filename)
+    if os.path.isdir(filename):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.py')]
+    return [filename]
 
-    logger.debug('Config file not specified, trying to read "kitchen.py"')
-    path = os.path.abspath(options.filename)
+def read_kitchen_files(filename, logger):
+    """Execute the kitchen files and return their globals, which hold the roles"""
+    path = os.path.abspath(filename)
     if not os.path.isdir(path):
         path = os.path.dirname(path)
     if path not in sys.path:
         sys.path.insert(0, path)
 
-    if os.path.isdir(options.filename):
-        files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.py')]
-    else:
-        files = [options.filename]
-
+    files = kitchen_files(filename)
     logger.debug('Processing %s as kitchen file(s)' % files)
 
     globs = {}
@@ -76,23 +96,24 @@ def load_kitchens(options, args, logger):
             del globs['__file__']
 
     if not file_found:
-        sys.stderr.write("Need to have 'kitchen.py' or other files specified by -f parameter")
-        sys.exit(1)
+        raise UserFail("Need to have 'kitchen.py' or other files specified by -f parameter")
+    return globs
 
-    kit = Kitchen()
+def build_kitchen(globs, role_names, inputs, logger, kit=None):
+    """Apply the named roles of globs to a new (or the given) kitchen"""
+    kit = kit or Kitchen()
     logger.debug('Processing inputs')
 
     # place all input variables under the "input" scope
-    kit.update_config({'input.' + value.split('=')[0]: value.split('=')[1] for value in options.inputs})
+    kit.update_config({'input.' + value.split('=')[0]: value.split('=')[1] for value in inputs})
 
     roles = []
-    for c in args:
+    for c in role_names:
         try:
             logger.debug('Adding role %s' % c)
             roles.append(globs[c])
         except KeyError:
-            sys.stderr.write("Function for role '%s' not found in config\n" % c)
-            sys.exit(1)
+            raise UserFail("Function for role '%s' not found in config" % c)
     logger.debug('Environment.config before running recipes: %s' % kit.config)
     for r in roles:
         kit.update_config({'kokki.current_role' : r.func_name})
@@ -100,6 +121,16 @@ def load_kitchens(options, args, logger):
 
     return kit
 
+def load_kitchens(options, args, logger):
+
+    logger.debug('Config file not specified, trying to read "kitchen.py"')
+    try:
+        globs = read_kitchen_files(options.filename, logger)
+        return build_kitchen(globs, args, options.inputs, logger)
+    except UserFail, exc:
+        sys.stderr.write("%s\n" % exc)
+        sys.exit(1)
+
 def produce_dump(options_dump, kitchen, logger):
     logger.debug('Dumping config files')
     if ':' in options_dump:
@@ -121,12 +152,101 @@ def produce_dump(options_dump, kitchen, logger):
         else:
             with open(filename, "wb") as fp:
                 pickle.dump(kitchen, fp, pickle.HIGHEST_PROTOCOL)
+    elif fmt == "snapshot":
+        from kokki.snapshot import dump_snapshot
+        data = dump_snapshot(kitchen)
+        if filename == "-":
+            sys.stdout.write(data)
+        else:
+            with open(filename, "wb") as fp:
+                fp.write(data)
     else:
-        sys.stderr.write("Unknown config format specified '%s'. Can only work with yaml or pickle \n" % fmt)
+        sys.stderr.write("Unknown config format specified '%s'. Can only work with yaml, pickle or snapshot \n" % fmt)
         sys.exit(1)
 
     sys.exit(0)
 
+def run_fleet(options, kitchen, logger):
+    from kokki.fleet import FleetRunner, LocalTransport, SSHTransport, load_nodes, summarize
+
+    kind, _, arg = options.transport.partition(':')
+    if kind == "local":
+        transport = LocalTransport(os.path.abspath(arg or "fleet"))
+    elif kind == "ssh":
+        transport = SSHTransport(user=arg or None)
+    else:
+        sys.stderr.write("Unknown fleet transport '%s'. Can only work with ssh or local \n" % kind)
+        sys.exit(1)
+
+    kitchen.check_input()
+    nodes = load_nodes(options.fleet)
+    logger.debug('Converging fleet of %d nodes' % len(nodes))
+    # Nodes apply the selection themselves, the snapshot stays complete
+    kokki_command = " ".join(["kokki"] + ["--only %s" % pipes.quote(spec) for spec in options.only])
+    runner = FleetRunner(kitchen, nodes, transport,
+        concurrency = options.concurrency,
+        batch_size = options.batch,
+        max_failures = options.max_failures,
+        kokki_command = kokki_command)
+    ok = summarize(runner.run())
+    sys.exit(0 if ok else 1)
+
+def restore_backup(options, args, logger):
+    from kokki.environment import Environment
+
+    env = Environment()
+    for over in options.overrides:
+        name, value = over.split('=', 1)
+        env.update_config({name: value})
+    store = env.backup_store
+
+    if not args:
+        for run in store.runs():
+            print "%s\t%d files" % (run, len(store.manifest(run)))
+        sys.exit(0)
+
+    restored = store.restore(args[0], args[1:])
+    logger.info('Restored %d files from run %s' % (len(restored), args[0]))
+    sys.exit(0)
+
+def run_agent(options, args, logger):
+    from kokki.agent import DEFAULT_SOCKET, Agent, AgentServer, benchmark, request
+
+    path = options.socket or DEFAULT_SOCKET
+    overrides = dict(over.split('=', 1) for over in options.overrides)
+
+    if not args:
+        agent = Agent(options.filename, overrides, options.inputs)
+        server = AgentServer(agent, path)
+        logger.info('Agent listening on %s' % path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        sys.exit(0)
+
+    command, roles = args[0], args[1:]
+    if command == "benchmark":
+        times = benchmark(options.filename, roles, overrides)
+        for name in ("cold", "warm"):
+            print "%s: best %.3fs, average %.3fs over %d runs" % (name, min(times[name]),
+                sum(times[name]) / len(times[name]), len(times[name]))
+        print "speedup: %.1fx" % (min(times['cold']) / max(min(times['warm']), 1e-6))
+        sys.exit(0)
+
+    req = dict(command=command)
+    if command in ("converge", "plan"):
+        req.update(roles=roles, overrides=overrides, inputs=options.inputs, only=options.only)
+    result = request(path, req)
+    for line in result.pop('log', []):
+        print line
+    for line in result.pop('plan', []):
+        print line
+    print json.dumps(result, indent=2, sort_keys=True)
+    sys.exit(0 if result.get('ok') else 1)
+
 def main():
     try:
         parser = build_parser()
@@ -148,6 +268,12 @@ def main():
         if options.quiet:
             logging.disable(logging.WARNING)
 
+        if args and args[0] == "restore":
+            restore_backup(options, args[1:], logger)
+
+        if args and args[0] == "agent":
+            run_agent(options, args[1:], logger)
+
         if options.config:
             kitchen = load_kitchen_from_dump(options.config, logger)
         else:
@@ -158,13 +284,34 @@ def main():
             name, value = over.split('=', 1)
             kitchen.update_config({name: value})
 
+        if options.only:
+            kitchen.only = options.only
+
         if options.dump:
             produce_dump(options.dump, kitchen, logger)
 
+        if options.plan:
+            print kitchen.compile().describe()
+            sys.exit(0)
+
+        if options.fleet:
+            run_fleet(options, kitchen, logger)
+
         logger.debug('Configuration is done. Visiting kitchen.')
         kitchen.check_input()
         kitchen.run()
         logger.info('All done')
+
+        if options.watch:
+            from kokki.watch import DriftWatcher
+            watcher = DriftWatcher(kitchen, options.debounce)
+            logger.info('Watching %d paths for drift' % len(watcher.paths))
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.close()
     except UserFail as uf:
         print "ERROR: " , uf
         sys.exit(1)
@@ -1,6 +1,5 @@
 
-import os
-from kokki import Environment, Execute
+from kokki import Environment, Execute, PathExists
 
 def module(name, enable=True, conf=False):
     env = Environment.get_instance()
@@ -12,9 +11,9 @@ def module(name, enable=True, conf=False):
         Execute("a2enmod %s" % name,
             command = "/usr/sbin/a2enmod %s" % name,
             notifies = [("restart", env.resources["Service"]["apache2"])],
-            not_if = lambda:os.path.exists("%s/mods-enabled/%s.load" % (env.config.apache.dir, name)))
+            not_if = PathExists("%s/mods-enabled/%s.load" % (env.config.apache.dir, name)))
     else:
         Execute("a2dismod %s" % name,
             command = "/usr/sbin/a2dismod %s" % name,
             notifies = [("restart", env.resources["Service"]["apache2"])],
-            only_if = lambda:os.path.exists("%s/mods-enabled/%s.load" % (env.config.apache.dir, name)))
+            only_if = PathExists("%s/mods-enabled/%s.load" % (env.config.apache.dir, name)))
@@ -18,11 +18,12 @@ Directory(env.config.apache.log_dir, mode = 0700, owner = env.config.apache.user
 if env.system.platform in ("centos", "redhat", "fedora", "suse"):
     Service("apache2",
         service_name = "httpd",
-        restart_command = "/sbin/service httpd restart && sleep 1",
-        reload_command = "/sbin/service httpd reload && sleep 1",
+        restart_command = "/sbin/service httpd restart",
+        reload_command = "/sbin/service httpd reload",
         supports_restart = True,
         supports_reload = True,
-        supports_status = True)
+        supports_status = True,
+        wait_for = ["tcp:127.0.0.1:%s" % port for port in env.config.apache.listen_ports])
 
     File("/usr/local/bin/apache2_module_conf_generate.pl",
         mode = 0755,
@@ -68,7 +69,8 @@ else: # debian, ubuntu
     Service("apache2",
         supports_restart = True,
         supports_reload = True,
-        supports_status = True)
+        supports_status = True,
+        wait_for = ["tcp:127.0.0.1:%s" % port for port in env.config.apache.listen_ports])
 
 Directory("%s/ssl" % env.config.apache.dir,
     mode = 0755,
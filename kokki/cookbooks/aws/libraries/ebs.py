@@ -0,0 +1,79 @@
+import time
+from kokki import Fail
+
+class VolumeIndex(object):
+    """The volumes a run cares about, listed once.
+
+    Only the volumes attached to this instance and the ones whose Name tag
+    matches an EBSVolume resource are fetched, through two filtered calls
+    instead of listing every volume of the account for each resource.
+    """
+
+    def __init__(self, ec2, instance_id, names):
+        self.ec2 = ec2
+        self.instance_id = instance_id
+        # EC2 filters take * wildcards, which covers indexed names
+        self.names = sorted(set(name.replace('{index}', '*') for name in names if name))
+        self._volumes = None
+
+    @property
+    def volumes(self):
+        if self._volumes is None:
+            found = {}
+            for v in self.ec2.get_all_volumes(filters={"attachment.instance-id": self.instance_id}):
+                found[v.id] = v
+            if self.names:
+                for v in self.ec2.get_all_volumes(filters={"tag:Name": self.names}):
+                    found[v.id] = v
+            self._volumes = sorted((v for v in found.values() if v.status in ('creating', 'available', 'in-use')),
+                key=lambda v:v.id)
+        return self._volumes
+
+    def add(self, vol):
+        if self._volumes is not None:
+            self._volumes.append(vol)
+
+    def replace(self, volumes):
+        """Swap in fresher copies of volumes"""
+        if self._volumes is not None:
+            fresh = dict((v.id, v) for v in volumes)
+            self._volumes = [fresh.get(v.id, v) for v in self._volumes]
+
+class EBSRunState(object):
+    def __init__(self, index):
+        self.index = index
+        self.created = set()
+        self.attached = set()
+        # Resource key -> volume name picked for an {index} name pattern
+        self.names = {}
+
+def wait_for_volumes(ec2, volumes, ready, timeout, interval=1, max_interval=16, log=None):
+    """Poll volumes until ready(volume) is true for all of them.
+
+    All pending volumes are refreshed with a single call per round and the
+    delay between rounds doubles up to max_interval. timeout is either the
+    seconds to wait for every volume or a dict of them by volume id, None
+    or 0 waits for ever. Volumes that are late don't stop the wait for the
+    others, the ones that passed their deadline fail once the rest are
+    ready. Returns the fresh volume objects.
+    """
+    volumes = dict((v.id, v) for v in volumes)
+    start = time.time()
+    timeouts = timeout if isinstance(timeout, dict) else dict.fromkeys(volumes, timeout)
+    deadlines = dict((vid, start + timeouts[vid] if timeouts.get(vid) else None) for vid in volumes)
+    expired = set()
+    while True:
+        now = time.time()
+        pending = sorted(vid for vid, v in volumes.items() if vid not in expired and not ready(v))
+        expired.update(vid for vid in pending if deadlines[vid] is not None and now >= deadlines[vid])
+        pending = [vid for vid in pending if vid not in expired]
+        if not pending:
+            if expired:
+                raise Fail("Timed out waiting for volumes %s" % ", ".join(sorted(expired)))
+            return sorted(volumes.values(), key=lambda v:v.id)
+        log and log.debug("Waiting %ss for volumes %s" % (interval, ", ".join(pending)))
+        ends = [deadlines[vid] for vid in pending if deadlines[vid] is not None]
+        time.sleep(max(0, min([interval] + [end - now for end in ends])))
+        interval = min(interval * 2, max_interval)
+        for v in ec2.get_all_volumes(pending):
+            volumes[v.id] = v
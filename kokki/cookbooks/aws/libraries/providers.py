@@ -1,60 +1,85 @@
 
 import itertools
 import os
-import time
 from kokki import Provider, Fail
+from kokki.plan import resource_key
 
 class EBSVolumeProvider(Provider):
+    """Creates and attaches EBS volumes.
+
+    The first EBSVolume action of a run issues the create and attach calls
+    of every unguarded EBSVolume resource in the plan and waits on all of
+    them at once. The actions of the other resources then only report
+    what was done for them.
+    """
+
+    # Delays between polls, doubling from poll_interval up to max_poll_interval
+    poll_interval = 1
+    max_poll_interval = 16
+
     def action_create(self):
         if self.resource.volume_id:
             raise Fail("Cannot create a volume with a specific id (EC2 chooses volume ids)")
-        
-        vol = self._find_volume(self.resource.volume_id, self.resource.name, self.resource.device)
-        if vol:
-            self.log.debug("Volume %s already exists", self.resource)
-            # self.log.debug("There is already a volume attached at device %s" % self.resource.device)
-            # # if not self._volume_compatible_with_resource_definition(attached_volume):
-            # raise Fail("Volume %s attached at %s but does not conform to this resource's specifications" % (attached_volume['aws_id'], attached_volume['aws_device']))
-            # # self.log.debug("The volume matches the resource's definition, so the volume is assumed to be already created")
-        else:
-            vol = self._create_volume(self.resource.snapshot_id, self.resource.size, self.resource.availability_zone, self.resource.name, self.resource.timeout)
+
+        state = self._state()
+        if self.resource not in state.created:
+            self._create_volumes(state, [self.resource])
+        if self.resource in state.created:
             self.resource.updated()
-    
-    def action_attach(self):
-        vol = self._determine_volume()
-        
-        if vol.status == "in-use":
-            if vol.attach_data.instance_id != self.resource.env.config.aws.instance_id:
-                raise Fail("Volume with id %s exists but is attached to instance %s" % (vol.id, vol.attach_data.instance_id))
-            else:
-                self.log.debug("Volume is already attached")
         else:
-            self._attach_volume(vol, self.resource.env.config.aws.instance_id, self.resource.device, self.resource.timeout)
+            self.log.debug("Volume %s already exists", self.resource)
+
+    def action_attach(self):
+        state = self._state()
+        if self.resource not in state.attached:
+            self._determine_volume()
+            self._attach_volumes(state, [self.resource])
+        if self.resource in state.attached:
             self.resource.updated()
-    
+        else:
+            self.log.debug("Volume is already attached")
+
     def action_detach(self):
         vol = self._determine_volume()
         if not vol.attach_data or vol.attach_data.instance_id != self.resource.env.config.aws.instance_id:
             return
-        
+
         self._detach_volume(vol, self.resource.timeout)
         self.resource.updated()
-    
+
     def action_snapshot(self):
         vol = self._determine_volume()
         snapshot = self.ec2.create_snapshot(vol.id)
         self.resource.updated()
         self.log.info("Created snapshot of %s as %s" % (vol.id, snapshot.id))
-    
-    def _find_volume(self, volume_id=None, name=None, device=None):
+
+    def _state(self):
+        env = self.resource.env
+        try:
+            return env.run_cache['aws.ebs']
+        except KeyError:
+            pass
+
+        steps = [step for step in env.plan or ()
+            if step.provider is self.__class__ and step.resource.not_if is None and step.resource.only_if is None]
+        names = [step.resource.name for step in steps] + [self.resource.name]
+        state = env.run_cache['aws.ebs'] = EBSRunState(VolumeIndex(self.ec2, env.config.aws.instance_id, names))
+
+        self._create_volumes(state, [step.resource for step in steps
+            if "create" in step.actions and not step.resource.volume_id])
+        self._attach_volumes(state, [step.resource for step in steps if "attach" in step.actions])
+        return state
+
+    def _find_volume(self, volume_id=None, name=None, device=None, resource=None):
+        resource = resource or self.resource
         vol = None
         if volume_id:
             vol = self._volume_by_id(volume_id)
         else:
-            all_volumes = [v for v in self.ec2.get_all_volumes() if v.status in ('in-use', 'available')]
+            all_volumes = self._state().index.volumes
             if device:
                 for v in all_volumes:
-                    if v.attach_data and v.attach_data.device == device and v.attach_data.instance_id == self.resource.env.config.aws.instance_id:
+                    if v.attach_data and v.attach_data.device == device and v.attach_data.instance_id == resource.env.config.aws.instance_id:
                         vol = v
                         break
             if not vol and name:
@@ -68,20 +93,28 @@ class EBSVolumeProvider(Provider):
                                 vol = v
                                 break
                         except KeyError:
-                            self.resource.name = vname
+                            self._state().names[resource_key(resource)] = vname
                             break
                 else:
                     for v in all_volumes:
                         if v.tags.get('Name') == name:
                             vol = v
                             break
-        if vol and '{index}' in name:
-            self.resource.name = vol.tags.get('Name')
+        if vol and name and '{index}' in name:
+            self._state().names[resource_key(resource)] = vol.tags.get('Name')
         return vol
 
-    def _determine_volume(self):
+    def _volume_name(self, resource):
+        """The name of the volume of resource, once picked for an {index} name pattern.
+
+        The resource keeps its declared name, the plan knows it by that.
+        """
+        return self._state().names.get(resource_key(resource), resource.name)
+
+    def _determine_volume(self, resource=None):
         """Pulls the volume id from the volume_id attribute or the node data and verifies that the volume actually exists"""
-        vol = self._find_volume(self.resource.volume_id, self.resource.name, self.resource.device)
+        resource = resource or self.resource
+        vol = self._find_volume(resource.volume_id, self._volume_name(resource), resource.device, resource)
 
         if not vol:
             raise Fail("volume_id attribute not set or no volume with the given name or device found")
@@ -90,6 +123,9 @@ class EBSVolumeProvider(Provider):
 
     def _volume_by_id(self, volume_id):
         """Retrieves information for a volume"""
+        for v in self._state().index.volumes:
+            if v.id == volume_id:
+                return v
         volumes = self.ec2.get_all_volumes([volume_id])
         if volumes:
             return volumes[0]
@@ -100,80 +136,99 @@ class EBSVolumeProvider(Provider):
             (not self.resource.availability_zone or self.resource.availability_zone == volume.zone),
             (self.resource.snapshot_id == volume.snapshot_id)
         )
-    
+
     def _find_snapshot(self, name):
         snapshots = self.ec2.get_all_snapshots(filters={"tag:Name": name})
         if snapshots:
             snapshots.sort(cmp=lambda x, y: cmp(y.start_time, x.start_time))
             return snapshots[0]
         return None
-    
-    def _create_volume(self, snapshot_id, size, availability_zone, name, timeout):
-        """Creates a volume according to specifications and blocks until done (or times out)"""
 
-        self.log.debug("Creating volume with attributes: snapshot_id=%s size=%s availability_zone=%s name=%s timeout=%s", snapshot_id, size, availability_zone, name, timeout)
+    def _create_volumes(self, state, resources):
+        """Creates the missing volumes of resources and blocks until all are available (or times out)"""
+        created = []
+        for resource in resources:
+            if resource in state.created or self._find_volume(None, self._volume_name(resource), resource.device, resource):
+                continue
+            name = self._volume_name(resource)
 
-        if snapshot_id and not snapshot_id.startswith('snap-'):
-            sid = self._find_snapshot(snapshot_id)
-            if not sid and self.resource.snapshot_required:
-                raise Fail("Unable to find snapshot with name %s" % snapshot_id)
-            snapshot_id = sid
+            snapshot_id = resource.snapshot_id
+            self.log.debug("Creating volume with attributes: snapshot_id=%s size=%s availability_zone=%s name=%s timeout=%s",
+                snapshot_id, resource.size, resource.availability_zone, name, resource.timeout)
 
-        availability_zone = availability_zone or self.resource.env.config.aws.availability_zone
-        vol = self.ec2.create_volume(size, availability_zone, snapshot_id)
-        self.log.info("Created new volume %s %s%s", name, vol.id, " based on %s" % snapshot_id if snapshot_id else "")
+            if snapshot_id and not snapshot_id.startswith('snap-'):
+                snapshot = self._find_snapshot(snapshot_id)
+                if not snapshot and resource.snapshot_required:
+                    raise Fail("Unable to find snapshot with name %s" % snapshot_id)
+                snapshot_id = snapshot and snapshot.id
 
-        start_time = time.time()
-        end_time = start_time + timeout if timeout else 0
+            availability_zone = resource.availability_zone or resource.env.config.aws.availability_zone
+            vol = self.ec2.create_volume(resource.size, availability_zone, snapshot_id)
+            self.log.info("Created new volume %s %s%s", name, vol.id, " based on %s" % snapshot_id if snapshot_id else "")
+            # Tag right away so volumes named after an index pattern pick distinct names
+            if name:
+                vol.add_tag('Name', name)
+            state.index.add(vol)
+            state.created.add(resource)
+            created.append((resource, vol))
 
-        while (not timeout) or (time.time() < end_time):
-            if vol.update() in ('in-use', 'available'):
-                break
-            time.sleep(1)
+        if created:
+            volumes = wait_for_volumes(self.ec2, [vol for _resource, vol in created],
+                lambda v:v.status in ('in-use', 'available'),
+                dict((vol.id, resource.timeout) for resource, vol in created), self.poll_interval, self.max_poll_interval, self.log)
+            state.index.replace(volumes)
 
-        if name:
-            vol.add_tag('Name', name)
+            try:
+                del self.resource.env.config.aws.resources._volumes
+            except AttributeError:
+                pass
 
-        try:
-            del self.resource.env.config.aws.resources._volumes
-        except AttributeError:
-            pass
+    def _attach_volumes(self, state, resources):
+        """Attaches the volumes of resources and blocks until all are attached and their devices exist (or times out)"""
+        instance_id = self.resource.env.config.aws.instance_id
+        attaching = []
+        for resource in resources:
+            if resource in state.attached:
+                continue
+            vol = self._find_volume(resource.volume_id, self._volume_name(resource), resource.device, resource)
+            if not vol:
+                # Reported by the attach action of the resource
+                continue
+            if vol.status == "in-use":
+                if vol.attach_data.instance_id != instance_id:
+                    raise Fail("Volume with id %s exists but is attached to instance %s" % (vol.id, vol.attach_data.instance_id))
+                continue
 
-        return vol
+            self.log.info("Attaching %s as %s" % (vol.id, resource.device))
+            vol.attach(instance_id, resource.device)
+            state.attached.add(resource)
+            attaching.append((resource, vol))
 
-    def _attach_volume(self, vol, instance_id, device, timeout):
-        """Attaches the volume and blocks until done (or times out)"""
-        self.log.info("Attaching %s as %s" % (vol.id, device))
-        vol.attach(instance_id, device)
-
-        start_time = time.time()
-        end_time = start_time + timeout if timeout else 0
-        attached = False
-
-        # block until attached
-        while (not timeout) or (time.time() < end_time):
-            if vol.update() != "deleting":
-                if vol.attachment_state() == "attached":
-                    if vol.attach_data.instance_id == instance_id:
-                        self.log.info("%s Volume is attached" % self)
-                        attached = True
-                        break
-                    else:
-                        raise Fail("Volume is attached to instance %s instead of %s" % (vol.attach_data.instance_id, instance_id))
-                else:
-                    self.log.debug("Volume is %s" % vol.status)
-            else:
-                raise Fail("%s Volume %s no longer exists" % (self, vol.id))
-            time.sleep(3)
-
-        # block until device is available
-        if attached:
-            while (not timeout) or (time.time() < end_time):
-                if os.path.exists(self.resource.device):
-                    return
-                time.sleep(1)
-
-        raise Fail("Timed out waiting for volume attachment after %s seconds" % (time.time() - start_time))
+        if not attaching:
+            return
+
+        devices = dict((vol.id, resource.device) for resource, vol in attaching)
+        def attached(vol):
+            if vol.status == "deleting":
+                raise Fail("Volume %s no longer exists" % vol.id)
+            if vol.attachment_state() != "attached":
+                return False
+            if vol.attach_data.instance_id != instance_id:
+                raise Fail("Volume is attached to instance %s instead of %s" % (vol.attach_data.instance_id, instance_id))
+            return os.path.exists(devices[vol.id])
+
+        volumes = wait_for_volumes(self.ec2, [vol for _resource, vol in attaching], attached,
+            dict((vol.id, resource.timeout) for resource, vol in attaching), self.poll_interval, self.max_poll_interval, self.log)
+        state.index.replace(volumes)
+        self.log.info("Volumes %s are attached" % ", ".join(vol.id for vol in volumes))
+
+    def _detach_volume(self, vol, timeout):
+        """Detaches the volume and blocks until done (or times out)"""
+        self.log.info("Detaching %s" % vol.id)
+        vol.detach()
+        volumes = wait_for_volumes(self.ec2, [vol], lambda v:v.status != "in-use",
+            timeout, self.poll_interval, self.max_poll_interval, self.log)
+        self._state().index.replace(volumes)
 
     # def detach_volume(self, vol, timeout):
     #     Chef::Log.debug("Detaching #{volume_id}")
@@ -1,12 +1,10 @@
 
-import os
-from kokki import Package, Execute, File, Script
+from kokki import Package, AptRepository, Script, FileContains, PathExists
 
 Package("debconf-utils")
 
-Execute("apt-update-java",
-    command = "apt-get update",
-    action = "nothing")
+# Ubuntu Archive Automatic Signing Key, shipped with the distribution
+UBUNTU_ARCHIVE_KEY = "630239CC130E1A7FD81A27B140976EAF437D05B5"
 
 if env.system.lsb['codename'] == 'karmic':
     def enter_the_multiverse():
@@ -19,19 +17,20 @@ if env.system.lsb['codename'] == 'karmic':
             "deb-src {source} karmic-updates multiverse\n"
             "deb http://security.ubuntu.com/ubuntu karmic-security multiverse\n"
         ).format(source=source)
-    File("/etc/apt/sources.list.d/multiverse.list",
-        owner = "root",
-        group = "root",
-        mode = 0644,
-        not_if = lambda:os.path.exists("/etc/apt/sources.list.d/multiverse.list"),
+    AptRepository("multiverse",
+        not_if = PathExists("/etc/apt/sources.list.d/multiverse.list"),
         content = enter_the_multiverse,
-        notifies = [("run", env.resources["Execute"]["apt-update-java"], True)])
+        key_fingerprint = UBUNTU_ARCHIVE_KEY)
 
 ubuntu_sources = ("lucid", "maverick")
 
 if env.system.lsb['codename'] in ubuntu_sources:
-    Execute('add-apt-repository "deb http://archive.canonical.com/ %s partner" ; apt-get update' % env.system.lsb['codename'],
-        not_if = "grep '%s partner' /etc/apt/sources.list > /dev/null" % env.system.lsb['codename'])
+    AptRepository("partner",
+        uri = "http://archive.canonical.com/",
+        distribution = env.system.lsb['codename'],
+        components = ["partner"],
+        key_fingerprint = UBUNTU_ARCHIVE_KEY,
+        not_if = FileContains("/etc/apt/sources.list", "%s partner" % env.system.lsb['codename']))
 
 Script("accept-java-license",
     not_if = "debconf-show sun-java6-jre | grep accepted > /dev/null",
@@ -1,6 +1,6 @@
 
 import os
-from kokki import Package, Directory, Script, File, Service
+from kokki import Package, Directory, Script, File, Service, PortListening
 
 env.include_recipe("java.jre")
 
@@ -29,6 +29,9 @@ File("%s/server.sh",
 Service("minecraft-server",
     start_command = "screen -dmS minecraft -- %s/server.sh" % env.config.minecraft.path,
     stop_command = 'screen -S minecraft -X stuff "stop\n"',
-    status_command = "nc -z localhost 25565",
+    status_command = PortListening(25565),
+    wait_for = "tcp:127.0.0.1:25565",
+    # Generating the world on the first start takes a while
+    wait_timeout = 300,
     action = "start",
 )
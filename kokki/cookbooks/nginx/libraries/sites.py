@@ -1,20 +1,18 @@
 
-from os.path import exists
-from kokki import Environment, Execute
+from kokki import Environment, Execute, PathExists
 
 def site(name, enable=True):
     env = Environment.get_instance()
 
+    enabled = PathExists("%s/sites-enabled/%s" % (env.config.nginx.dir, name))
     if enable:
         cmd = 'nxensite'
+        guards = dict(not_if = enabled)
     else:
         cmd = 'nxdissite'
-
-    def _not_if():
-        e = exists("%s/sites-enabled/%s" % (env.config.nginx.dir, name))
-        return e if enable else not e
+        guards = dict(only_if = enabled)
 
     Execute("%s %s" % (cmd, name),
             command = "/usr/sbin/%s %s" % (cmd, name),
             notifies = [("reload", env.resources["Service"]["nginx"])],
-            not_if = _not_if)
+            **guards)
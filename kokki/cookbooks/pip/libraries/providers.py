@@ -1,66 +1,127 @@
-
 __all__ = ["PipPackageProvider"]
 
+import os
 import re
-from subprocess import check_call, Popen, PIPE, STDOUT
+from subprocess import check_call, PIPE, STDOUT
 
-from kokki import Fail
+from kokki.distributions import get_distribution_index, normalize_name, script_interpreter
+from kokki.plan import resource_key
 from kokki.providers.package import PackageProvider
-
-version_re = re.compile(r'\S\S(.*)\/(.*)-(.*)-py(.*).egg\S')
-best_match_re = re.compile(r'Best match: (.*) (.*)\n')
+from kokki.providers.package.easy_install import get_candidate_version
 
 class PipPackageProvider(PackageProvider):
+    """Packages installed with pip.
+
+    Installed versions come from one scan of the dist-info/egg-info
+    metadata of pip's interpreter per run. When a package has to be
+    installed, the pinned packages of the consecutive PipPackage steps
+    after it that are out of date too are installed with the same pip
+    call. Wheels are built once into a local wheelhouse, which installs
+    look into first.
+    """
+
+    pip_binary_path = "pip"
+
+    @classmethod
+    def wheelhouse(cls, env):
+        return os.path.join(env.config.kokki.download.path, "pip")
+
+    @classmethod
+    def distribution_index(cls, env):
+        return get_distribution_index(env, script_interpreter(cls.pip_binary_path))
+
+    @classmethod
+    def prefetch(cls, env, steps):
+        """Build wheels of the distributions the plan will install into the wheelhouse"""
+        index = cls.distribution_index(env)
+        packages = [(name, version) for name, version in cls.prefetch_packages(steps)
+            if name != 'pip' and (not version or index.get_version(name) != version)]
+        if packages:
+            wheelhouse = cls.wheelhouse(env)
+            check_call([cls.pip_binary_path, "wheel", "--wheel-dir", wheelhouse, "--find-links", wheelhouse] +
+                ["%s==%s" % (name, version) if version else name for name, version in packages],
+                stdout=PIPE, stderr=STDOUT)
+
+    def _batch(self):
+        """Packages installed by a batch this run and their versions before it"""
+        batches = self.resource.env.run_cache.setdefault('pip.batch', {})
+        return batches.setdefault(self.pip_binary_path, {})
+
     def get_current_status(self):
-        p = Popen("%s freeze | grep ^%s==" % (self.pip_binary_path, self.resource.package_name), stdout=PIPE, stderr=STDOUT, shell=True)
-        out = p.communicate()[0]
-        res = p.wait()
-        if res != 0:
-            self.current_version = None
+        name = normalize_name(self.resource.package_name)
+        batch = self._batch()
+        if name in batch:
+            # Already installed along with an earlier package, report it as it was
+            self.current_version = batch[name]
         else:
-            try:
-                self.current_version = out.split("==", 1)[1].strip()
-            except IndexError:
-                raise Fail("pip could not determine installed package version.")
+            self.current_version = self.distribution_index(self.resource.env).get_version(name)
 
     @property
     def candidate_version(self):
         if not hasattr(self, '_candidate_version'):
             if not self.resource.version and re.match("^[A-Za-z0-9_.-]+$", self.resource.package_name):
-                p = Popen([self.easy_install_binary_path, "-n", self.resource.package_name], stdout=PIPE, stderr=STDOUT)
-                out = p.communicate()[0]
-                res = p.wait()
-                if res != 0:
-                    self.log.warning("easy_install check returned a non-zero result (%d) %s" % (res, self.resource))
-
-                m = best_match_re.search(out)
-                if not m:
-                    self._candidate_version = None
-                else:
-                    self._candidate_version = m.group(2)
+                self._candidate_version = get_candidate_version(self.resource.env,
+                    self.easy_install_binary_path, self.resource.package_name)
             else:
                 self._candidate_version = self.resource.version
         return self._candidate_version
 
-    @property
-    def pip_binary_path(self):
-        return "pip"
-
     @property
     def easy_install_binary_path(self):
         return "easy_install"
 
     def install_package(self, name, version):
+        env = self.resource.env
+        batch = self._batch()
+        if normalize_name(self.resource.package_name) in batch:
+            return True
+
+        args = [self.pip_binary_path, "install"]
+        wheelhouse = self.wheelhouse(env)
+        if os.path.isdir(wheelhouse):
+            args += ["--find-links", wheelhouse]
         if name == 'pip' or not version:
-            check_call([self.pip_binary_path, "install", "--upgrade", name], stdout=PIPE, stderr=STDOUT)
+            check_call(args + ["--upgrade", name], stdout=PIPE, stderr=STDOUT)
         else:
-            check_call([self.pip_binary_path, "install", '{0}=={1}'.format(name, version)], stdout=PIPE, stderr=STDOUT)
+            pending = self._pending_steps()
+            self.log.info("Installing %d packages with pip: %s" % (len(pending) + 1,
+                ", ".join(step.arguments['package_name'] for step in pending) or name))
+            index = self.distribution_index(env)
+            previous = dict((normalize_name(step.arguments['package_name']), index.get_version(step.arguments['package_name']))
+                for step in pending)
+            check_call(args + ['{0}=={1}'.format(name, version)] +
+                ['{0}=={1}'.format(step.arguments['location'], step.arguments['version']) for step in pending],
+                stdout=PIPE, stderr=STDOUT)
+            batch.update(previous)
+        self.distribution_index(env).invalidate()
+        return True
+
+    def _pending_steps(self):
+        """Out of date steps of the PipPackage run following this resource in the plan"""
+        plan = self.resource.env.plan
+        if plan is None:
+            return []
+        steps = list(plan.steps)
+        index = self.distribution_index(self.resource.env)
+        pending = []
+        for step in steps[steps.index(plan.get_step(resource_key(self.resource)))+1:]:
+            if (step.provider is not self.__class__ or step.resource.not_if is not None
+                    or step.resource.only_if is not None or not step.actions
+                    or not set(step.actions) <= set(self.prefetch_actions)):
+                break
+            version = step.arguments.get('version')
+            if step.arguments['location'] == 'pip' or not version:
+                break
+            if index.get_version(step.arguments['package_name']) != version:
+                pending.append(step)
+        return pending
 
     def upgrade_package(self, name, version):
-        self.install_package(name, version)
+        return self.install_package(name, version)
 
-    def remove_package(self, name, version):
-        check_call([self.pip_binary_path, "uninstall", name])
+    def remove_package(self, name):
+        check_call([self.pip_binary_path, "uninstall", "-y", name], stdout=PIPE, stderr=STDOUT)
+        self.distribution_index(self.resource.env).invalidate()
 
-    def purge_package(self, name, version):
-        self.remove_package(name, version)
\ No newline at end of file
+    def purge_package(self, name):
+        self.remove_package(name)
\ No newline at end of file
@@ -1,22 +1,15 @@
 
 import os
-from kokki import Script, Directory, File, Service, Package, Link, Template
+from kokki import SourceBuild, Directory, File, Service, Package, Link, Template
 
 # env.include_recipe("monit")
 
 version = "2.2.0-rc2"
-dirname = "redis-%s" % version
-filename = "%s.tar.gz" % dirname
-url = "http://redis.googlecode.com/files/%s" % filename
 
-Script("install-redis",
-    not_if = lambda:os.path.exists("/usr/local/bin/redis-server"),
-    cwd = "/usr/local/src",
-    code = (
-        "wget %(url)s\n"
-        "tar -zxvf %(filename)s\n"
-        "cd %(dirname)s\n"
-        "make install\n") % dict(url=url, dirname=dirname, filename=filename))
+# The redis Makefile has no DESTDIR, PREFIX points the install at it
+SourceBuild("redis",
+    url = "http://redis.googlecode.com/files/redis-%s.tar.gz" % version,
+    install_command = "make PREFIX=%(destdir)s/usr/local install")
 
 Directory(env.config.redis.dbdir,
     owner = "root",
@@ -53,7 +46,7 @@ File("/etc/init.d/redis",
 
 Service("redis",
     subscribes = [
-        ("restart", env.resources["Script"]["install-redis"]),
+        ("restart", env.resources["SourceBuild"]["redis"]),
     ])
 
 if "munin.node" in env.included_recipes:
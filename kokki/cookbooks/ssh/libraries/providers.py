@@ -4,8 +4,15 @@ __all__ = ["SSHKnownHostProvider", "SSHAuthorizedKeyProvider"]
 from kokki import Provider
 
 class SSHKnownHostProvider(Provider):
+    # Every host of a run is added to one in-memory copy of the file
+    uses_file_editors = True
+
+    def _hosts(self):
+        env = self.resource.env
+        return env.get_file_editor(self.resource.path, env.cookbooks.ssh.SSHKnownHostsFile)
+
     def action_include(self):
-        hosts = self.resource.env.cookbooks.ssh.SSHKnownHostsFile(self.resource.path)
+        hosts = self._hosts()
         modified = False
         for host in self.resource.host.split(','):
             if hosts.add_host(host, self.resource.keytype, self.resource.key, hashed=self.resource.hashed):
@@ -14,11 +21,10 @@ class SSHKnownHostProvider(Provider):
             else:
                 self.log.debug("[%s] Host %s already in known_hosts file %s" % (self, host, self.resource.path))
         if modified:
-            hosts.save(self.resource.path)
             self.resource.updated()
 
     def action_exclude(self):
-        hosts = self.resource.env.cookbooks.ssh.SSHKnownHostsFile(self.resource.path)
+        hosts = self._hosts()
         modified = False
         for host in self.resource.host.split(','):
             if hosts.remove_host(host):
@@ -27,24 +33,28 @@ class SSHKnownHostProvider(Provider):
             else:
                 self.log.debug("[%s] Host %s not found in known_hosts file %s" % (self, host, self.resource.path))
         if modified:
-            hosts.save(self.resource.path)
             self.resource.updated()
 
 class SSHAuthorizedKeyProvider(Provider):
+    # Every key of a run is applied to one in-memory copy of the file
+    uses_file_editors = True
+
+    def _keys(self):
+        env = self.resource.env
+        return env.get_file_editor(self.resource.path, env.cookbooks.ssh.SSHAuthorizedKeysFile)
+
     def action_include(self):
-        keys = self.resource.env.cookbooks.ssh.SSHAuthorizedKeysFile(self.resource.path)
-        if keys.add_key(self.resource.keytype, self.resource.key, self.resource.name):
+        keys = self._keys()
+        if keys.add_key(self.resource.keytype, self.resource.key, self.resource.name, self.resource.options):
             self.log.info("[%s] Added key to authorized_keys file %s" % (self, self.resource.path))
-            keys.save(self.resource.path)
             self.resource.updated()
         else:
             self.log.debug("[%s] Key already in authorized_keys file %s" % (self, self.resource.path))
 
     def action_exclude(self):
-        keys = self.resource.env.cookbooks.ssh.SSHAuthorizedKeysFile(self.resource.path)
+        keys = self._keys()
         if keys.remove_key(self.resource.keytype, self.resource.key):
             self.log.info("[%s] Removed key from authorized_keys file %s" % (self, self.resource.path))
-            keys.save(self.resource.path)
             self.resource.updated()
         else:
             self.log.debug("[%s] Key not found in authorized_keys file %s" % (self, self.resource.path))
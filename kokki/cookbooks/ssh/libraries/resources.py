@@ -16,6 +16,7 @@ class SSHKnownHost(Resource):
     path = ResourceArgument()
 
     actions = Resource.actions + ["include", "exclude"]
+    shares_path = True
 
     def validate(self):
         if not self.path:
@@ -29,10 +30,12 @@ class SSHAuthorizedKey(Resource):
     action = ForcedListArgument(default="include")
     keytype = ResourceArgument()
     key = ResourceArgument()
+    options = ResourceArgument() # e.g. 'command="uptime",no-pty', existing options are kept when None
     user = ResourceArgument()
     path = ResourceArgument()
 
     actions = Resource.actions + ["include", "exclude"]
+    shares_path = True
 
     def validate(self):
         if not self.path:
@@ -4,46 +4,72 @@ import hmac
 import os
 from base64 import b64decode, b64encode
 from kokki import Fail, Environment
+from kokki.utils import atomic_write
 
 class SSHKnownHostsFile(object):
+    """known_hosts indexed for many lookups and edits.
+
+    Plain hosts are kept in a dict. Hashed entries each have their own
+    salt, so a host is hashed once with every salt the first time it is
+    looked up and the hashes are remembered for the later lookups, adds
+    and removes of that host. Edits are kept in memory until flush() (or
+    save()) writes the file once.
+    """
+
     def __init__(self, path=None):
-        self.hosts = []
+        self.path = path
+        self.log = logging.getLogger('kokki').getChild('SSHKnownHostsFile')
+        self.dirty = False
         self.parse(path)
 
-
     def parse(self, path):
-        self.hosts = []
+        # Entries are (0, [hosts], keytype, key), (1, salt, hash, keytype, key)
+        # or (None, line) for comments and marker lines, None once removed
+        self.entries = []
+        self.plain = {}     # host -> entry numbers
+        self.hashed = {}    # (salt, hash) -> entry numbers
+        self.host_hashes = {}   # host -> {salt: hash}
+        self.existed = bool(path) and os.path.exists(path)
+        if not self.existed:
+            return
         with open(path, "r") as fp:
             for line in fp:
                 line = line.strip()
                 if not line:
                     continue
 
-                addr, keytype, key = line.split(' ')
-                if addr.startswith('|1|'):
+                fields = line.split(None, 2)
+                if line.startswith(('#', '@')) or len(fields) < 3:
+                    self._append((None, line))
+                elif fields[0].startswith('|1|'):
                     # Hashed host entry
-                    salt, hosthash = addr.split('|')[2:]
-                    self.hosts.append((1, b64decode(salt), b64decode(hosthash), keytype, key))
+                    salt, hosthash = fields[0].split('|')[2:]
+                    self._append((1, b64decode(salt), b64decode(hosthash), fields[1], fields[2]))
                 else:
                     # Unhashed
-                    for a in addr.split(','):
-                        self.hosts.append((0, a, keytype, key))
+                    self._append((0, fields[0].split(','), fields[1], fields[2]))
 
-    def save(self, path):
-        with open(path, "w") as fp:
-            fp.write(str(self))
+    def _append(self, entry):
+        n = len(self.entries)
+        self.entries.append(entry)
+        if entry[0] == 0:
+            for host in entry[1]:
+                self.plain.setdefault(host, set()).add(n)
+        elif entry[0] == 1:
+            self.hashed.setdefault((entry[1], entry[2]), set()).add(n)
+
+    def _find(self, host):
+        found = set(self.plain.get(host, ()))
+        hashes = self.host_hashes.setdefault(host, {})
+        for (salt, hosthash), entries in self.hashed.items():
+            if salt not in hashes:
+                hashes[salt] = self.hash(host, salt)[0]
+            if hashes[salt] == hosthash:
+                found.update(entries)
+        return found
 
     def includes(self, host):
-        host = host.lower()
-        for h in self.hosts:
-            if h[0] == 0:
-                if h[1] == host:
-                    return True
-            elif h[0] == 1:
-                hosthash = self.hash(host, h[1])[0]
-                if hosthash == h[2]:
-                    return  True
-        return False
+        return bool(self._find(host.lower()))
 
     def hash(self, host, salt=None):
         if not salt:
@@ -59,110 +85,201 @@ class SSHKnownHostsFile(object):
             return False
 
         if hashed:
+            # A fresh salt per entry, like ssh-keygen -H, so entries can't be linked
             hosthash, salt = self.hash(host)
-            self.hosts.append((1, salt, hosthash, keytype, key))
+            self.host_hashes.setdefault(host, {})[salt] = hosthash
+            self._append((1, salt, hosthash, keytype, key))
         else:
-            self.hosts.append((0, host, keytype, key))
+            self._append((0, [host], keytype, key))
 
+        self.dirty = True
         return True
 
     def remove_host(self, host):
         host = host.lower()
-        new_hosts = []
-        for h in self.hosts:
-            if h[0] == 0:
-                if h[1] == host:
-                    continue
-            elif h[0] == 1:
-                hosthash = self.hash(host, h[1])[0]
-                if hosthash == h[2]:
-                    continue
-            new_hosts.append(h)
+        found = self._find(host)
+        for n in found:
+            entry = self.entries[n]
+            if entry[0] == 0:
+                entry[1].remove(host)
+                if not entry[1]:
+                    self.entries[n] = None
+            else:
+                self.entries[n] = None
+                entries = self.hashed[(entry[1], entry[2])]
+                entries.discard(n)
+                if not entries:
+                    del self.hashed[(entry[1], entry[2])]
+        self.plain.pop(host, None)
+        if found:
+            self.dirty = True
+        return bool(found)
 
-        found = len(new_hosts) != len(self.hosts)
-        self.hosts = new_hosts
-        return found
-
-    def __str__(self):
+    @property
+    def content(self):
         out = []
-        unhashed = {} # Group unhashed hosts by the key
-        for h in self.hosts:
-            if h[0] == 0:
-                k = (h[2], h[3])
-                if k not in unhashed:
-                    unhashed[k] = [h[1]]
-                else:
-                    unhashed[k].append(h[1])
-            elif h[0] == 1:
-                out.append("|1|%s|%s %s %s" % (b64encode(h[1]), b64encode(h[2]), h[3], h[4]))
-        for k, host in unhashed.items():
-            out.append("%s %s %s" % (",".join(host), k[0], k[1]))
+        for entry in self.entries:
+            if entry is None:
+                continue
+            elif entry[0] == 0:
+                out.append("%s %s %s" % (",".join(entry[1]), entry[2], entry[3]))
+            elif entry[0] == 1:
+                out.append("|1|%s|%s %s %s" % (b64encode(entry[1]), b64encode(entry[2]), entry[3], entry[4]))
+            else:
+                out.append(entry[1])
         out.append("")
         return "\n".join(out)
 
+    def save(self, path):
+        atomic_write(path, self.content)
+
+    def flush(self, env=None):
+        """Write the file if it was edited, returns True if it was"""
+        if not self.dirty:
+            return False
+        if env is not None and self.existed:
+            env.backup_file(self.path)
+        self.log.info("Writing %s" % self.path)
+        self.save(self.path)
+        self.existed = True
+        self.dirty = False
+        return True
+
+    def __str__(self):
+        return self.content
+
+def split_key_options(line):
+    """Split an authorized_keys line into (options, rest).
+
+    Options come first when the line doesn't start with the key type, they
+    end at the first whitespace outside of double quotes.
+    """
+    first = line.split(None, 1)[0]
+    if first.startswith(('ssh-', 'ecdsa-', 'sk-')) or first.isdigit():
+        return None, line
+    quoted = False
+    escaped = False
+    for i, c in enumerate(line):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c in ' \t' and not quoted:
+            return line[:i], line[i:].strip()
+    return line, ""
+
 class SSHAuthorizedKeysFile(object):
+    """authorized_keys kept in file order.
+
+    Keys are indexed by (keytype, key), their options (command=... and so
+    on) are kept and new keys are appended, so the same set of keys always
+    produces the same file. Edits are kept in memory until flush() (or
+    save()) writes the file once.
+    """
+
     def __init__(self, path=None):
+        self.path = path
         self.log = logging.getLogger('kokki').getChild('SSHAuthorizedKeysFile')
-        self.keys = {}
-        if path:
-            self.parse(path)
+        self.dirty = False
+        self.parse(path)
 
     def parse(self, path):
+        # Entries are [options, keytype, key, name] or (None, line) for
+        # comments and lines we don't understand, None once removed
+        self.entries = []
         self.keys = {}
-        try:
-            line_number = 0
-            with open(path, "r") as fp:
-                for line in fp:
-                    line_number += 1
-                    line = line.strip()
-                    if not line:
-                        continue
-
-                    if line.startswith("command="):
-                        # TODO: This is a bit of a hack.. not sure what else could be here
-                        # TODO: Do something with cmd? It'll get overwritten
-                        line = line[line.find("ssh-"):]
-                    l = line.split(' ')
-                    if len(l) == 1:
-                        self.log.warning('Invalid key on line %s of %s. Ignoring.' % (line_number, path))
-                        continue
-
-                    keytype, key = l[0:2]
-                    name = ' '.join(l[2:])
-                    self.keys[(keytype, key)] = name
-        except IOError as exc:
-            if exc.errno != 2: # No such file
-                raise
+        self.duplicates = {}    # (keytype, key) -> entry numbers of repeated lines
+        self.existed = bool(path) and os.path.exists(path)
+        if not self.existed:
+            return
+        with open(path, "r") as fp:
+            for line_number, line in enumerate(fp, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    self.entries.append((None, line))
+                    continue
 
-    def save(self, path):
-        with open(path, "w") as fp:
-            fp.write(str(self))
+                options, rest = split_key_options(line)
+                l = rest.split(' ', 2)
+                if len(l) == 1:
+                    self.log.warning('Invalid key on line %s of %s. Keeping it as is.' % (line_number, path))
+                    self.entries.append((None, line))
+                    continue
+
+                keytype, key = l[0:2]
+                name = l[2] if len(l) > 2 else ""
+                if (keytype, key) in self.keys:
+                    # A repeated key is kept as is, the first one is the one edited
+                    self.duplicates.setdefault((keytype, key), []).append(len(self.entries))
+                    self.entries.append((None, line))
+                    continue
+                self.keys[(keytype, key)] = len(self.entries)
+                self.entries.append([options, keytype, key, name])
 
     def includes(self, keytype, key):
         return (keytype, key) in self.keys
 
-    def add_key(self, keytype, key, name, verify=True):
-        if verify and self.includes(keytype, key):
-            return False
+    def add_key(self, keytype, key, name, options=None):
+        """Add the key, or update its options when given"""
+        try:
+            entry = self.entries[self.keys[(keytype, key)]]
+        except KeyError:
+            self.keys[(keytype, key)] = len(self.entries)
+            self.entries.append([options, keytype, key, name or ""])
+            self.dirty = True
+            return True
 
-        self.keys[(keytype, key)] = name
+        if options is None or entry[0] == options:
+            return False
+        entry[0] = options
+        self.dirty = True
         return True
 
     def remove_key(self, keytype, key):
         try:
-            self.keys.pop((keytype, key))
+            n = self.keys.pop((keytype, key))
         except KeyError:
             return False
+        for i in [n] + self.duplicates.pop((keytype, key), []):
+            self.entries[i] = None
+        self.dirty = True
         return True
 
-    def __str__(self):
+    @property
+    def content(self):
         out = []
-        for k, name in self.keys.items():
-            keytype, key = k
-            out.append(" ".join((keytype, key, name)))
+        for entry in self.entries:
+            if entry is None:
+                continue
+            elif entry[0] is None and len(entry) == 2:
+                out.append(entry[1])
+            else:
+                out.append(" ".join(x for x in entry if x))
         out.append("")
         return "\n".join(out)
 
+    def save(self, path):
+        atomic_write(path, self.content)
+
+    def flush(self, env=None):
+        """Write the file if it was edited, returns True if it was"""
+        if not self.dirty:
+            return False
+        if env is not None and self.existed:
+            env.backup_file(self.path)
+        self.log.info("Writing %s" % self.path)
+        self.save(self.path)
+        self.existed = True
+        self.dirty = False
+        return True
+
+    def __str__(self):
+        return self.content
+
 def ssh_path_for_user(user):
     env = Environment.get_instance()
     if env.system.os == "linux":
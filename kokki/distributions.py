@@ -0,0 +1,129 @@
+__all__ = ["DistributionIndex", "get_distribution_index", "normalize_name", "script_interpreter"]
+
+import os
+import re
+import sys
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+from kokki.exceptions import Fail
+
+SYS_PATH_SCRIPT = "import sys; sys.stdout.write('\\n'.join(sys.path))"
+
+def normalize_name(name):
+    """Project names compare case insensitively with runs of -_. equal"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def parse_pkg_info(content):
+    """Return (name, version) from PKG-INFO or METADATA headers"""
+    headers = {}
+    for line in content.splitlines():
+        if not line.strip():
+            break
+        if ":" in line and not line[0].isspace():
+            key, value = line.split(":", 1)
+            headers.setdefault(key.strip().lower(), value.strip())
+    return headers.get("name"), headers.get("version")
+
+def _parse_entry(entry):
+    """Name and version encoded in a metadata file name.
+
+    foo-1.0.dist-info, Foo-1.0-py2.7.egg-info, Foo-1.0-py2.7.egg or Foo.egg-info
+    (which setup.py develop leaves without a version)
+    """
+    base = entry.rsplit(".", 1)[0]
+    parts = base.split("-")
+    return parts[0], parts[1] if len(parts) > 1 else None
+
+def _metadata_path(path):
+    if path.endswith(".dist-info"):
+        return os.path.join(path, "METADATA")
+    if path.endswith(".egg-info"):
+        return path if os.path.isfile(path) else os.path.join(path, "PKG-INFO")
+    if path.endswith(".egg") and os.path.isdir(path):
+        return os.path.join(path, "EGG-INFO", "PKG-INFO")
+    return None
+
+def scan_distributions(paths):
+    """Index the distributions installed in the sys.path entries paths.
+
+    Returns {normalized name: (name, version, location)}. Like imports, the
+    first entry of paths providing a project wins. Eggs that are on the
+    path themselves (through easy-install.pth) are included.
+    """
+    found = {}
+
+    def add(location):
+        name, version = _parse_entry(os.path.basename(location))
+        if not version:
+            metadata = _metadata_path(location)
+            if metadata and os.path.isfile(metadata):
+                with open(metadata, "rb") as fp:
+                    name, version = parse_pkg_info(fp.read())
+        if name:
+            found.setdefault(normalize_name(name), (name, version, location))
+
+    for path in paths:
+        if not path:
+            continue
+        if path.endswith(".egg"):
+            add(path)
+        elif os.path.isdir(path):
+            for entry in sorted(os.listdir(path)):
+                if entry.endswith((".dist-info", ".egg-info", ".egg")):
+                    add(os.path.join(path, entry))
+    return found
+
+def script_interpreter(script):
+    """The python interpreter of a console script (pip, easy_install) from its #! line"""
+    path = find_executable(script) if not os.path.isabs(script) else script
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as fp:
+        line = fp.readline()
+    if not line.startswith("#!"):
+        return None
+    args = line[2:].split()
+    if args and os.path.basename(args[0]) == "env" and len(args) > 1:
+        return find_executable(args[1])
+    return args[0] if args else None
+
+def site_paths(interpreter=None):
+    """sys.path of interpreter, without spawning it when it is the running one"""
+    if not interpreter or os.path.realpath(interpreter) == os.path.realpath(sys.executable):
+        return list(sys.path)
+    proc = Popen([interpreter, "-c", SYS_PATH_SCRIPT], stdout=PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Fail("Unable to get the module search path of %s" % interpreter)
+    return out.split("\n")
+
+class DistributionIndex(object):
+    """Installed distributions of one interpreter, scanned once until invalidated.
+
+    Installers invalidate the index after changing site-packages.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._distributions = None
+
+    def invalidate(self):
+        self._distributions = None
+
+    @property
+    def distributions(self):
+        if self._distributions is None:
+            self._distributions = scan_distributions(self.paths)
+        return self._distributions
+
+    def get_version(self, name):
+        dist = self.distributions.get(normalize_name(name))
+        return dist and dist[1]
+
+def get_distribution_index(env, interpreter=None):
+    """The run's DistributionIndex of interpreter (default the running python)"""
+    indexes = env.run_cache.setdefault('python.distributions', {})
+    if interpreter not in indexes:
+        indexes[interpreter] = DistributionIndex(site_paths(interpreter))
+    return indexes[interpreter]
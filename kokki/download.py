@@ -0,0 +1,210 @@
+__all__ = ["DownloadManager"]
+
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import urllib2
+from Queue import Queue, Empty
+
+from kokki.exceptions import Fail
+
+class DownloadManager(object):
+    """Streaming, resumable download cache.
+
+    Entries are keyed by the sha1 of their URL and written to disk while
+    downloading. Interrupted downloads leave a .part file that is resumed
+    with a Range request. Entries are verified against sha256/md5 sums
+    when given, and the least recently used ones are evicted once the
+    cache grows past max_size bytes.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    blocksize = 1 << 16
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.log = logging.getLogger("kokki.download")
+        self._locks = {}
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @classmethod
+    def get_instance(cls, path, max_size=None):
+        with cls._instances_lock:
+            try:
+                manager = cls._instances[path]
+            except KeyError:
+                manager = cls._instances[path] = cls(path, max_size)
+            manager.max_size = max_size
+            return manager
+
+    def cache_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest())
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def fetch(self, url, sha256=None, md5=None):
+        """Return the path of a verified local copy of url"""
+        path = self.cache_path(url)
+        with self._path_lock(path):
+            self._fetch(url, path, sha256, md5)
+        self.evict(keep=path)
+        return path
+
+    def _fetch(self, url, path, sha256, md5):
+        # Called with the lock of path held, eviction leaves it alone meanwhile
+        if os.path.exists(path):
+            if self._verify(path, sha256, md5):
+                # Bump mtime, it is what eviction uses as last access time
+                os.utime(path, None)
+                return
+            self.log.info("Cached copy of %s failed verification, downloading again" % url)
+            os.unlink(path)
+
+        part = path + ".part"
+        self._download(url, part)
+        if not self._verify(part, sha256, md5):
+            os.unlink(part)
+            raise Fail("Checksum of %s does not match" % url)
+        os.rename(part, path)
+
+    def fetch_content(self, url, sha256=None, md5=None, cache=True):
+        if cache:
+            path = self.cache_path(url)
+            with self._path_lock(path):
+                self._fetch(url, path, sha256, md5)
+                with open(path, "rb") as fp:
+                    content = fp.read()
+            self.evict(keep=path)
+            return content
+
+        fd, part = tempfile.mkstemp(prefix="kokki-download")
+        os.close(fd)
+        try:
+            self._download(url, part, resume=False)
+            if not self._verify(part, sha256, md5):
+                raise Fail("Checksum of %s does not match" % url)
+            with open(part, "rb") as fp:
+                return fp.read()
+        finally:
+            os.unlink(part)
+
+    def prefetch(self, downloads, concurrency=4):
+        """Fetch (url, sha256, md5) tuples concurrently, returns the failures"""
+        queue = Queue()
+        for download in set(downloads):
+            queue.put(download)
+        failures = []
+
+        def worker():
+            while True:
+                try:
+                    url, sha256, md5 = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    self.fetch(url, sha256, md5)
+                except Exception, exc:
+                    self.log.warning("Prefetching %s failed: %s" % (url, exc))
+                    failures.append((url, exc))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(concurrency, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failures
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries past max_size.
+
+        Entries being fetched or read right now are skipped, so are files
+        that disappear while the cache is scanned.
+        """
+        if not self.max_size:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".part"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for _mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            path = os.path.join(self.path, name)
+            if path == keep:
+                continue
+            lock = self._path_lock(path)
+            if not lock.acquire(False):
+                continue
+            try:
+                self.log.debug("Evicting %s from the download cache" % name)
+                os.unlink(path)
+            except OSError:
+                continue
+            finally:
+                lock.release()
+            total -= size
+
+    def _download(self, url, part, resume=True):
+        offset = os.path.getsize(part) if resume and os.path.exists(part) else 0
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header("Range", "bytes=%d-" % offset)
+        self.log.info("Downloading %s%s" % (url, " (resuming at %d bytes)" % offset if offset else ""))
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, exc:
+            if exc.code != 416 or not offset:
+                raise Fail("Downloading %s failed: %s" % (url, exc))
+            # Range not satisfiable, the partial file is already complete
+            return
+        except urllib2.URLError, exc:
+            raise Fail("Downloading %s failed: %s" % (url, exc.reason))
+
+        # A server that ignores Range answers 200 with the full body
+        mode = "ab" if offset and response.getcode() == 206 else "wb"
+        try:
+            with open(part, mode) as fp:
+                while True:
+                    block = response.read(self.blocksize)
+                    if not block:
+                        break
+                    fp.write(block)
+        finally:
+            response.close()
+
+    def _verify(self, path, sha256=None, md5=None):
+        if not sha256 and not md5:
+            return True
+        digests = []
+        if sha256:
+            digests.append((hashlib.sha256(), sha256))
+        if md5:
+            digests.append((hashlib.md5(), md5))
+        with open(path, "rb") as fp:
+            while True:
+                block = fp.read(self.blocksize)
+                if not block:
+                    break
+                for digest, _expected in digests:
+                    digest.update(block)
+        return all(digest.hexdigest() == expected.lower() for digest, expected in digests)
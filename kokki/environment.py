@@ -4,11 +4,19 @@ __all__ = ["Environment"]
 
 import logging
 import os
-import shutil
 import subprocess
+import threading
 from datetime import datetime
 
+from kokki.backup import BackupStore
+from kokki.download import DownloadManager
 from kokki.exceptions import Fail
+from kokki.filecache import FileCache
+from kokki.fileedit import FileEditor
+from kokki.guards import Guard
+from kokki.mounts import MountTable
+from kokki.plan import Plan, resource_key
+from kokki.readiness import wait_all
 from kokki.providers import find_provider
 from kokki.utils import AttributeDictionary
 from kokki.system import System
@@ -17,7 +25,7 @@ from kokki.version import long_version
 class Environment(object):
     _instances = []
 
-    def __init__(self, verbose_logging):
+    def __init__(self, verbose_logging=False):
         self.log = logging.getLogger("kokki")
         logging.basicConfig(level=logging.INFO)
 
@@ -32,6 +40,18 @@ class Environment(object):
         self.resources = {}
         self.resource_list = []
         self.delayed_actions = set()
+        self.plan = None
+        # Selectors limiting the plan to some resources, see Plan.compile
+        self.only = None
+        self.current_recipe = None
+        self.guard_cache = {}
+        self.backups_made = False
+        self.file_editors = {}
+        self.pending_waits = []
+        self.mount_table = MountTable(self)
+        self.run_cache = {}
+        self.finalizers = []
+        self.prefetches = {}
 
         default_config = {
             'date': datetime.now(),
@@ -39,6 +59,14 @@ class Environment(object):
             'kokki.backup.path': '/tmp/kokki/backup',
             'kokki.template_engine': 'jinja2',
             'kokki.backup.prefix': datetime.now().strftime("%Y%m%d%H%M%S"),
+            'kokki.backup.keep': 20,
+            'kokki.backup.max_age': None,
+            'kokki.backup.max_size': None,
+            'kokki.download.path': '/var/tmp/downloads',
+            'kokki.download.max_size': 2 << 30,
+            'kokki.download.concurrency': 4,
+            'kokki.build_cache.path': '/var/cache/kokki/builds',
+            'kokki.source_build.path': '/var/lib/kokki/source-builds',
         }
 
         stored_config = self._load_kokki_conf()
@@ -62,14 +90,71 @@ class Environment(object):
         #     self.log.warning('Can not read kokki_conf.json because jsonpickle is not installed. Using defaults.')
         return None
 
+    @property
+    def backup_store(self):
+        return BackupStore(self.config.kokki.backup.path)
+
     def backup_file(self, path):
         if self.config.kokki.backup:
-            if not os.path.exists(self.config.kokki.backup.path):
-                os.makedirs(self.config.kokki.backup.path, 0700)
-            new_name = self.config.kokki.backup.prefix + path.replace('/', '-')
-            backup_path = os.path.join(self.config.kokki.backup.path, new_name)
-            self.log.info("backing up %s to %s" % (path, backup_path))
-            shutil.copy(path, backup_path)
+            digest = self.backup_store.backup(self.config.kokki.backup.prefix, path)
+            self.log.info("backing up %s as %s in run %s" % (path, digest, self.config.kokki.backup.prefix))
+            self.backups_made = True
+
+    def prune_backups(self):
+        backup = self.config.kokki.backup
+        # Values may come from the command line as strings
+        limit = lambda name, cast:None if backup.get(name) is None else cast(backup.get(name))
+        self.backup_store.prune(limit('keep', int), limit('max_age', float), limit('max_size', int))
+
+    def add_finalizer(self, func):
+        """Call func(env) once at the end of the run, after the delayed actions"""
+        if func not in self.finalizers:
+            self.finalizers.append(func)
+
+    def get_file_editor(self, path, factory=FileEditor):
+        """Return the editor shared by every edit of path in this run.
+
+        factory builds the editor from the path, any object with a flush(env)
+        method will do. An editor of another kind is flushed first.
+        """
+        path = os.path.abspath(path)
+        editor = self.file_editors.get(path)
+        if editor is not None and not isinstance(editor, factory):
+            del self.file_editors[path]
+            editor.flush(self)
+            editor = None
+        if editor is None:
+            editor = self.file_editors[path] = factory(path)
+        return editor
+
+    def flush_file_editors(self, *paths):
+        """Write pending edits so other resources see the files on disk.
+
+        With paths only the edits of those files are written.
+        """
+        if paths:
+            paths = set(os.path.abspath(path) for path in paths)
+            editors = dict((path, self.file_editors.pop(path))
+                for path in sorted(paths) if path in self.file_editors)
+        else:
+            editors, self.file_editors = self.file_editors, {}
+        for path in sorted(editors):
+            editors[path].flush(self)
+
+    def add_wait(self, wait):
+        """Wait for a readiness check before the next resource that needs it"""
+        self.pending_waits.append(wait)
+
+    def flush_waits(self):
+        """Poll every pending readiness check at once, fail if some time out"""
+        waits, self.pending_waits = self.pending_waits, []
+        if not waits:
+            return
+        self.log.info("Waiting for %s" % ", ".join(str(wait) for wait in waits))
+        failed = wait_all(waits)
+        if failed:
+            raise Fail("Timed out waiting for %s" % ", ".join(
+                "%s after %ds" % (wait, wait.timeout) for wait in failed))
 
     def update_config(self, attributes, overwrite=True):
         for key, value in attributes.items():
@@ -82,15 +167,104 @@ class Environment(object):
             if overwrite or path[-1] not in attr:
                 attr[path[-1]] = value
 
+    def compile(self):
+        """Freeze the current resources into an execution plan"""
+        self.log.debug('> Environment.compile()')
+        self.plan = Plan.compile(self)
+        self.log.debug('< Environment.compile() %d steps' % len(self.plan))
+        return self.plan
+
+    def prefetch_downloads(self, plan):
+        """Fetch the cached DownloadSources of the plan concurrently in the background.
+
+        Guarded steps, steps only run when notified and files that already
+        have the expected sha256 are left out, they may not need the
+        download at all. A source being prefetched is simply waited for by
+        its resource.
+        """
+        from kokki.source import DownloadSource
+
+        downloads = {}
+        for step in plan:
+            if not step.actions or step.resource.not_if is not None or step.resource.only_if is not None:
+                continue
+            for name, value in step.arguments.items():
+                if not isinstance(value, DownloadSource) or not value.cache:
+                    continue
+                path = step.arguments.get('path')
+                if (name == 'content' and path and value.sha256sum and os.path.isfile(path)
+                        and FileCache.get_instance().digest(path) == value.sha256sum):
+                    continue
+                downloads.setdefault(value.manager, []).append(value.prefetch_key())
+        if not downloads:
+            return
+
+        def fetch():
+            for manager, keys in downloads.items():
+                manager.prefetch(keys, self.config.kokki.download.concurrency)
+        thread = threading.Thread(target=fetch, name="prefetch-downloads")
+        thread.daemon = True
+        thread.start()
+        self.prefetches[DownloadManager] = thread
+
+    def start_prefetch(self, plan):
+        """Start the prefetch of every provider class that has one in the background.
+
+        A provider class may define a prefetch(env, steps) classmethod that
+        warms local caches (package archives, ...) for its unguarded steps
+        while other resources converge. Providers call wait_for_prefetch()
+        before using what it fetches.
+        """
+        steps = {}
+        for step in plan:
+            if hasattr(step.provider, 'prefetch') and step.resource.not_if is None and step.resource.only_if is None:
+                steps.setdefault(step.provider, []).append(step)
+
+        for provider, provider_steps in steps.items():
+            thread = threading.Thread(target=self._prefetch, args=(provider, provider_steps),
+                name="prefetch-%s" % provider.__name__)
+            thread.daemon = True
+            thread.start()
+            self.prefetches[provider] = thread
+
+    def _prefetch(self, provider, steps):
+        try:
+            provider.prefetch(self, steps)
+        except Exception, exc:
+            # Only a missed optimization, the provider fetches what it needs
+            self.log.warning("Prefetch for %s failed: %s" % (provider.__name__, exc))
+
+    def wait_for_prefetch(self, provider):
+        thread = self.prefetches.pop(provider, None)
+        if thread is not None:
+            thread.join()
+
+    def _provider_class(self, resource):
+        if self.plan is not None:
+            return self.plan.get_step(resource_key(resource)).provider
+        if callable(resource.provider):
+            return resource.provider
+        return find_provider(self, resource.__class__.__name__, resource.provider)
+
+    def _notifications(self, resource):
+        """(immediate, delayed) lists of (action, resource) sent by resource.
+
+        They come from the plan, where they were validated and ordered.
+        """
+        if self.plan is None:
+            return list(resource.subscriptions['immediate']), list(resource.subscriptions['delayed'])
+        step = self.plan.get_step(resource_key(resource))
+        resolve = lambda notifications:[(action, self.resources[key[0]][key[1]]) for action, key in notifications]
+        return resolve(step.immediate), resolve(step.delayed)
+
     def run_action(self, resource, action):
         self.log.info("START: Performing action '%s' on resource '%s'" % (action, resource))
 
-        if callable(resource.provider):
-            provider_class = resource.provider
-        else:
-            provider_class = find_provider(self, resource.__class__.__name__, resource.provider)
+        provider_class = self._provider_class(resource)
 
-        provider = provider_class(resource)
+        # Coalesced steps run with the arguments merged by the plan
+        bound = self.plan.get_step(resource_key(resource)).bind() if self.plan is not None else resource
+        provider = provider_class(bound)
 
         try:
             provider_action = getattr(provider, 'action_%s' % action)
@@ -98,34 +272,101 @@ class Environment(object):
             raise Fail("%r does not implement action %s" % (provider, action))
 
         provider_action()
+        if bound is not resource and bound.is_updated:
+            resource.updated()
 
         if resource.is_updated:
-            for action, res in resource.subscriptions['immediate']:
-                self.log.info("%s sending %s action to %s (immediate)" % (resource, action, res))
-                self.run_action(res, action)
-            for action, res in resource.subscriptions['delayed']:
-                self.log.info("%s sending %s action to %s (delayed)" % (resource, action, res))
-            self.delayed_actions |= resource.subscriptions['delayed']
+            # Guards and mounts may depend on what the resource just changed
+            self.guard_cache.clear()
+            self.mount_table.invalidate()
+            immediate, delayed = self._notifications(resource)
+            if immediate or delayed:
+                self.flush_file_editors()
+            for notified_action, res in immediate:
+                self.log.info("%s sending %s action to %s (immediate)" % (resource, notified_action, res))
+                self.run_action(res, notified_action)
+            for notified_action, res in delayed:
+                self.log.info("%s sending %s action to %s (delayed)" % (resource, notified_action, res))
+            self.delayed_actions.update(delayed)
 
         self.log.info("END: Performing action '%s' on resource '%s'" % (action, resource))
 
+    def check_command(self, command):
+        """Run a shell guard, reusing the result until a resource is updated"""
+        try:
+            return self.guard_cache[command]
+        except KeyError:
+            ret = self.guard_cache[command] = subprocess.call(command, shell=True) == 0
+            return ret
+
     def _check_condition(self, cond):
+        if isinstance(cond, Guard):
+            return cond.check(self)
+
         if hasattr(cond, '__call__'):
             return cond()
 
         if isinstance(cond, basestring):
-            ret = subprocess.call(cond, shell=True)
-            return ret == 0
+            return self.check_command(cond)
 
         raise Exception("Unknown condition type %r" % cond)
 
     def run(self):
         self.log.debug('> Environment.run()')
         with self:
-            # Run resource actions
+            # Per run state kept by providers and cookbook libraries
+            self.run_cache = {}
+            self.finalizers = []
+            self.prefetches = {}
+            self.pending_waits = []
+            self.guard_cache.clear()
+            self.mount_table.invalidate()
+            plan = self.plan if self.plan is not None else self.compile()
+            self.start_prefetch(plan)
+            self.prefetch_downloads(plan)
+            self._run_steps(plan)
+        self.log.debug('< Environment.run()')
+
+    def rerun(self, keys):
+        """Run the steps of the resource keys again, in plan order.
+
+        Meant for resources that drifted after a run: only they and the
+        resources they notify are run, with fresh per run state.
+        """
+        self.log.debug('> Environment.rerun(%d resources)' % len(keys))
+        keys = set(keys)
+        with self:
+            self.run_cache = {}
+            self.finalizers = []
+            self.prefetches = {}
+            self.pending_waits = []
+            self.guard_cache.clear()
+            self.mount_table.invalidate()
             for resource in self.resource_list:
+                resource.is_updated = False
+            plan = self.plan if self.plan is not None else self.compile()
+            self._run_steps([step for step in plan if step.key in keys])
+        self.log.debug('< Environment.rerun()')
+
+    def _run_steps(self, steps):
+        try:
+            # Run resource actions
+            for step in steps:
+                resource = step.resource
                 self.log.debug("Running resource %r" % resource)
 
+                # Consecutive line/block edits share one read and one write
+                if self.file_editors and not getattr(step.provider, 'uses_file_editors', False):
+                    self.flush_file_editors()
+
+                # Consecutive waits (WaitFor, started services) are polled together
+                if self.pending_waits and not getattr(step.provider, 'defers_waits', False):
+                    self.flush_waits()
+
+                if not step.actions:
+                    # Only in a partial plan to receive notifications
+                    continue
+
                 if resource.not_if is not None and self._check_condition(resource.not_if):
                     self.log.debug("Skipping %s due to not_if" % resource)
                     continue
@@ -134,14 +375,31 @@ class Environment(object):
                     self.log.debug("Skipping %s due to only_if" % resource)
                     continue
 
-                for action in resource.action:
+                for action in step.actions:
                     self.run_action(resource, action)
 
+            self.flush_file_editors()
+
             # Run delayed actions
             while self.delayed_actions:
                 action, resource = self.delayed_actions.pop()
+                if self.pending_waits and not getattr(self._provider_class(resource), 'defers_waits', False):
+                    self.flush_waits()
                 self.run_action(resource, action)
-        self.log.debug('< Environment.run()')
+            self.flush_file_editors()
+            self.flush_waits()
+        finally:
+            # Edits already reported as updated must reach the disk when a resource fails
+            self.flush_file_editors()
+
+        while self.finalizers:
+            self.finalizers.pop(0)(self)
+
+        for provider in list(self.prefetches):
+            self.wait_for_prefetch(provider)
+
+        if self.backups_made:
+            self.prune_backups()
 
     @classmethod
     def get_instance(cls):
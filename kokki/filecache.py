@@ -0,0 +1,108 @@
+__all__ = ["FileCache"]
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_mtime, st.st_size)
+
+def file_digest(path, blocksize=1 << 16):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileCache(object):
+    """Content addressed cache of file contents.
+
+    Files are identified by (path, inode, mtime, size) and mapped to the
+    sha256 digest of their content, blobs are stored once per digest. A
+    file that didn't change on disk is never read twice, and the same
+    bytes deployed to many places are only held once. Blobs are kept up to
+    max_size bytes and digests up to max_digests entries, the least
+    recently used go first so a long lived process (the agent) doesn't
+    keep every version it ever read.
+    """
+
+    def __init__(self, max_size=64 << 20, max_digests=100000):
+        self.max_size = max_size
+        self.max_digests = max_digests
+        self._digests = OrderedDict()
+        self._blobs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get(self, entries, key):
+        value = entries.pop(key, None)
+        if value is not None:
+            entries[key] = value
+        return value
+
+    def _add_digest(self, key, digest):
+        self._digests.pop(key, None)
+        self._digests[key] = digest
+        while len(self._digests) > self.max_digests:
+            self._digests.popitem(last=False)
+
+    def _add_blob(self, digest, content):
+        existing = self._get(self._blobs, digest)
+        if existing is not None:
+            return existing
+        if len(content) > self.max_size:
+            return content
+        self._blobs[digest] = content
+        self._size += len(content)
+        while self._size > self.max_size:
+            _digest, blob = self._blobs.popitem(last=False)
+            self._size -= len(blob)
+        return content
+
+    def read(self, path):
+        """Return (digest, content) of path"""
+        key = _stat_key(path)
+        with self._lock:
+            digest = self._get(self._digests, key)
+            if digest is not None:
+                content = self._get(self._blobs, digest)
+                if content is not None:
+                    return digest, content
+
+        with open(path, "rb") as fp:
+            content = fp.read()
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            self._add_digest(key, digest)
+            content = self._add_blob(digest, content)
+        return digest, content
+
+    def digest(self, path):
+        """Return the sha256 digest of path without keeping its content"""
+        key = _stat_key(path)
+        with self._lock:
+            digest = self._get(self._digests, key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._add_digest(key, digest)
+        return digest
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+            self._blobs.clear()
+            self._size = 0
+
+    @classmethod
+    def get_instance(cls):
+        try:
+            return cls._instance
+        except AttributeError:
+            cls._instance = cls()
+        return cls._instance
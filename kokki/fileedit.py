@@ -0,0 +1,131 @@
+__all__ = ["FileEditor"]
+
+import logging
+import os
+import re
+
+from kokki.utils import atomic_write
+
+class FileEditor(object):
+    """In-memory, line indexed copy of a file shared by all edits to it.
+
+    The file is read once, edits only touch the in-memory lines and
+    flush() writes the result once, through a rename.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger("kokki.fileedit")
+        self.existed = os.path.exists(path)
+        if self.existed:
+            with open(path, "rb") as fp:
+                content = fp.read()
+        else:
+            content = ""
+        self.trailing_newline = not content or content.endswith("\n")
+        self.lines = content.split("\n")
+        if content.endswith("\n"):
+            self.lines.pop()
+        elif not content:
+            self.lines = []
+        self._index = None
+        self.dirty = False
+
+    @property
+    def index(self):
+        """Line -> number of occurrences"""
+        if self._index is None:
+            self._index = {}
+            for line in self.lines:
+                self._index[line] = self._index.get(line, 0) + 1
+        return self._index
+
+    def _changed(self):
+        self._index = None
+        self.dirty = True
+        return True
+
+    def has_line(self, line):
+        return line in self.index
+
+    def ensure_line(self, line, match=None):
+        """Make sure line is present. Lines matching the regex match are
+        replaced by it (the first one) or removed (the others)."""
+        if match:
+            pattern = re.compile(match)
+            hits = [i for i, l in enumerate(self.lines) if pattern.search(l)]
+            if hits:
+                if [self.lines[i] for i in hits] == [line]:
+                    return False
+                self.lines[hits[0]] = line
+                for i in reversed(hits[1:]):
+                    del self.lines[i]
+                return self._changed()
+        if self.has_line(line):
+            return False
+        self.lines.append(line)
+        return self._changed()
+
+    def remove_line(self, line, match=None):
+        """Remove every occurrence of line, or every line matching match"""
+        if match:
+            pattern = re.compile(match)
+            keep = [l for l in self.lines if not pattern.search(l)]
+        elif self.has_line(line):
+            keep = [l for l in self.lines if l != line]
+        else:
+            return False
+        if len(keep) == len(self.lines):
+            return False
+        self.lines = keep
+        return self._changed()
+
+    def _find_block(self, begin, end):
+        try:
+            start = self.lines.index(begin)
+            stop = self.lines.index(end, start)
+        except ValueError:
+            return None
+        return start, stop
+
+    def ensure_block(self, begin, end, content):
+        """Make sure content is present between the marker lines begin and end"""
+        body = content.split("\n")
+        if body and body[-1] == "":
+            body.pop()
+        block = [begin] + body + [end]
+        found = self._find_block(begin, end)
+        if found:
+            start, stop = found
+            if self.lines[start:stop+1] == block:
+                return False
+            self.lines[start:stop+1] = block
+        else:
+            self.lines.extend(block)
+        return self._changed()
+
+    def remove_block(self, begin, end):
+        found = self._find_block(begin, end)
+        if not found:
+            return False
+        start, stop = found
+        del self.lines[start:stop+1]
+        return self._changed()
+
+    @property
+    def content(self):
+        if not self.lines:
+            return ""
+        return "\n".join(self.lines) + ("\n" if self.trailing_newline else "")
+
+    def flush(self, env=None):
+        """Write the file if it was edited, returns True if it was"""
+        if not self.dirty:
+            return False
+        if env is not None and self.existed:
+            env.backup_file(self.path)
+        self.log.info("Writing edits to %s" % self.path)
+        atomic_write(self.path, self.content)
+        self.existed = True
+        self.dirty = False
+        return True
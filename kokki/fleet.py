@@ -0,0 +1,207 @@
+__all__ = ["FleetRunner", "LocalTransport", "SSHTransport", "NodeResult"]
+
+import logging
+import os
+import pipes
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue, Empty
+from StringIO import StringIO
+
+from kokki.exceptions import Fail
+from kokki.snapshot import dump_snapshot
+
+NodeResult = namedtuple("NodeResult", "node success returncode output duration")
+
+class Transport(object):
+    """Runs shell commands on a node, optionally feeding data to stdin"""
+
+    # Where bundles are unpacked on the node
+    default_path = "/var/tmp/kokki-fleet"
+
+    def run(self, node, command, data=None):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def _call(self, args, data=None, **kwargs):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, **kwargs)
+        out = proc.communicate(data)[0]
+        return proc.returncode, out
+
+class LocalTransport(Transport):
+    """Treats every node as a directory below root on this machine.
+
+    Commands run through a local shell with the node directory as cwd,
+    which makes fleet runs testable without any network.
+    """
+
+    default_path = "kokki-fleet"
+
+    def __init__(self, root):
+        self.root = root
+
+    def run(self, node, command, data=None):
+        path = os.path.join(self.root, node)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return self._call(command, data, shell=True, cwd=path)
+
+class SSHTransport(Transport):
+    """Runs commands over ssh, sharing one master connection per node"""
+
+    def __init__(self, user=None, port=None, options=None, persist=300):
+        self.user = user
+        self.port = port
+        self.options = options or []
+        self.persist = persist
+        self.control_dir = tempfile.mkdtemp(prefix="kokki-ssh")
+        self.nodes = set()
+        self.lock = threading.Lock()
+
+    def _args(self, node):
+        args = ["ssh", "-o", "BatchMode=yes",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % os.path.join(self.control_dir, "%r@%h:%p"),
+            "-o", "ControlPersist=%d" % self.persist]
+        if self.port:
+            args += ["-p", str(self.port)]
+        args += self.options
+        args.append("%s@%s" % (self.user, node) if self.user else node)
+        return args
+
+    def run(self, node, command, data=None):
+        with self.lock:
+            self.nodes.add(node)
+        return self._call(self._args(node) + [command], data)
+
+    def close(self):
+        for node in self.nodes:
+            args = self._args(node)
+            self._call(args[:-1] + ["-O", "exit", args[-1]])
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+class FleetRunner(object):
+    """Converge many nodes from a single compiled kitchen.
+
+    The kitchen is compiled and snapshotted once, bundled with the
+    cookbooks it uses and pushed to every node, which loads the snapshot
+    and runs it. Nodes are processed in rolling batches of batch_size,
+    with up to concurrency nodes in flight at a time.
+    """
+
+    def __init__(self, kitchen, nodes, transport, concurrency=10, batch_size=None,
+                 max_failures=0, remote_path=None, kokki_command="kokki"):
+        self.kitchen = kitchen
+        self.nodes = list(nodes)
+        self.transport = transport
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size or len(self.nodes) or 1
+        self.max_failures = max_failures
+        self.remote_path = remote_path or transport.default_path
+        self.kokki_command = kokki_command
+        self.log = logging.getLogger("kokki.fleet")
+
+    def build_bundle(self):
+        """Return a gzipped tarball containing the snapshot and cookbooks"""
+        snapshot = dump_snapshot(self.kitchen, [os.path.join(self.remote_path, "cookbooks")])
+
+        buf = StringIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            info = tarfile.TarInfo("kitchen.snap")
+            info.size = len(snapshot)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(snapshot))
+            for name, cb in sorted(self.kitchen.cookbooks.items()):
+                tar.add(cb.path, os.path.join("cookbooks", name), exclude=lambda p:p.endswith(".pyc"))
+        return buf.getvalue()
+
+    def converge_node(self, node, bundle):
+        start = time.time()
+        remote = pipes.quote(self.remote_path)
+        ret, out = self.transport.run(node,
+            "rm -rf %(path)s && mkdir -p %(path)s && tar -xzf - -C %(path)s" % dict(path=remote), bundle)
+        if ret == 0:
+            ret, run_out = self.transport.run(node,
+                "%s -l snapshot:%s/kitchen.snap" % (self.kokki_command, remote))
+            out += run_out
+        return NodeResult(node, ret == 0, ret, out, time.time() - start)
+
+    def _run_batch(self, nodes, bundle):
+        queue = Queue()
+        for node in nodes:
+            queue.put(node)
+        results = []
+
+        def worker():
+            while True:
+                try:
+                    node = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    result = self.converge_node(node, bundle)
+                except Exception, exc:
+                    result = NodeResult(node, False, None, str(exc), 0)
+                self.log.info("%s %s in %.1fs" % (node, "converged" if result.success else "FAILED", result.duration))
+                results.append(result)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.concurrency, len(nodes)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def run(self):
+        start = time.time()
+        bundle = self.build_bundle()
+        self.log.info("Compiled kitchen in %.2fs (%d byte bundle) for %d nodes" % (
+            time.time() - start, len(bundle), len(self.nodes)))
+
+        results = []
+        try:
+            for i in range(0, len(self.nodes), self.batch_size):
+                batch = self.nodes[i:i+self.batch_size]
+                results += self._run_batch(batch, bundle)
+                failures = len([r for r in results if not r.success])
+                if failures > self.max_failures and i + self.batch_size < len(self.nodes):
+                    self.log.error("Stopping rollout after %d failures" % failures)
+                    break
+        finally:
+            self.transport.close()
+
+        order = dict((node, i) for i, node in enumerate(self.nodes))
+        return sorted(results, key=lambda r:order[r.node])
+
+def summarize(results, stream=None):
+    stream = stream or sys.stdout
+    for res in results:
+        stream.write("%-30s %-6s %6.1fs\n" % (res.node, "ok" if res.success else "FAILED", res.duration))
+    failed = [r for r in results if not r.success]
+    durations = [r.duration for r in results] or [0]
+    stream.write("%d nodes, %d failed, slowest %.1fs, average %.1fs\n" % (
+        len(results), len(failed), max(durations), sum(durations) / len(durations)))
+    for res in failed:
+        stream.write("\n==> %s (returned %s)\n%s\n" % (res.node, res.returncode, res.output))
+    return not failed
+
+def load_nodes(spec):
+    """Nodes are given comma separated, or one per line in a file as @path"""
+    if spec.startswith('@'):
+        with open(spec[1:], "rb") as fp:
+            nodes = [line.split('#', 1)[0].strip() for line in fp]
+    else:
+        nodes = [node.strip() for node in spec.split(',')]
+    nodes = [node for node in nodes if node]
+    if not nodes:
+        raise Fail("No fleet nodes specified")
+    return nodes
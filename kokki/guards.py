@@ -0,0 +1,152 @@
+__all__ = ["Guard", "PathExists", "FileContains", "CommandSucceeds", "PortListening", "PackageInstalled"]
+
+import os
+import re
+import socket
+import subprocess
+
+class Guard(object):
+    """Declarative condition for only_if / not_if evaluated in-process.
+
+    Unlike lambdas guards can be stored in snapshots, and unlike shell
+    strings they don't fork a shell for every check.
+    """
+
+    def check(self, env):
+        raise NotImplementedError()
+
+    def __call__(self):
+        from kokki.environment import Environment
+        return self.check(Environment.get_instance())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+            ", ".join("%s=%r" % kv for kv in sorted(self.__dict__.items())))
+
+class PathExists(Guard):
+    def __init__(self, path):
+        self.path = path
+
+    def check(self, env):
+        return os.path.exists(self.path)
+
+class FileContains(Guard):
+    """True if the file exists and contains text (or matches it when regex is set)"""
+
+    def __init__(self, path, text, regex=False):
+        self.path = path
+        self.text = text
+        self.regex = regex
+
+    def check(self, env):
+        try:
+            with open(self.path, "rb") as fp:
+                content = fp.read()
+        except IOError:
+            return False
+        if self.regex:
+            return re.search(self.text, content, re.M) is not None
+        return self.text in content
+
+class CommandSucceeds(Guard):
+    """True if the shell command exits with 0. Results are cached like string guards."""
+
+    def __init__(self, command):
+        self.command = command
+
+    def check(self, env):
+        return env.check_command(self.command)
+
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost", "0.0.0.0", "::", "")
+
+class PortListening(Guard):
+    """True if something is listening on the TCP port.
+
+    The local socket tables answer for this host, other hosts are
+    connected to.
+    """
+
+    def __init__(self, port, host="127.0.0.1"):
+        self.port = int(port)
+        self.host = host
+
+    def check(self, env):
+        if self._is_local():
+            listening = self._proc_listening()
+            if listening is not None:
+                return listening
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(1)
+        try:
+            return sock.connect_ex((self.host, self.port)) == 0
+        except socket.error:
+            # Unknown host
+            return False
+        finally:
+            sock.close()
+
+    def _is_local(self):
+        if self.host in LOCAL_HOSTS or self.host.startswith("127."):
+            return True
+        try:
+            return self.host in (socket.gethostname(), socket.getfqdn())
+        except socket.error:
+            return False
+
+    def _proc_listening(self):
+        found_table = False
+        for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+            try:
+                with open(table, "rb") as fp:
+                    lines = fp.read().split("\n")[1:]
+            except IOError:
+                continue
+            found_table = True
+            for line in lines:
+                fields = line.split()
+                # sl local_address rem_address st ... where st 0A is LISTEN
+                if len(fields) > 3 and fields[3] == "0A" and int(fields[1].rsplit(':', 1)[1], 16) == self.port:
+                    return True
+        return False if found_table else None
+
+class PackageInstalled(Guard):
+    """True if the system package is installed, read from the dpkg database when available"""
+
+    DPKG_STATUS = "/var/lib/dpkg/status"
+
+    def __init__(self, name):
+        self.name = name
+
+    def check(self, env):
+        if os.path.exists(self.DPKG_STATUS):
+            return self.name in self._dpkg_installed(env)
+        return subprocess.call(["rpm", "-q", self.name],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT) == 0
+
+    @staticmethod
+    def invalidate(env):
+        """Forget the installed packages, for providers that just changed them"""
+        env.run_cache.pop('dpkg.installed', None)
+
+    def _dpkg_installed(self, env):
+        # Kept apart from the guard cache, only package changes make it stale
+        # and the mtime can't be trusted to notice them within one second
+        mtime = os.path.getmtime(self.DPKG_STATUS)
+        cached = env.run_cache.get('dpkg.installed')
+        if cached and cached[0] == (self.DPKG_STATUS, mtime):
+            return cached[1]
+
+        installed = set()
+        with open(self.DPKG_STATUS, "rb") as fp:
+            for stanza in fp.read().split("\n\n"):
+                fields = dict(line.split(": ", 1) for line in stanza.split("\n") if ": " in line and not line.startswith(" "))
+                if fields.get("Status", "").endswith(" installed") and "Package" in fields:
+                    installed.add(fields["Package"])
+        env.run_cache['dpkg.installed'] = ((self.DPKG_STATUS, mtime), installed)
+        return installed
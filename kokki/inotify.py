@@ -0,0 +1,92 @@
+__all__ = ["Inotify"]
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+from kokki.exceptions import Fail
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise Fail("inotify is not available on this system")
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+def parse_events(data):
+    """Split what was read from an inotify fd into (wd, mask, cookie, name) tuples"""
+    events = []
+    i = 0
+    while i + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+        i += EVENT_HEADER.size
+        events.append((wd, mask, cookie, data[i:i+length].rstrip("\0")))
+        i += length
+    return events
+
+class Inotify(object):
+    """Minimal inotify binding through ctypes, the fd is non-blocking"""
+
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise Fail("inotify_init1 failed: %s" % os.strerror(ctypes.get_errno()))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch(%s): %s" % (path, os.strerror(err)))
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails harmlessly when the watched path is already gone
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=0):
+        """Return the pending events, waiting up to timeout seconds (None for ever) for some"""
+        if timeout != 0 and not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError, exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        return parse_events(data)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
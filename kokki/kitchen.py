@@ -99,6 +99,8 @@ class Kitchen(Environment):
         self.cookbooks = AttributeDictionary()
         self.cookbook_paths = []
         self.running = False
+        # Cookbooks by path, shared by kitchens that want to reuse loaded libraries
+        self.cookbook_cache = None
 
     def add_cookbook_path(self, *args):
         for path in args:
@@ -122,11 +124,16 @@ class Kitchen(Environment):
                 self.log.debug('Loading cookbook from "%s"' % fullpath)
                 if not os.path.exists(fullpath):
                     continue
-                cb = Cookbook.load_from_path(name, fullpath)
+                if self.cookbook_cache is not None and fullpath in self.cookbook_cache:
+                    cb = self.cookbook_cache[fullpath]
+                else:
+                    cb = Cookbook.load_from_path(name, fullpath)
 
             if not cb:
                 raise ImportError("Cookbook %s not found" % name)
 
+            if self.cookbook_cache is not None:
+                self.cookbook_cache[cb.path] = cb
             self.register_cookbook(cb)
 
     def include_recipe(self, *args):
@@ -151,6 +158,8 @@ class Kitchen(Environment):
             self.included_recipes[name] = (cb, recipe)
 
             if self.running:
+                if self.plan is not None:
+                    raise Fail("Recipe %s included after the plan was compiled" % name)
                 self.source_recipe(cb, recipe)
 
     def source_recipe(self, cookbook, recipe):
@@ -165,9 +174,13 @@ class Kitchen(Environment):
 
         rc, path = cookbook.get_recipe(recipe)
         globs = {'env': self}
-        with self:
-            self.log.debug('Compiling recipe "%s"' % name)
-            exec compile(rc, path, 'exec') in globs
+        parent_recipe, self.current_recipe = self.current_recipe, name
+        try:
+            with self:
+                self.log.debug('Compiling recipe "%s"' % name)
+                exec compile(rc, path, 'exec') in globs
+        finally:
+            self.current_recipe = parent_recipe
 
     def prerun(self):
         ''' Loads all recipes in order '''
@@ -178,13 +191,30 @@ class Kitchen(Environment):
             self.source_recipe(cookbook, recipe)
         self.log.debug('< Kitchen.prerun')
 
+    def source_recipes(self):
+        ''' Sources all included recipes, including the ones they include '''
+        self.plan = None
+        self.running = True
+        try:
+            self.prerun()
+        finally:
+            self.running = False
+
+    def compile(self):
+        ''' Sources all recipes and freezes the resulting resources into a plan '''
+        self.source_recipes()
+        return super(Kitchen, self).compile()
+
     def run(self):
         self.log.debug('> Kitchen.run()')
-        self.running = True
-        self.prerun()
+        if self.plan is None:
+            self.compile()
 
-        super(Kitchen, self).run()
-        self.running = False
+        self.running = True
+        try:
+            super(Kitchen, self).run()
+        finally:
+            self.running = False
         self.log.debug('< Kitchen.run()')
 
     def check_input(self):
@@ -221,6 +251,9 @@ class Kitchen(Environment):
             self.add_cookbook_path(path)
         for recipe in state['included_recipes']:
             self.include_recipe(recipe)
+            # The dumped resources already contain what the recipe created
+            cb, name = self.included_recipes[recipe]
+            self.sourced_recipes.add("%s.%s" % (cb.name, name))
 
     def _check_parameter(self, name):
         parent = self.config
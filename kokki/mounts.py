@@ -0,0 +1,130 @@
+__all__ = ["MountTable"]
+
+import os
+import re
+from subprocess import Popen, PIPE, STDOUT
+
+from kokki.exceptions import Fail
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+FSTAB_PATH = "/etc/fstab"
+
+_escape_re = re.compile(r"\\([0-7]{3})")
+
+def unescape(field):
+    """Decode the octal escapes (\\040 for a space, ...) used by mountinfo and fstab"""
+    return _escape_re.sub(lambda m:chr(int(m.group(1), 8)), field)
+
+def escape(field):
+    return "".join("\\%03o" % ord(c) if c in " \t\n\\" else c for c in field)
+
+def parse_mountinfo(content):
+    """Parse /proc/self/mountinfo.
+
+    36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+
+    The number of optional fields before the '-' varies.
+    """
+    mounts = []
+    for line in content.splitlines():
+        fields = line.split()
+        try:
+            sep = fields.index("-", 6)
+        except ValueError:
+            continue
+        options = fields[5].split(",")
+        for option in fields[sep+3].split(",") if len(fields) > sep + 3 else []:
+            if option not in options:
+                options.append(option)
+        mounts.append(dict(
+            device = unescape(fields[sep+2]),
+            mount_point = unescape(fields[4]),
+            fstype = fields[sep+1],
+            options = options,
+        ))
+    return mounts
+
+def parse_mount_output(content):
+    """Parse the output of mount, for systems without mountinfo"""
+    mounts = []
+    for line in content.strip().split("\n"):
+        m = line.split(" ")
+        if len(m) >= 6 and m[1] == "on" and m[3] == "type":
+            mounts.append(dict(
+                device = m[0],
+                mount_point = m[2],
+                fstype = m[4],
+                options = m[5][1:-1].split(","),
+            ))
+    return mounts
+
+def parse_fstab(content):
+    mounts = []
+    for line in content.splitlines():
+        fields = line.split("#", 1)[0].split()
+        if len(fields) < 4:
+            continue
+        mounts.append(dict(
+            device = unescape(fields[0]),
+            mount_point = unescape(fields[1]),
+            fstype = fields[2],
+            options = fields[3].split(","),
+            dump = int(fields[4]) if len(fields) > 4 else 0,
+            passno = int(fields[5]) if len(fields) > 5 else 0,
+        ))
+    return mounts
+
+class MountTable(object):
+    """Mounted filesystems and fstab entries, parsed once per run.
+
+    The environment invalidates the table whenever a resource is updated,
+    since mounting and enabling (or any command) may change it. Pending
+    edits to fstab that weren't flushed yet are taken into account.
+    """
+
+    mountinfo_path = MOUNTINFO_PATH
+    fstab_path = FSTAB_PATH
+
+    def __init__(self, env=None):
+        self.env = env
+        self._mounts = None
+        self._fstab = None
+
+    def invalidate(self):
+        self._mounts = None
+        self._fstab = None
+
+    @property
+    def mounts(self):
+        if self._mounts is None:
+            if os.path.exists(self.mountinfo_path):
+                with open(self.mountinfo_path, "rb") as fp:
+                    self._mounts = parse_mountinfo(fp.read())
+            else:
+                p = Popen(["mount"], stdout=PIPE, stderr=STDOUT)
+                out = p.communicate()[0]
+                if p.wait() != 0:
+                    raise Fail("Getting list of mounts (calling mount) failed")
+                self._mounts = parse_mount_output(out)
+        return self._mounts
+
+    @property
+    def fstab(self):
+        editor = self.env and self.env.file_editors.get(os.path.abspath(self.fstab_path))
+        if editor is not None and editor.dirty:
+            return parse_fstab(editor.content)
+        if self._fstab is None:
+            if os.path.exists(self.fstab_path):
+                with open(self.fstab_path, "rb") as fp:
+                    self._fstab = parse_fstab(fp.read())
+            else:
+                self._fstab = []
+        return self._fstab
+
+    def is_mounted(self, mount_point):
+        mount_point = os.path.normpath(mount_point)
+        return any(m['mount_point'] == mount_point for m in self.mounts)
+
+    def is_enabled(self, mount_point):
+        mount_point = os.path.normpath(mount_point)
+        return any(os.path.normpath(m['mount_point']) == mount_point for m in self.fstab)
@@ -0,0 +1,319 @@
+__all__ = ["Plan", "PlanStep", "Selector"]
+
+import logging
+import os
+import re
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from kokki.exceptions import Fail
+from kokki.providers import find_provider
+
+class PlanStep(namedtuple("PlanStep", "resource key provider actions arguments immediate delayed merged")):
+    """merged names the arguments taken from File steps coalesced into this one"""
+
+    __slots__ = ()
+
+    def bind(self):
+        """The resource as the step runs it, with the merged arguments.
+
+        The resource itself is left as it was declared. Returns a copy
+        when arguments were merged, which the executor runs instead.
+        """
+        if not self.merged:
+            return self.resource
+        resource = object.__new__(self.resource.__class__)
+        resource.__dict__.update(self.resource.__dict__)
+        resource.arguments = dict(self.resource.arguments)
+        for name in self.merged:
+            resource.arguments[name] = self.arguments[name]
+        resource.is_updated = False
+        return resource
+
+# Arguments that name the filesystem path a resource manages. Two resources
+# managing the same path are reported as duplicates.
+PATH_ARGUMENTS = ("path", "mount_point")
+
+# File steps that may be folded into a later File step on the same path
+COALESCED_ACTIONS = (("create",), ("delete",))
+MERGED_ARGUMENTS = ("content", "owner", "group", "mode")
+
+def resource_key(resource):
+    return (resource.__class__.__name__, resource.name)
+
+class Selector(object):
+    """Picks resources for a partial run (--only).
+
+    Type or Type[name] selects by resource, recipe:cookbook or
+    recipe:cookbook.recipe by the recipe that defined the resource and
+    tag:name by the tags argument. Names may use shell wildcards.
+    """
+
+    _resource_re = re.compile(r"^(\w+)(?:\[(.*)\])?$")
+
+    def __init__(self, spec):
+        self.spec = spec
+        if spec.startswith("recipe:"):
+            self.kind, self.value = "recipe", spec[len("recipe:"):]
+        elif spec.startswith("tag:"):
+            self.kind, self.value = "tag", spec[len("tag:"):]
+        else:
+            match = self._resource_re.match(spec)
+            if not match:
+                raise Fail("Invalid selector %r, expected Type, Type[name], recipe:name or tag:name" % spec)
+            self.kind, self.value = "resource", match.group(1)
+            self.name = match.group(2)
+            if self.name and self.name[0] == self.name[-1] and self.name[0] in "'\"":
+                self.name = self.name[1:-1]
+
+    def matches(self, resource):
+        if self.kind == "tag":
+            return any(fnmatchcase(tag, self.value) for tag in resource.tags)
+        if self.kind == "recipe":
+            recipe = resource.recipe or ""
+            if "." not in self.value:
+                recipe = recipe.split(".", 1)[0]
+            return fnmatchcase(recipe, self.value)
+        return (resource.__class__.__name__ == self.value
+            and (self.name is None or fnmatchcase(resource.name, self.name)))
+
+    def __repr__(self):
+        return self.spec
+
+class Plan(object):
+    """An immutable, ordered list of steps ready to be executed.
+
+    Compiling resolves the provider of every resource, computes all
+    argument defaults, validates and normalizes notifications, coalesces
+    File steps writing the same path and reports resources that manage
+    the same path. With env.only set, only the selected resources are
+    kept, see _select.
+    """
+
+    def __init__(self, steps, duplicates=(), coalesced=()):
+        self.steps = tuple(steps)
+        self.duplicates = tuple(duplicates)
+        self.coalesced = tuple(coalesced)
+        self._index = dict((step.key, step) for step in self.steps)
+        self.log = logging.getLogger("kokki.plan")
+
+    @classmethod
+    def compile(cls, env):
+        providers = {}
+        def resolve(resource):
+            key = resource_key(resource)
+            if key not in providers:
+                if callable(resource.provider):
+                    providers[key] = resource.provider
+                else:
+                    providers[key] = find_provider(env, resource.__class__.__name__, resource.provider)
+            return providers[key]
+
+        def check_action(resource, action):
+            if not hasattr(resolve(resource), 'action_%s' % action):
+                raise Fail("%r does not implement action %s" % (resolve(resource), action))
+
+        resources = []
+        for resource in env.resource_list:
+            actions = tuple(resource.action)
+            for action in actions:
+                check_action(resource, action)
+            arguments = dict((name, getattr(resource, name)) for name in resource._arguments)
+            notifications = dict((timing, set(resource.subscriptions[timing])) for timing in ("immediate", "delayed"))
+            resources.append((resource, actions, arguments, notifications))
+
+        if env.only:
+            selectors = [s if isinstance(s, Selector) else Selector(s) for s in env.only]
+            total = len(resources)
+            resources = cls._select(resources, selectors)
+            logging.getLogger("kokki.plan").info("Selected %d of %d resources with %s" % (
+                len([r for r in resources if r[1]]), total, ", ".join(map(repr, selectors))))
+
+        resources, coalesced, merged = cls._coalesce(resources)
+
+        steps = []
+        paths = {}
+        for resource, actions, arguments, subscriptions in resources:
+            notifications = {}
+            for timing in ("immediate", "delayed"):
+                subs = []
+                for action, target in sorted(subscriptions[timing], key=lambda x:(x[0], resource_key(x[1]))):
+                    check_action(target, action)
+                    subs.append((action, resource_key(target)))
+                notifications[timing] = tuple(subs)
+
+            for name in PATH_ARGUMENTS:
+                path = arguments.get(name)
+                if path and not resource.shares_path:
+                    paths.setdefault(path, []).append(resource_key(resource))
+
+            steps.append(PlanStep(
+                resource = resource,
+                key = resource_key(resource),
+                provider = resolve(resource),
+                actions = actions,
+                arguments = arguments,
+                immediate = notifications["immediate"],
+                delayed = notifications["delayed"],
+                merged = tuple(sorted(merged.get(resource_key(resource), ()))),
+            ))
+
+        duplicates = sorted((path, tuple(keys)) for path, keys in paths.items() if len(keys) > 1)
+        plan = cls(steps, duplicates, coalesced)
+        for path, keys, key in plan.coalesced:
+            plan.log.debug("Coalesced writes to %s: %s into %s['%s']" % ((path, ", ".join("%s['%s']" % k for k in keys)) + key))
+        for path, keys in plan.duplicates:
+            plan.log.warning("%s is managed by several resources: %s" % (path, ", ".join("%s['%s']" % k for k in keys)))
+        return plan
+
+    @staticmethod
+    def _select(resources, selectors):
+        """Keep the resources matching selectors and what they need.
+
+        That is the Directory resources creating the directories above
+        their paths and the resources they notify, transitively. Notified
+        resources that weren't selected themselves keep no actions of
+        their own, they only run when notified.
+        """
+        from kokki.resources import Directory
+
+        index = dict((resource_key(r), (arguments, notifications)) for r, _actions, arguments, notifications in resources)
+        directories = dict((os.path.normpath(arguments['path']), resource_key(r))
+            for r, _actions, arguments, _notifications in resources if isinstance(r, Directory) and arguments.get('path'))
+
+        selected = set(resource_key(r) for r, _actions, _arguments, _notifications in resources
+            if any(s.matches(r) for s in selectors))
+        if not selected:
+            raise Fail("No resource matches %s" % ", ".join(map(repr, selectors)))
+        notified = set()
+        pending = list(selected)
+        while pending:
+            key = pending.pop()
+            arguments, notifications = index[key]
+            if key in selected:
+                for name in PATH_ARGUMENTS:
+                    path = arguments.get(name)
+                    while path and os.path.dirname(path) != path:
+                        path = os.path.dirname(path)
+                        parent = directories.get(path)
+                        if parent is not None and parent not in selected:
+                            selected.add(parent)
+                            notified.discard(parent)
+                            pending.append(parent)
+            for timing in ("immediate", "delayed"):
+                for _action, target in notifications[timing]:
+                    target = resource_key(target)
+                    if target not in selected and target not in notified:
+                        notified.add(target)
+                        pending.append(target)
+
+        return [(r, actions if resource_key(r) in selected else (), arguments, notifications)
+            for r, actions, arguments, notifications in resources if resource_key(r) in selected or resource_key(r) in notified]
+
+    @staticmethod
+    def _coalesce(resources):
+        """Fold runs of File create/delete steps on one path into the last of them.
+
+        Only the final content is computed and written once. A step can be
+        folded when it has no guards and nothing notifies it, and a run
+        is broken by any step that isn't bound to another path, since it
+        could use the file as written so far. A step that notifies other
+        resources ends its run, they must only run when that step changes
+        the file. Unset content and metadata of the final step are taken from
+        the steps it replaces, in the compiled arguments only: resources
+        are never changed. Returns (resources, coalesced, {key: names of the
+        merged arguments}).
+        """
+        from kokki.resources import File
+
+        targets = set()
+        for _resource, _actions, _arguments, notifications in resources:
+            for timing in ("immediate", "delayed"):
+                targets.update(resource_key(target) for _action, target in notifications[timing])
+
+        def foldable(resource, actions):
+            return (isinstance(resource, File) and actions in COALESCED_ACTIONS
+                and resource.not_if is None and resource.only_if is None
+                and resource_key(resource) not in targets)
+
+        runs = {}
+        superseded = set()
+        coalesced = []
+        merged = {}
+
+        def close(path):
+            run = runs.pop(path)
+            if len(run) < 2:
+                return
+            final_resource, final_actions, final_arguments, _notifications = resources[run[-1]]
+            names = merged.setdefault(resource_key(final_resource), set())
+            earlier = [resources[i] for i in run[:-1]]
+            if final_actions == ("create",):
+                deleted = [i for i, (_r, actions, _a, _n) in enumerate(earlier) if actions == ("delete",)]
+                if deleted:
+                    earlier_creates = earlier[deleted[-1]+1:]
+                else:
+                    earlier_creates = earlier
+                for name in MERGED_ARGUMENTS:
+                    if final_arguments.get(name) is not None:
+                        continue
+                    for _r, _actions, arguments, _n in reversed(earlier_creates):
+                        if arguments.get(name) is not None:
+                            final_arguments[name] = arguments[name]
+                            names.add(name)
+                            break
+                if deleted and final_arguments.get("content") is None:
+                    # The file would have been recreated empty
+                    final_arguments["content"] = ""
+                    names.add("content")
+            for resource, _actions, _arguments, _notifications in earlier:
+                superseded.add(id(resource))
+            coalesced.append((path, tuple(resource_key(r) for r, _a, _args, _n in earlier), resource_key(final_resource)))
+
+        for i, (resource, actions, arguments, notifications) in enumerate(resources):
+            if foldable(resource, actions):
+                runs.setdefault(arguments['path'], []).append(i)
+                if notifications['immediate'] or notifications['delayed']:
+                    close(arguments['path'])
+                continue
+            bound = [arguments[name] for name in PATH_ARGUMENTS if arguments.get(name)]
+            if bound and not notifications['immediate']:
+                # Only runs on this path, or below it, are affected
+                for path in list(runs):
+                    if any(path == b or path.startswith(b.rstrip("/") + "/") for b in bound):
+                        close(path)
+            else:
+                for path in list(runs):
+                    close(path)
+        for path in list(runs):
+            close(path)
+
+        return ([r for r in resources if id(r[0]) not in superseded], sorted(coalesced),
+            dict((key, names) for key, names in merged.items() if names))
+
+    def get_step(self, key):
+        try:
+            return self._index[key]
+        except KeyError:
+            raise Fail("Resource %s['%s'] is not part of the plan" % key)
+
+    def describe(self):
+        """Return a human readable listing of the plan."""
+        lines = []
+        for step in self.steps:
+            lines.append("%s['%s'] %s via %s.%s" % (step.key + (",".join(step.actions) or "(when notified)",
+                step.provider.__module__, step.provider.__name__)))
+            for timing in ("immediate", "delayed"):
+                for action, key in getattr(step, timing):
+                    lines.append("    notifies %s %s['%s'] (%s)" % ((action,) + key + (timing,)))
+        for path, keys, key in self.coalesced:
+            lines.append("coalesced %s: %s into %s['%s']" % ((path, ", ".join("%s['%s']" % k for k in keys)) + key))
+        for path, keys in self.duplicates:
+            lines.append("duplicate path %s: %s" % (path, ", ".join("%s['%s']" % k for k in keys)))
+        return "\n".join(lines)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
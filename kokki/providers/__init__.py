@@ -21,10 +21,12 @@ class Provider(object):
 PROVIDERS = dict(
     debian = dict(
         Package = "kokki.providers.package.apt.DebianAptProvider",
+        AptRepository = "kokki.providers.package.apt.AptRepositoryProvider",
         Service = "kokki.providers.service.debian.DebianServiceProvider",
     ),
     ubuntu = dict(
         Package = "kokki.providers.package.apt.DebianAptProvider",
+        AptRepository = "kokki.providers.package.apt.AptRepositoryProvider",
         Service = "kokki.providers.service.debian.DebianServiceProvider",
     ),
     redhat = dict(
@@ -49,11 +51,16 @@ PROVIDERS = dict(
     ),
     default = dict(
         File = "kokki.providers.system.FileProvider",
+        FileLine = "kokki.providers.system.FileLineProvider",
+        FileBlock = "kokki.providers.system.FileBlockProvider",
         Directory = "kokki.providers.system.DirectoryProvider",
+        DirectorySync = "kokki.providers.system.DirectorySyncProvider",
         Link = "kokki.providers.system.LinkProvider",
         Execute = "kokki.providers.system.ExecuteProvider",
         Script = "kokki.providers.system.ScriptProvider",
         Mount = "kokki.providers.mount.MountProvider",
+        SourceBuild = "kokki.providers.package.source.SourceBuildProvider",
+        WaitFor = "kokki.providers.service.WaitForProvider",
         User = "kokki.providers.accounts.UserProvider",
         Group = "kokki.providers.accounts.GroupProvider",
     ),
@@ -2,11 +2,14 @@ from __future__ import with_statement
 
 import os
 import re
-from subprocess import Popen, PIPE, STDOUT, check_call
+from subprocess import check_call
 from kokki.base import Fail
+from kokki.mounts import escape
 from kokki.providers import Provider
 
 class MountProvider(Provider):
+    uses_file_editors = True
+
     def action_mount(self):
         if not os.path.exists(self.resource.mount_point):
             os.makedirs(self.resource.mount_point)
@@ -23,6 +26,7 @@ class MountProvider(Provider):
                 args.append(self.resource.device)
             args.append(self.resource.mount_point)
 
+            self.flush_fstab()
             check_call(args)
 
             self.log.info("%s mounted" % self)
@@ -30,6 +34,7 @@ class MountProvider(Provider):
 
     def action_umount(self):
         if self.is_mounted():
+            self.flush_fstab()
             check_call(["umount", self.resource.mount_point])
 
             self.log.info("%s unmounted" % self)
@@ -46,21 +51,41 @@ class MountProvider(Provider):
             if not self.resource.fstype:
                 raise Fail("[%s] fstype not set but required for enable action" % self)
 
-            with open("/etc/fstab", "a") as fp:
-                fp.write("%s %s %s %s %d %d\n" % (
-                        self.resource.device,
-                        self.resource.mount_point,
-                        self.resource.fstype,
-                        ",".join(self.resource.options or ["defaults"]),
-                        self.resource.dump,
-                        self.resource.passno,
-                    ))
-
-            self.log.info("%s enabled" % self)
+            if self.resource.env.get_file_editor(self.resource.env.mount_table.fstab_path).ensure_line("%s %s %s %s %d %d" % (
+                    escape(self.resource.device),
+                    escape(self.resource.mount_point),
+                    self.resource.fstype,
+                    ",".join(self.resource.options or ["defaults"]),
+                    self.resource.dump,
+                    self.resource.passno,
+                )):
+                self.log.info("%s enabled" % self)
+                self.resource.updated()
+
+    def action_remount(self):
+        if self.is_mounted():
+            options = [o for o in self.resource.options or [] if o != "defaults"]
+            self.flush_fstab()
+            check_call(["mount", "-o", ",".join(["remount"] + options), self.resource.mount_point])
+
+            self.log.info("%s remounted" % self)
             self.resource.updated()
+        else:
+            self.log.debug("%s is not mounted" % self)
 
     def action_disable(self):
-        pass # TODO
+        if self.is_enabled():
+            # Match on the mount point, the other fields may differ
+            match = r"^\s*[^#\s]\S*\s+%s/?\s" % re.escape(escape(os.path.normpath(self.resource.mount_point)))
+            if self.resource.env.get_file_editor(self.resource.env.mount_table.fstab_path).remove_line(None, match):
+                self.log.info("%s disabled" % self)
+                self.resource.updated()
+        else:
+            self.log.debug("%s not enabled" % self)
+
+    def flush_fstab(self):
+        # mount and umount read fstab, they must see the edits of this run
+        self.resource.env.flush_file_editors(self.resource.env.mount_table.fstab_path)
 
     def is_mounted(self):
         if not os.path.exists(self.resource.mount_point):
@@ -69,49 +94,13 @@ class MountProvider(Provider):
         if self.resource.device and not os.path.exists(self.resource.device):
             raise Fail("%s Device %s does not exist" % (self, self.resource.device))
 
-        mounts = self.get_mounted()
-        for m in mounts:
-            if m['mount_point'] == self.resource.mount_point:
-                return True
-
-        return False
+        return self.resource.env.mount_table.is_mounted(self.resource.mount_point)
 
     def is_enabled(self):
-        mounts = self.get_fstab()
-        for m in mounts:
-            if m['mount_point'] == self.resource.mount_point:
-                return True
-
-        return False
+        return self.resource.env.mount_table.is_enabled(self.resource.mount_point)
 
     def get_mounted(self):
-        p = Popen("mount", stdout=PIPE, stderr=STDOUT, shell=True)
-        out = p.communicate()[0]
-        if p.wait() != 0:
-            raise Fail("[%s] Getting list of mounts (calling mount) failed" % self)
-
-        mounts = [x.split(' ') for x in out.strip().split('\n')]
-
-        return [dict(
-                device = m[0],
-                mount_point = m[2],
-                fstype = m[4],
-                options = m[5][1:-1].split(','),
-            ) for m in mounts if m[1] == "on" and m[3] == "type"]
+        return self.resource.env.mount_table.mounts
 
     def get_fstab(self):
-        mounts = []
-        with open("/etc/fstab", "r") as fp:
-            for line in fp:
-                line = line.split('#', 1)[0].strip()
-                mount = re.split('\s+', line)
-                if len(mount) == 6:
-                    mounts.append(dict(
-                        device = mount[0],
-                        mount_point = mount[1],
-                        fstype = mount[2],
-                        options = mount[3].split(","),
-                        dump = int(mount[4]),
-                        passno = int(mount[5]),
-                    ))
-        return mounts
+        return self.resource.env.mount_table.fstab
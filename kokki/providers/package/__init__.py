@@ -1,12 +1,25 @@
 
 from kokki.base import Fail
+from kokki.guards import PackageInstalled
 from kokki.providers import Provider
 
 class PackageProvider(Provider):
+    # Actions whose packages are worth downloading ahead of time
+    prefetch_actions = ("install", "upgrade")
+
     def __init__(self, *args, **kwargs):
         super(PackageProvider, self).__init__(*args, **kwargs)
         self.get_current_status()
 
+    @classmethod
+    def prefetch_packages(cls, steps):
+        """Return (name, version) of the packages the steps may install"""
+        packages = []
+        for step in steps:
+            if set(step.actions) & set(cls.prefetch_actions) and not step.arguments.get('build_vars'):
+                packages.append((step.arguments['location'], step.arguments.get('version')))
+        return packages
+
     def get_current_status(self):
         raise NotImplementedError()
 
@@ -37,7 +50,9 @@ class PackageProvider(Provider):
             self.resource.package_name, install_version, self.resource.version,
             self.current_version, self.candidate_version, self.resource.location)
 
+        self.resource.env.wait_for_prefetch(self.__class__)
         status = self.install_package(self.resource.location, install_version)
+        PackageInstalled.invalidate(self.resource.env)
         if status:
             self.resource.updated()
 
@@ -47,7 +62,9 @@ class PackageProvider(Provider):
             self.log.info("Upgrading %s from version %s to %s",
                 str(self.resource), orig_version, self.candidate_version)
 
+            self.resource.env.wait_for_prefetch(self.__class__)
             status = self.upgrade_package(self.resource.location, self.candidate_version)
+            PackageInstalled.invalidate(self.resource.env)
             if status:
                 self.resource.updated()
 
@@ -55,10 +72,12 @@ class PackageProvider(Provider):
         if self.current_version:
             self.log.info("Remove %s version %s", self.resource.package_name, self.current_version)
             self.remove_package(self.resource.package_name)
+            PackageInstalled.invalidate(self.resource.env)
             self.resource.updated()
 
     def action_purge(self):
         if self.current_version:
             self.log.info("Purging %s version %s", self.resource.package_name, self.current_version)
             self.purge_package(self.resource.package_name)
+            PackageInstalled.invalidate(self.resource.env)
             self.resource.updated()
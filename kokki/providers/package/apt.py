@@ -1,15 +1,171 @@
 
 import glob
+import hashlib
 import os
 import shutil
+import struct
 import tempfile
+from base64 import b64decode
+from multiprocessing import cpu_count
 from subprocess import Popen, STDOUT, PIPE, check_call, CalledProcessError
 from kokki.base import Fail
+from kokki.buildcache import BuildCache
+from kokki.providers import Provider
 from kokki.providers.package import PackageProvider
+from kokki.source import DownloadSource
+from kokki.utils import atomic_write
 
+TRUSTED_KEYRINGS = ["/etc/apt/trusted.gpg", "/etc/apt/trusted.gpg.d"]
+
+def dearmor(data):
+    """Return the binary OpenPGP data of an ASCII armored key"""
+    if "-----BEGIN PGP" not in data:
+        return data
+    lines = data[data.index("-----BEGIN PGP"):].splitlines()[1:]
+    # Armor headers end with an empty line
+    if "" in lines:
+        lines = lines[lines.index("")+1:]
+    body = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("=") or line.startswith("-----END"):
+            break
+        body.append(line)
+    return b64decode("".join(body))
+
+def _packets(data):
+    """Yield (tag, body) of the OpenPGP packets in data"""
+    i = 0
+    while i < len(data):
+        header = ord(data[i])
+        i += 1
+        if not header & 0x80:
+            return
+        if header & 0x40:
+            tag = header & 0x3f
+            first = ord(data[i])
+            if first < 192:
+                length, i = first, i + 1
+            elif first < 224:
+                length, i = ((first - 192) << 8) + ord(data[i+1]) + 192, i + 2
+            elif first == 255:
+                length, i = struct.unpack(">I", data[i+1:i+5])[0], i + 5
+            else:
+                # Partial lengths are not used for key packets
+                return
+        else:
+            tag = (header >> 2) & 0x0f
+            length_type = header & 3
+            if length_type == 0:
+                length, i = ord(data[i]), i + 1
+            elif length_type == 1:
+                length, i = struct.unpack(">H", data[i:i+2])[0], i + 2
+            elif length_type == 2:
+                length, i = struct.unpack(">I", data[i:i+4])[0], i + 4
+            else:
+                length = len(data) - i
+        yield tag, data[i:i+length]
+        i += length
+
+def key_fingerprints(data):
+    """Fingerprints of the v4 public keys and subkeys in data"""
+    fingerprints = []
+    for tag, body in _packets(dearmor(data)):
+        if tag in (6, 14) and body[:1] == "\x04":
+            fingerprints.append(hashlib.sha1("\x99" + struct.pack(">H", len(body)) + body).hexdigest().upper())
+    return fingerprints
+
+def keyring_fingerprints(paths):
+    """Fingerprints of every key in the keyring files, or directories of them, in paths"""
+    fingerprints = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith((".gpg", ".asc")))
+        else:
+            files = [path] if os.path.exists(path) else []
+        for keyring in files:
+            with open(keyring, "rb") as fp:
+                fingerprints.update(key_fingerprints(fp.read()))
+    return fingerprints
+
+def schedule_index_update(env, path=None):
+    """Mark the source list at path (None for all of them) as needing an index refresh"""
+    pending = env.run_cache.setdefault('apt.update', set())
+    pending.add(path)
+
+def update_package_indexes(env):
+    """Run one apt-get update for every source list changed so far, returns True if it did"""
+    pending = env.run_cache.pop('apt.update', None)
+    if not pending:
+        return False
+
+    command = ["apt-get", "-q", "update"]
+    if None in pending:
+        check_call(command, stdout=PIPE, stderr=STDOUT)
+        return True
+
+    # Only fetch the indexes of the changed lists, keeping the others
+    parts = tempfile.mkdtemp(prefix="kokki-apt")
+    try:
+        for path in sorted(pending):
+            os.symlink(os.path.abspath(path), os.path.join(parts, os.path.basename(path)))
+        check_call(command + [
+            "-o", "Dir::Etc::sourcelist=/dev/null",
+            "-o", "Dir::Etc::sourceparts=%s" % parts,
+            "-o", "APT::Get::List-Cleanup=0",
+        ], stdout=PIPE, stderr=STDOUT)
+    finally:
+        shutil.rmtree(parts)
+    return True
+
+
+def parse_policy(out):
+    """Parse apt-cache policy output into {name: (installed, candidate)}"""
+    policy = {}
+    name = None
+    for line in out.split("\n"):
+        if line and not line[0].isspace() and line.rstrip().endswith(":"):
+            name = line.rstrip()[:-1]
+            policy[name] = (None, None)
+            continue
+        fields = line.strip().split(':', 1)
+        if name is None or len(fields) != 2:
+            continue
+        installed, candidate = policy[name]
+        ver = fields[1].strip()
+        ver = None if ver == '(none)' else ver
+        if fields[0] == "Installed":
+            policy[name] = (ver, candidate)
+        elif fields[0] == "Candidate":
+            policy[name] = (installed, ver)
+    return policy
 
 class DebianAptProvider(PackageProvider):
+    @classmethod
+    def prefetch(cls, env, steps):
+        """Download the .debs the plan will install into the apt archive cache"""
+        packages = cls.prefetch_packages(steps)
+        if not packages:
+            return
+        proc = Popen(["apt-cache", "policy"] + [name for name, _version in packages], stdout=PIPE, stderr=PIPE)
+        policy = parse_policy(proc.communicate()[0])
+        specs = []
+        for name, version in packages:
+            installed, candidate = policy.get(name, (None, None))
+            # Unknown packages may come from a repository added later in the run
+            version = version or candidate
+            if version and version != installed:
+                specs.append("%s=%s" % (name, version))
+        if specs:
+            check_call(["apt-get", "-q", "-y", "--download-only", "install"] + specs,
+                stdout=PIPE, stderr=STDOUT, env=dict(os.environ, DEBIAN_FRONTEND="noninteractive"))
+
     def get_current_status(self):
+        if self.resource.env.run_cache.get('apt.update'):
+            # apt-get update and the prefetch would fight over the apt locks
+            self.resource.env.wait_for_prefetch(self.__class__)
+        update_package_indexes(self.resource.env)
+
         self.current_version = None
         self.candidate_version = None
 
@@ -41,7 +197,36 @@ class DebianAptProvider(PackageProvider):
             shell=True, stdout=PIPE, stderr=STDOUT)
     
     def _install_package_source(self, name, version):
-        build_vars = " ".join(self.resource.build_vars)
+        cache = BuildCache(self.resource.env.config.kokki.build_cache.path)
+        key = self._build_key(name, version)
+        debs = cache.lookup(name, key)
+        if debs:
+            self.log.info("Installing %s %s from the build cache" % (name, version))
+        else:
+            debs = self._build_package_source(name, version, cache, key)
+
+        # NOTE: I can't figure out why this call returns non-zero sometimes, though everything seems to work.
+        # Just ignoring checking for now.
+        try:
+            check_call(["dpkg", "-i"] + debs, stdout=PIPE, stderr=STDOUT)
+        except CalledProcessError:
+            pass
+
+        return True
+
+    def _build_key(self, name, version):
+        """Everything the built .debs depend on"""
+        lsb = self.resource.env.system.lsb or {}
+        proc = Popen(["dpkg", "--print-architecture"], stdout=PIPE)
+        arch = proc.communicate()[0].strip()
+        return BuildCache.key(name=name, version=version, build_vars=list(self.resource.build_vars),
+            arch=arch, distro=[lsb.get('id'), lsb.get('codename') or lsb.get('release')])
+
+    def _build_package_source(self, name, version, cache, key):
+        build_vars = list(self.resource.build_vars)
+        if not any(var.startswith("DEB_BUILD_OPTIONS=") for var in build_vars):
+            build_vars.insert(0, "DEB_BUILD_OPTIONS=parallel=%d" % cpu_count())
+        build_vars = " ".join(build_vars)
         run_check_call = lambda s, **kw: check_call(s, shell = True, stdout=PIPE, stderr=STDOUT, **kw)
         pkgdir = tempfile.mkdtemp(suffix = name)
 
@@ -57,17 +242,13 @@ class DebianAptProvider(PackageProvider):
 
             run_check_call("%s fakeroot debian/rules binary > /dev/null" % build_vars, cwd = builddir)
 
-            # NOTE: I can't figure out why this call returns non-zero sometimes, though everything seems to work.
-            # Just ignoring checking for now.
-            try:
-                run_check_call("dpkg -i *.deb > /dev/null", cwd = pkgdir)
-            except CalledProcessError:
-                pass
+            debs = glob.glob(os.path.join(pkgdir, "*.deb"))
+            if not debs:
+                raise Fail("Couldn't install %s from source: the build produced no packages." % name)
+            return cache.store(name, key, debs)
         finally:
             shutil.rmtree(pkgdir)
 
-        return True
-
     def remove_package(self, name):
         return 0 == check_call("DEBIAN_FRONTEND=noninteractive apt-get -q -y remove %s" % name,
             shell=True, stdout=PIPE, stderr=STDOUT)
@@ -78,3 +259,92 @@ class DebianAptProvider(PackageProvider):
 
     def upgrade_package(self, name, version):
         return self.install_package(name, version)
+
+class AptRepositoryProvider(Provider):
+    def action_add(self):
+        key_changed = self._ensure_key()
+
+        content = self._get_content()
+        path = self.resource.path
+        list_changed = True
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                list_changed = fp.read() != content
+            if list_changed:
+                self.resource.env.backup_file(path)
+
+        if list_changed:
+            self.log.info("Writing source list %s for %s" % (path, self.resource))
+            atomic_write(path, content)
+            os.chmod(path, 0644)
+
+        if list_changed or key_changed:
+            self._schedule_update(path)
+            self.resource.updated()
+
+    def action_remove(self):
+        removed = False
+        for path in (self.resource.path, self.resource.keyring):
+            if os.path.exists(path):
+                self.log.info("Removing %s for %s" % (path, self.resource))
+                self.resource.env.backup_file(path)
+                os.unlink(path)
+                removed = True
+        if removed:
+            self._schedule_update(None)
+            self.resource.updated()
+
+    def action_update(self):
+        if update_package_indexes(self.resource.env):
+            self.log.info("Updated package indexes")
+
+    def _schedule_update(self, path):
+        schedule_index_update(self.resource.env, path)
+        # Packages installed later refresh the indexes first, this covers
+        # runs that don't install any
+        self.resource.env.add_finalizer(update_package_indexes)
+
+    def _get_content(self):
+        content = self.resource.content
+        if content is not None:
+            if hasattr(content, "__call__"):
+                content = content()
+            return content if content.endswith("\n") else content + "\n"
+
+        if not self.resource.uri or not self.resource.distribution:
+            raise Fail("%s needs either content or uri and distribution" % self.resource)
+        line = " ".join([self.resource.uri, self.resource.distribution] + list(self.resource.components))
+        lines = ["deb " + line]
+        if self.resource.deb_src:
+            lines.append("deb-src " + line)
+        return "\n".join(lines) + "\n"
+
+    def _ensure_key(self):
+        """Install the signing key unless the keyring already trusts it"""
+        wanted = (self.resource.key_fingerprint or "").replace(" ", "").upper()
+        if not self.resource.key and not self.resource.key_url and not wanted:
+            return False
+
+        trusted = keyring_fingerprints(TRUSTED_KEYRINGS + [self.resource.keyring])
+        if wanted and wanted in trusted:
+            return False
+        if not self.resource.key and not self.resource.key_url:
+            # Signed by a key the system should already have, e.g. the distribution's
+            raise Fail("%s signing key %s is not trusted" % (self.resource, self.resource.key_fingerprint))
+
+        key = self.resource.key
+        if key is None:
+            key = DownloadSource(self.resource.key_url, env=self.resource.env).get_content()
+        key = dearmor(key)
+        fingerprints = key_fingerprints(key)
+        if not fingerprints:
+            raise Fail("No public key found for %s" % self.resource)
+        if wanted and wanted not in fingerprints:
+            raise Fail("Key for %s doesn't match fingerprint %s" % (self.resource, self.resource.key_fingerprint))
+        if not wanted and fingerprints[0] in trusted:
+            return False
+
+        self.log.info("Adding key %s to %s for %s" % (fingerprints[0], self.resource.keyring, self.resource))
+        atomic_write(self.resource.keyring, key)
+        os.chmod(self.resource.keyring, 0644)
+        return True
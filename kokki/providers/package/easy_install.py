@@ -1,53 +1,80 @@
-
+import logging
 import re
 from subprocess import check_call, Popen, PIPE, STDOUT
+from kokki.distributions import get_distribution_index, normalize_name, script_interpreter
 from kokki.providers.package import PackageProvider
+from kokki.utils import parallel_map
 
-VERSION_RE = re.compile(r'\S\S(.*)\/(.*)-(.*)-py(.*).egg\S')
 BEST_MATCH_RE = re.compile(r'Best match: (.*) (.*)\n')
 
+log = logging.getLogger("kokki.provider")
+
+def lookup_candidate(easy_install, name):
+    """Ask easy_install for the best available version of name"""
+    proc = Popen([easy_install, "-n", name], stdout=PIPE, stderr=STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        log.warning("easy_install check returned a non-zero result (%d) for %s" % (proc.returncode, name))
+    match = BEST_MATCH_RE.search(out)
+    return match and match.group(2)
+
+def get_candidate_version(env, easy_install, name):
+    """Best available version of name, looked up once per run"""
+    candidates = env.run_cache.setdefault('easy_install.candidates', {})
+    key = (easy_install, normalize_name(name))
+    if key not in candidates:
+        candidates[key] = lookup_candidate(easy_install, name)
+    return candidates[key]
+
 class EasyInstallProvider(PackageProvider):
+    """Python packages installed with easy_install.
+
+    Installed versions come from the egg/dist-info metadata of the
+    interpreter easy_install runs with, scanned once per run. Candidate
+    versions are looked up once per package and run, concurrently for the
+    whole plan in the background.
+    """
+
+    easy_install_binary_path = "easy_install"
+
+    @classmethod
+    def distribution_index(cls, env):
+        return get_distribution_index(env, script_interpreter(cls.easy_install_binary_path))
+
+    @classmethod
+    def prefetch(cls, env, steps):
+        """Look up the candidates of the packages that don't have a version"""
+        names = sorted(set(step.arguments['package_name'] for step in steps
+            if set(step.actions) & set(cls.prefetch_actions) and not step.arguments.get('version')))
+        parallel_map(lambda name:get_candidate_version(env, cls.easy_install_binary_path, name),
+            names, env.config.kokki.download.concurrency)
+
     def get_current_status(self):
-        proc = Popen(["python", "-c", "import %s; print %s.__path__" % (self.resource.package_name, self.resource.package_name)], stdout=PIPE, stderr=STDOUT)
-        path = proc.communicate()[0]
-        if proc.wait() != 0:
+        dist = self.distribution_index(self.resource.env).distributions.get(normalize_name(self.resource.package_name))
+        if dist is None:
             self.current_version = None
         else:
-            match = VERSION_RE.search(path)
-            if match:
-                self.current_version = match.group(3)
-            else:
-                self.current_version = "unknown"
+            self.current_version = dist[1] or "unknown"
 
     @property
     def candidate_version(self):
         if not hasattr(self, '_candidate_version'):
-            proc = Popen([self.easy_install_binary_path, "-n", self.resource.package_name], stdout=PIPE, stderr=STDOUT)
-            out = proc.communicate()[0]
-            res = proc.wait()
-            if res != 0:
-                self.log.warning("easy_install check returned a non-zero result (%d) %s" % (res, self.resource))
-            #     self._candidate_version = None
-            # else:
-            match = BEST_MATCH_RE.search(out)
-            if not match:
-                self._candidate_version = None
-            else:
-                self._candidate_version = match.group(2)
+            self.resource.env.wait_for_prefetch(self.__class__)
+            self._candidate_version = get_candidate_version(self.resource.env,
+                self.easy_install_binary_path, self.resource.package_name)
         return self._candidate_version
 
-    @property
-    def easy_install_binary_path(self):
-        return "easy_install"
-
     def install_package(self, name, version):
         check_call([self.easy_install_binary_path, "-U", "%s==%s" % (name, version)], stdout=PIPE, stderr=STDOUT)
+        self.distribution_index(self.resource.env).invalidate()
+        return True
 
     def upgrade_package(self, name, version):
-        self.install_package(name, version)
+        return self.install_package(name, version)
 
     def remove_package(self, name):
         check_call([self.easy_install_binary_path, "-m", name])
+        self.distribution_index(self.resource.env).invalidate()
 
     def purge_package(self, name):
         self.remove_package(name)
@@ -0,0 +1,171 @@
+from __future__ import with_statement
+
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from multiprocessing import cpu_count
+from subprocess import Popen, PIPE, STDOUT
+from kokki.base import Fail
+from kokki.buildcache import BuildCache
+from kokki.providers import Provider
+from kokki.source import DownloadSource
+from kokki.utils import atomic_write
+
+TREE_NAME = "tree.tar.gz"
+
+def build_key(env, arguments):
+    """Everything the installed tree depends on"""
+    lsb = env.system.lsb or {}
+    return BuildCache.key(url=arguments['url'], sha256sum=arguments.get('sha256sum'),
+        md5sum=arguments.get('md5sum'), configure_flags=list(arguments['configure_flags']),
+        make_flags=list(arguments['make_flags']), install_command=arguments['install_command'],
+        environment=arguments.get('environment'), arch=os.uname()[4],
+        distro=[lsb.get('id'), lsb.get('codename') or lsb.get('release')])
+
+class SourceBuildProvider(Provider):
+    """Build a source tarball with configure and make, and install the result.
+
+    The tree installed to a DESTDIR is cached as a tarball in the build
+    cache, so any node with the same build key only unpacks it. The key
+    of what was installed is recorded in a state file, which is how a
+    change of URL, checksum or flags triggers a new install.
+    """
+
+    @classmethod
+    def prefetch(cls, env, steps):
+        cache = BuildCache(env.config.kokki.build_cache.path)
+        downloads = []
+        for step in steps:
+            if "install" not in step.actions:
+                continue
+            if cache.lookup(step.resource.name, build_key(env, step.arguments)):
+                continue
+            source = DownloadSource(step.arguments['url'], md5sum=step.arguments.get('md5sum'),
+                sha256sum=step.arguments.get('sha256sum'), env=env)
+            downloads.append(source.prefetch_key())
+        if downloads:
+            source.manager.prefetch(downloads, env.config.kokki.download.concurrency)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.resource.env.config.kokki.source_build.path, "%s.json" % self.resource.name)
+
+    def get_state(self):
+        try:
+            with open(self.state_path, "rb") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def action_install(self):
+        env = self.resource.env
+        key = build_key(env, dict((name, getattr(self.resource, name)) for name in self.resource._arguments))
+        root = self.resource.root
+        state = self.get_state()
+        if (state and state.get('key') == key and state.get('root') == root
+                and all(os.path.lexists(os.path.join(root, f)) for f in state.get('files', []))):
+            return
+
+        cache = BuildCache(env.config.kokki.build_cache.path)
+        artifacts = cache.lookup(self.resource.name, key)
+        if artifacts:
+            self.log.info("Installing %s from the build cache" % self.resource)
+        else:
+            env.wait_for_prefetch(self.__class__)
+            artifacts = self._build(cache, key)
+
+        files = self._unpack(artifacts[0], root)
+        if state and state.get('root') == root:
+            self._remove_stale(root, set(state.get('files', [])) - set(files))
+
+        if self.resource.post_install:
+            self._run(self.resource.post_install)
+
+        state_dir = os.path.dirname(self.state_path)
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        atomic_write(self.state_path, json.dumps(dict(key=key, url=self.resource.url, root=root, files=files), indent=1))
+        self.resource.updated()
+
+    def _build(self, cache, key):
+        source = DownloadSource(self.resource.url, md5sum=self.resource.md5sum,
+            sha256sum=self.resource.sha256sum, env=self.resource.env)
+        tarball = source.manager.fetch(source.url, source.sha256sum, source.md5sum)
+
+        workdir = tempfile.mkdtemp(prefix="kokki-build-%s-" % self.resource.name)
+        try:
+            srcdir = os.path.join(workdir, "src")
+            destdir = os.path.join(workdir, "dest")
+            os.mkdir(srcdir)
+            os.mkdir(destdir)
+            with tarfile.open(tarball) as tf:
+                tf.extractall(srcdir)
+            # Source tarballs usually hold a single <name>-<version> directory
+            entries = os.listdir(srcdir)
+            if len(entries) == 1 and os.path.isdir(os.path.join(srcdir, entries[0])):
+                srcdir = os.path.join(srcdir, entries[0])
+
+            self.log.info("Building %s from %s" % (self.resource, self.resource.url))
+            if os.path.exists(os.path.join(srcdir, "configure")):
+                self._run(["./configure"] + self.resource.configure_flags, cwd=srcdir)
+            elif self.resource.configure_flags:
+                raise Fail("%s has configure_flags but %s has no configure script" % (self.resource, self.resource.url))
+            self._run(["make", "-j%d" % cpu_count()] + self.resource.make_flags, cwd=srcdir)
+            self._run(self.resource.install_command % dict(destdir=destdir), cwd=srcdir)
+
+            if not os.listdir(destdir):
+                raise Fail("%s installed nothing into %s, does install_command honour it?" % (self.resource, destdir))
+            tree = os.path.join(workdir, TREE_NAME)
+            with tarfile.open(tree, "w:gz") as tf:
+                for name in sorted(os.listdir(destdir)):
+                    tf.add(os.path.join(destdir, name), arcname=name)
+            return cache.store(self.resource.name, key, [tree])
+        finally:
+            shutil.rmtree(workdir)
+
+    def _unpack(self, tree, root):
+        """Extract the cached tree into root, returns the paths of its files.
+
+        Only files are extracted: the directories of the tree would carry
+        the mode, owner and mtime of the build onto /usr and friends. Missing
+        directories are created, existing ones are left alone.
+        """
+        files = []
+        with tarfile.open(tree) as tf:
+            for member in tf.getmembers():
+                name = os.path.normpath(member.name)
+                if name.startswith(("/", "..")):
+                    raise Fail("%s has an unsafe path %s in its cached tree %s" % (self.resource, member.name, tree))
+                path = os.path.join(root, name)
+                if member.isdir():
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    continue
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tf.extract(member, root)
+                files.append(member.name)
+        return sorted(files)
+
+    def _remove_stale(self, root, files):
+        """Remove files a previous build installed that the current one doesn't"""
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                self.log.debug("Removing %s left by the previous build of %s" % (path, self.resource))
+                os.unlink(path)
+
+    def _run(self, command, cwd=None):
+        environment = None
+        if self.resource.environment:
+            environment = os.environ.copy()
+            environment.update(self.resource.environment)
+        proc = Popen(command, shell=isinstance(command, basestring), cwd=cwd, env=environment,
+            stdout=PIPE, stderr=STDOUT)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            if not isinstance(command, basestring):
+                command = " ".join(command)
+            raise Fail("%s failed for %s:\n%s" % (command, self.resource, "\n".join(out.splitlines()[-20:])))
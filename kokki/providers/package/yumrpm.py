@@ -1,4 +1,5 @@
 
+from subprocess import check_call, PIPE, STDOUT
 from kokki.providers.package import PackageProvider
 import yum
 
@@ -9,6 +10,15 @@ class DummyCallback(object):
 
 
 class YumProvider(PackageProvider):
+    @classmethod
+    def prefetch(cls, env, steps):
+        """Download the rpms the plan will install into the yum cache"""
+        packages = cls.prefetch_packages(steps)
+        if packages:
+            check_call(["yum", "-q", "-y", "install", "--downloadonly"] +
+                ["%s-%s" % (name, version) if version else name for name, version in packages],
+                stdout=PIPE, stderr=STDOUT)
+
     def get_current_status(self):
         self.candidate_version = None
         self.current_version = None
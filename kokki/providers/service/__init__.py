@@ -3,12 +3,14 @@ import subprocess
 
 from kokki.base import Fail
 from kokki.providers import Provider
+from kokki.readiness import Wait
 
 class ServiceProvider(Provider):
     def action_start(self):
         if not self.status():
             self._exec_cmd("start", 0)
             self.resource.updated()
+            self._wait_ready()
 
     def action_stop(self):
         if self.status():
@@ -22,6 +24,7 @@ class ServiceProvider(Provider):
         else:
             self._exec_cmd("restart", 0)
             self.resource.updated()
+        self._wait_ready()
 
     def action_reload(self):
         if not self.status():
@@ -30,6 +33,12 @@ class ServiceProvider(Provider):
         else:
             self._exec_cmd("reload", 0)
             self.resource.updated()
+        self._wait_ready()
+
+    def _wait_ready(self):
+        # Polled with other pending waits before the next resource runs
+        for target in self.resource.wait_for:
+            self.resource.env.add_wait(Wait(target, self.resource.wait_timeout, owner=self.resource))
 
     def status(self):
         return self._exec_cmd("status") == 0
@@ -80,3 +89,13 @@ class ServiceProvider(Provider):
             self.__upstart = os.path.exists("/sbin/start") \
                              and os.path.exists("/etc/init/%s.conf" % self.resource.service_name)
         return self.__upstart
+
+class WaitForProvider(Provider):
+    """Queue the targets, consecutive WaitFor and started services are polled concurrently"""
+
+    defers_waits = True
+
+    def action_wait(self):
+        for target in self.resource.targets:
+            self.resource.env.add_wait(Wait(target, self.resource.timeout,
+                self.resource.interval, self.resource.max_interval, owner=self.resource))
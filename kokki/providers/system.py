@@ -5,11 +5,20 @@ import grp
 import os
 import pwd
 import shutil
+import stat as statmod
 import subprocess
 from kokki.base import Fail
+from kokki.filecache import FileCache
 from kokki.providers import Provider
+from kokki.source import Source
+from kokki.utils import atomic_write, parallel_map
 from adlt.logs_asserts import start as start_msg
 
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
 def _coerce_uid(user):
     try:
         uid = int(user)
@@ -51,15 +60,83 @@ def _ensure_metadata(path, user, group, mode = None, log = None):
 
     return updated
 
+def _scandir(path):
+    """Yield (name, lstat) of the entries of path"""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            yield name, os.lstat(os.path.join(path, name))
+
+def _ensure_tree_metadata(path, user, group, dir_mode=None, file_mode=None, workers=1, log=None):
+    """Enforce ownership and modes on everything below path.
+
+    Every entry is stat'ed once and only touched when it differs. Symlinks
+    are left alone. The subdirectories of path are spread over workers
+    threads. Returns a dict with the number of entries seen and changed.
+    """
+    uid = _coerce_uid(user) if user else -1
+    gid = _coerce_gid(group) if group else -1
+
+    def fix(entry, st, counts):
+        counts['entries'] += 1
+        if statmod.S_ISLNK(st.st_mode):
+            return
+        mode = dir_mode if statmod.S_ISDIR(st.st_mode) else file_mode
+        if mode and st.st_mode & 07777 != mode:
+            os.chmod(entry, mode)
+            counts['chmod'] += 1
+        if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+            os.lchown(entry, uid, gid)
+            counts['chown'] += 1
+
+    def walk(top):
+        counts = dict(entries=0, chmod=0, chown=0)
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            for name, st in _scandir(dirpath):
+                entry = os.path.join(dirpath, name)
+                if statmod.S_ISDIR(st.st_mode):
+                    stack.append(entry)
+                fix(entry, st, counts)
+        return counts
+
+    # Entries directly in path are handled here, the subdirectories
+    # below them are spread over the workers
+    totals = dict(entries=0, chmod=0, chown=0)
+    subdirs = []
+    for name, st in _scandir(path):
+        entry = os.path.join(path, name)
+        if statmod.S_ISDIR(st.st_mode):
+            subdirs.append(entry)
+        fix(entry, st, totals)
+
+    for counts in parallel_map(walk, subdirs, workers):
+        for key, value in counts.items():
+            totals[key] += value
+
+    log and log.info("Checked metadata of %(entries)d entries below %(path)s: %(chmod)d chmod, %(chown)d chown" % dict(totals, path=path))
+    return totals
 
 class FileProvider(Provider):
     def action_create(self):
         path = self.resource.path
         write = False
-        content = self._get_content()
+        content = None
+        checksum = self._get_checksum()
+        if checksum is None:
+            content = self._get_content()
         if not os.path.exists(path):
             write = True
             reason = "it doesn't exist"
+        elif checksum is not None:
+            # Compare digests so the source doesn't have to be loaded
+            if FileCache.get_instance().digest(path) != checksum:
+                write = True
+                reason = "checksums don't match"
+                self.resource.env.backup_file(path)
         else:
             if content is not None:
                 with open(path, "rb") as fp:
@@ -70,10 +147,10 @@ class FileProvider(Provider):
                     self.resource.env.backup_file(path)
 
         if write:
+            if checksum is not None:
+                content = self._get_content()
             self.log.info("Writing %s because %s" % (self.resource, reason))
-            with open(path, "wb") as fp:
-                if content:
-                    fp.write(content)
+            atomic_write(path, content or "")
             self.resource.updated()
 
         if _ensure_metadata(self.resource.path, self.resource.owner, self.resource.group, mode = self.resource.mode, log = self.log):
@@ -91,6 +168,12 @@ class FileProvider(Provider):
         with open(path, "a"):
             pass
 
+    def _get_checksum(self):
+        content = self.resource.content
+        if isinstance(content, Source):
+            return content.get_checksum()
+        return None
+
     def _get_content(self):
         content = self.resource.content
         if content is None:
@@ -102,9 +185,44 @@ class FileProvider(Provider):
         raise Fail("Unknown source type for %s: %r" % (self, content))
 
 
+class FileLineProvider(Provider):
+    uses_file_editors = True
+
+    def action_present(self):
+        editor = self.resource.env.get_file_editor(self.resource.path)
+        if editor.ensure_line(self.resource.line, self.resource.match):
+            self.log.info("Adding line to %s for %s" % (self.resource.path, self.resource))
+            self.resource.updated()
+
+    def action_absent(self):
+        editor = self.resource.env.get_file_editor(self.resource.path)
+        if editor.remove_line(self.resource.line, self.resource.match):
+            self.log.info("Removing line from %s for %s" % (self.resource.path, self.resource))
+            self.resource.updated()
+
+class FileBlockProvider(Provider):
+    uses_file_editors = True
+
+    def _markers(self):
+        marker = self.resource.marker
+        return marker % "BEGIN", marker % "END"
+
+    def action_present(self):
+        editor = self.resource.env.get_file_editor(self.resource.path)
+        begin, end = self._markers()
+        if editor.ensure_block(begin, end, self.resource.content):
+            self.log.info("Updating block in %s for %s" % (self.resource.path, self.resource))
+            self.resource.updated()
+
+    def action_absent(self):
+        editor = self.resource.env.get_file_editor(self.resource.path)
+        begin, end = self._markers()
+        if editor.remove_block(begin, end):
+            self.log.info("Removing block from %s for %s" % (self.resource.path, self.resource))
+            self.resource.updated()
+
 class DirectoryProvider(Provider):
     def action_create(self):
-        log and log.info("Creating directory: ", self.resource.path)
         path = self.resource.path
         if not os.path.exists(path):
             self.log.info("Creating directory %s" % self.resource)
@@ -117,8 +235,14 @@ class DirectoryProvider(Provider):
         if _ensure_metadata(path, self.resource.owner, self.resource.group, mode = self.resource.mode, log = self.log):
             self.resource.updated()
 
+        if self.resource.recursive_metadata:
+            counts = _ensure_tree_metadata(path, self.resource.owner, self.resource.group,
+                dir_mode = self.resource.mode, file_mode = self.resource.file_mode,
+                workers = int(self.resource.metadata_workers or 1), log = self.log)
+            if counts['chmod'] or counts['chown']:
+                self.resource.updated()
+
     def action_delete(self):
-        log and log.info("Deleting  directory: ", self.resource.path)
         path = self.resource.path
         if os.path.exists(path):
             self.log.info("Removing directory %s" % self.resource)
@@ -133,9 +257,137 @@ class DirectoryProvider(Provider):
         self.action_delete()
         self.action_create()
 
+def _scan_tree(root):
+    """Return {relative path: lstat} of everything below root"""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            entries[os.path.relpath(path, root)] = os.lstat(path)
+    return entries
+
+class DirectorySyncProvider(Provider):
+    """Mirror a cookbook files/ subtree or a directory to path.
+
+    Both trees are scanned once. Files are copied when their size differs,
+    or when only their mtime differs and their digests don't match, and
+    owner and mode are applied while each entry is compared or copied, so
+    a tree that is already in sync costs two walks and no reads.
+    """
+
+    def action_sync(self):
+        source = self.source_path
+        if not os.path.isdir(source):
+            raise Fail("%s source directory %s does not exist" % (self.resource, source))
+
+        path = self.resource.path
+        if not os.path.exists(path):
+            self.log.info("Creating directory %s" % self.resource)
+            os.makedirs(path, self.resource.dir_mode or 0755)
+            self.resource.updated()
+        if _ensure_metadata(path, self.resource.owner, self.resource.group, mode = self.resource.dir_mode, log = self.log):
+            self.resource.updated()
+
+        wanted = _scan_tree(source)
+        existing = _scan_tree(path)
+        cache = FileCache.get_instance()
+        uid = _coerce_uid(self.resource.owner) if self.resource.owner else -1
+        gid = _coerce_gid(self.resource.group) if self.resource.group else -1
+
+        def fix(target, st, mode):
+            # Owner and mode are checked against the stat of the scan
+            changed = False
+            if mode and st.st_mode & 07777 != mode:
+                os.chmod(target, mode)
+                changed = True
+            if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+                os.lchown(target, uid, gid)
+                changed = True
+            return changed
+
+        copies = []
+        fixed = 0
+        for rel in sorted(wanted):
+            st = wanted[rel]
+            target = os.path.join(path, rel)
+            current = existing.get(rel)
+            if statmod.S_ISDIR(st.st_mode):
+                if current and not statmod.S_ISDIR(current.st_mode):
+                    os.unlink(target)
+                    current = None
+                if not current:
+                    os.mkdir(target, self.resource.dir_mode or 0755)
+                    self.resource.updated()
+                    current = os.lstat(target)
+                if fix(target, current, self.resource.dir_mode):
+                    fixed += 1
+            elif statmod.S_ISLNK(st.st_mode):
+                link = os.readlink(os.path.join(source, rel))
+                if current and statmod.S_ISLNK(current.st_mode) and os.readlink(target) == link:
+                    continue
+                self._remove(target, current)
+                os.symlink(link, target)
+                self.resource.updated()
+            elif not current or not statmod.S_ISREG(current.st_mode):
+                self._remove(target, current)
+                copies.append(rel)
+            elif current.st_size != st.st_size:
+                copies.append(rel)
+            elif int(current.st_mtime) != int(st.st_mtime) and cache.digest(os.path.join(source, rel)) != cache.digest(target):
+                copies.append(rel)
+            else:
+                if int(current.st_mtime) != int(st.st_mtime):
+                    # Same content, sync mtime so the next run takes the fast path
+                    os.utime(target, (st.st_atime, st.st_mtime))
+                if fix(target, current, self.resource.mode):
+                    fixed += 1
+
+        def copy(rel):
+            target = os.path.join(path, rel)
+            tmp = os.path.join(os.path.dirname(target), ".%s.kokki-sync" % os.path.basename(target))
+            shutil.copy2(os.path.join(source, rel), tmp)
+            fix(tmp, os.lstat(tmp), self.resource.mode)
+            os.rename(tmp, target)
+
+        if copies:
+            self.log.info("%s copying %d files" % (self.resource, len(copies)))
+            parallel_map(copy, copies, int(self.resource.workers or 1))
+            self.resource.updated()
+
+        if fixed:
+            self.log.info("%s changed owner or mode of %d entries" % (self.resource, fixed))
+            self.resource.updated()
+
+        if self.resource.purge:
+            # Deepest first so directories are empty when removed
+            for rel in sorted((r for r in existing if r not in wanted), key=len, reverse=True):
+                if not os.path.lexists(os.path.join(path, rel)):
+                    continue
+                self.log.info("%s purging %s" % (self.resource, rel))
+                self._remove(os.path.join(path, rel), existing[rel])
+                self.resource.updated()
+
+    @property
+    def source_path(self):
+        source = self.resource.source
+        if os.path.isabs(source):
+            return source
+        try:
+            cookbook, name = source.split('/', 1)
+        except ValueError:
+            cookbook, name = source, ""
+        return os.path.join(self.resource.env.cookbooks[cookbook].path, "files", name)
+
+    def _remove(self, path, st):
+        if st is None:
+            return
+        if statmod.S_ISDIR(st.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
 class LinkProvider(Provider):
     def action_create(self):
-        log and log.info("Creating link: ", self.resource.path)
         path = self.resource.path
 
         if os.path.lexists(path):
@@ -157,7 +409,6 @@ class LinkProvider(Provider):
             self.resource.updated()
 
     def action_delete(self):
-        log and log.info("Deleting link: ", self.resource.path)
         path = self.resource.path
         if os.path.exists(path):
             self.log.info("Deleting %s" % self.resource)
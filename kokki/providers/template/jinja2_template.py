@@ -1,6 +1,7 @@
 import os
 from kokki import environment, Source
 from kokki.exceptions import Fail
+from kokki.filecache import FileCache
 
 try:
     from jinja2 import Environment, BaseLoader, TemplateNotFound
@@ -25,8 +26,7 @@ else:
             if not os.path.exists(path):
                 raise TemplateNotFound("%s at %s" % (template, path))
             mtime = os.path.getmtime(path)
-            with open(path, "rb") as fp:
-                source = fp.read().decode('utf-8')
+            source = FileCache.get_instance().read(path)[1].decode('utf-8')
             return source, path, lambda:mtime == os.path.getmtime(path)
 
     class Jinja2Template(Source):
@@ -34,7 +34,11 @@ else:
             self.name = name
             self.env = env or environment.Environment.get_instance()
             self.context = variables.copy() if variables else {}
-            self.template_env = Environment(loader=Jinja2TemplateLoader(self.env), autoescape=False)
+            # One jinja environment per kokki environment, templates are compiled once
+            try:
+                self.template_env = self.env._jinja2_template_env
+            except AttributeError:
+                self.template_env = self.env._jinja2_template_env = Environment(loader=Jinja2TemplateLoader(self.env), autoescape=False)
             self.template = self.template_env.get_template(self.name)
 
         def get_content(self):
@@ -0,0 +1,192 @@
+__all__ = ["parse_check", "Wait", "wait_all", "TCPCheck", "UnixSocketCheck",
+    "FileCheck", "PidFileCheck", "HTTPCheck"]
+
+import errno
+import httplib
+import os
+import socket
+import threading
+import time
+import urlparse
+
+from kokki.exceptions import Fail
+
+class Check(object):
+    """One readiness condition, ready(timeout) must not block longer than timeout"""
+
+    def ready(self, timeout):
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+class TCPCheck(Check):
+    def __init__(self, port, host="127.0.0.1"):
+        self.port = int(port)
+        self.host = host
+
+    def ready(self, timeout):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout)
+        except socket.error:
+            return False
+        sock.close()
+        return True
+
+    def __str__(self):
+        return "tcp:%s:%d" % (self.host, self.port)
+
+class UnixSocketCheck(Check):
+    def __init__(self, path):
+        self.path = path
+
+    def ready(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def __str__(self):
+        return "unix:%s" % self.path
+
+class FileCheck(Check):
+    def __init__(self, path):
+        self.path = path
+
+    def ready(self, timeout):
+        return os.path.exists(self.path)
+
+    def __str__(self):
+        return "file:%s" % self.path
+
+class PidFileCheck(Check):
+    """The pidfile exists and names a running process"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def ready(self, timeout):
+        try:
+            with open(self.path, "rb") as fp:
+                pid = int(fp.read().strip() or 0)
+        except (IOError, ValueError):
+            return False
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError, exc:
+            return exc.errno == errno.EPERM
+        return True
+
+    def __str__(self):
+        return "pidfile:%s" % self.path
+
+class HTTPCheck(Check):
+    """A GET of the url answers 200"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def ready(self, timeout):
+        url = urlparse.urlsplit(self.url)
+        cls = httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        conn = cls(url.netloc, timeout=timeout)
+        try:
+            conn.request("GET", path)
+            return conn.getresponse().status == 200
+        except (socket.error, httplib.HTTPException):
+            return False
+        finally:
+            conn.close()
+
+    def __str__(self):
+        return self.url
+
+def parse_check(spec):
+    """Build the check of a readiness target.
+
+    tcp:[host:]port (or just a port number), unix:/path, file:/path,
+    pidfile:/path or an http:// or https:// url.
+    """
+    if isinstance(spec, Check):
+        return spec
+    if isinstance(spec, (int, long)):
+        return TCPCheck(spec)
+    if spec.isdigit():
+        return TCPCheck(int(spec))
+    if spec.startswith(("http://", "https://")):
+        return HTTPCheck(spec)
+    kind, _, rest = spec.partition(":")
+    if kind == "tcp" and rest:
+        host, _, port = rest.rpartition(":")
+        if port.isdigit():
+            return TCPCheck(int(port), host.strip("[]") or "127.0.0.1")
+    elif kind == "unix" and rest:
+        return UnixSocketCheck(rest)
+    elif kind == "file" and rest:
+        return FileCheck(rest)
+    elif kind == "pidfile" and rest:
+        return PidFileCheck(rest)
+    raise Fail("Invalid readiness target %r" % spec)
+
+class Wait(object):
+    """Poll a check until it's ready or timeout seconds passed since the wait was created.
+
+    The delay between attempts starts at interval and doubles up to
+    max_interval, so a fast daemon is seen quickly and a slow one isn't
+    hammered.
+    """
+
+    def __init__(self, check, timeout=60, interval=0.1, max_interval=2.0, owner=None):
+        self.check = parse_check(check)
+        self.timeout = float(timeout)
+        self.interval = float(interval)
+        self.max_interval = float(max_interval)
+        self.owner = owner
+        self.deadline = time.time() + self.timeout
+        self.attempts = 0
+        self.is_ready = False
+
+    def run(self):
+        interval = self.interval
+        while True:
+            remaining = self.deadline - time.time()
+            self.attempts += 1
+            # Always try at least once, even when the deadline has passed
+            if self.check.ready(max(0.1, min(remaining, 5.0))):
+                self.is_ready = True
+                return True
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_interval)
+
+    def __str__(self):
+        return "%s (%s)" % (self.check, self.owner) if self.owner else str(self.check)
+
+def wait_all(waits):
+    """Run waits concurrently, returns the ones that timed out"""
+    waits = list(waits)
+    if len(waits) == 1:
+        waits[0].run()
+    else:
+        threads = [threading.Thread(target=wait.run) for wait in waits]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return [wait for wait in waits if not wait.is_ready]
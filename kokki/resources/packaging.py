@@ -1,7 +1,10 @@
 
-__all__ = ["Package"]
+__all__ = ["Package", "AptRepository", "SourceBuild"]
 
-from kokki.base import Resource, ForcedListArgument, ResourceArgument
+import re
+
+from kokki.base import Resource, ForcedListArgument, ResourceArgument, BooleanArgument
+from kokki.exceptions import Fail
 
 class Package(Resource):
     action = ForcedListArgument(default="install")
@@ -10,3 +13,37 @@ class Package(Resource):
     version = ResourceArgument()
     actions = ["install", "upgrade", "remove", "purge"]
     build_vars = ForcedListArgument(default=[])
+
+class AptRepository(Resource):
+    action = ForcedListArgument(default="add")
+    path = ResourceArgument(default=lambda obj:"/etc/apt/sources.list.d/%s.list" % obj.name)
+    uri = ResourceArgument()
+    distribution = ResourceArgument()
+    components = ForcedListArgument(default=[])
+    deb_src = BooleanArgument(default=False)
+    content = ResourceArgument()
+    key = ResourceArgument()
+    key_url = ResourceArgument()
+    key_fingerprint = ResourceArgument()
+    keyring = ResourceArgument(default=lambda obj:"/etc/apt/trusted.gpg.d/%s.gpg" % obj.name)
+
+    actions = Resource.actions + ["add", "remove", "update"]
+
+    def validate(self):
+        # Short key ids can be forged, only a full v4 fingerprint identifies a key
+        if self.key_fingerprint and not re.match(r"^[0-9A-F]{40}$", self.key_fingerprint.replace(" ", "").upper()):
+            raise Fail("[%s] key_fingerprint must be a full 40 hex digit fingerprint" % self)
+
+class SourceBuild(Resource):
+    action = ForcedListArgument(default="install")
+    url = ResourceArgument(required=True)
+    sha256sum = ResourceArgument()
+    md5sum = ResourceArgument()
+    configure_flags = ForcedListArgument(default=[])
+    make_flags = ForcedListArgument(default=[])
+    install_command = ResourceArgument(default="make install DESTDIR=%(destdir)s")
+    environment = ResourceArgument()
+    post_install = ResourceArgument()
+    root = ResourceArgument(default="/")
+
+    actions = Resource.actions + ["install"]
@@ -1,7 +1,6 @@
+__all__ = ["Service", "WaitFor"]
 
-__all__ = ["Service"]
-
-from kokki.base import Resource, ResourceArgument, BooleanArgument
+from kokki.base import Resource, ResourceArgument, BooleanArgument, ForcedListArgument
 
 class Service(Resource):
     service_name = ResourceArgument(default=lambda obj:obj.name)
@@ -16,5 +15,17 @@ class Service(Resource):
     supports_restart = BooleanArgument(default=lambda obj:bool(obj.restart_command))
     supports_reload = BooleanArgument(default=lambda obj:bool(obj.reload_command))
     supports_status = BooleanArgument(default=lambda obj:bool(obj.status_command))
+    # Readiness targets (see WaitFor) to wait for after starting the service
+    wait_for = ForcedListArgument(default=[])
+    wait_timeout = ResourceArgument(default=60)
 
     actions = ["nothing", "start", "stop", "restart", "reload"]
+
+class WaitFor(Resource):
+    action = ForcedListArgument(default="wait")
+    targets = ForcedListArgument(default=lambda obj:[obj.name])
+    timeout = ResourceArgument(default=60)
+    interval = ResourceArgument(default=0.1)
+    max_interval = ResourceArgument(default=2.0)
+
+    actions = Resource.actions + ["wait"]
@@ -1,5 +1,5 @@
 
-__all__ = ["File", "Directory", "Link", "Execute", "Script", "Mount"]
+__all__ = ["File", "FileLine", "FileBlock", "Directory", "DirectorySync", "Link", "Execute", "Script", "Mount"]
 
 from kokki.base import Resource, ForcedListArgument, ResourceArgument, BooleanArgument
 
@@ -14,6 +14,24 @@ class File(Resource):
 
     actions = Resource.actions + ["create", "delete", "touch"]
 
+class FileLine(Resource):
+    action = ForcedListArgument(default="present")
+    path = ResourceArgument(required=True)
+    line = ResourceArgument(default=lambda obj:obj.name)
+    match = ResourceArgument()
+
+    actions = Resource.actions + ["present", "absent"]
+    shares_path = True
+
+class FileBlock(Resource):
+    action = ForcedListArgument(default="present")
+    path = ResourceArgument(required=True)
+    content = ResourceArgument(default="")
+    marker = ResourceArgument(default=lambda obj:"# %%s kokki block %s" % obj.name)
+
+    actions = Resource.actions + ["present", "absent"]
+    shares_path = True
+
 class Directory(Resource):
     action = ForcedListArgument(default="create")
     path = ResourceArgument(default=lambda obj:obj.name)
@@ -21,9 +39,25 @@ class Directory(Resource):
     owner = ResourceArgument()
     group = ResourceArgument()
     recursive = BooleanArgument(default=False)
+    recursive_metadata = BooleanArgument(default=False)
+    file_mode = ResourceArgument()
+    metadata_workers = ResourceArgument(default=1)
 
     actions = Resource.actions + ["create", "delete", "empty"]
 
+class DirectorySync(Resource):
+    action = ForcedListArgument(default="sync")
+    path = ResourceArgument(default=lambda obj:obj.name)
+    source = ResourceArgument(required=True)
+    mode = ResourceArgument()
+    dir_mode = ResourceArgument()
+    owner = ResourceArgument()
+    group = ResourceArgument()
+    purge = BooleanArgument(default=False)
+    workers = ResourceArgument(default=1)
+
+    actions = Resource.actions + ["sync"]
+
 class Link(Resource):
     action = ForcedListArgument(default="create")
     path = ResourceArgument(default=lambda obj:obj.name)
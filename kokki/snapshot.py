@@ -0,0 +1,199 @@
+__all__ = ["dump_snapshot", "load_snapshot", "SNAPSHOT_VERSION"]
+
+import logging
+import marshal
+from datetime import datetime
+
+from kokki.exceptions import Fail
+from kokki.guards import Guard
+from kokki.source import Source, StaticFile, Template, DownloadSource
+from kokki.utils import AttributeDictionary
+
+SNAPSHOT_MAGIC = "KOKKISNP"
+SNAPSHOT_VERSION = 1
+
+# Top level keys every snapshot carries. Loading refuses anything that
+# doesn't match so a node never runs a half understood plan.
+SNAPSHOT_SCHEMA = ("version", "config", "cookbook_paths", "recipes", "resources")
+
+# Arguments only used to build subscriptions while a recipe is evaluated.
+# The resulting subscriptions are stored on their own.
+_SUBSCRIPTION_ARGUMENTS = ("notifies", "subscribes")
+
+# Config values that belong to the run on the controller, the node keeps
+# its own
+_RUN_SCOPED_CONFIG = ("date", "kokki.backup.prefix", "kokki.long_version")
+
+# Sources are stored by kind and arguments and built again on the node,
+# rendering them on the controller would bake in the controller's facts
+_SOURCE_TYPES = {
+    "static": StaticFile,
+    "template": Template,
+    "download": DownloadSource,
+}
+
+# Names Template.get_content adds to the context, not template variables
+_TEMPLATE_BUILTINS = ("env", "repr", "str", "bool")
+
+log = logging.getLogger("kokki.snapshot")
+
+def _class_path(env, cls):
+    for name, cb in env.cookbooks.items():
+        if cb.library.get(cls.__name__) is cls:
+            return "*%s.%s" % (name, cls.__name__)
+    if cls.__module__ in ("__builtin__", "__main__"):
+        raise Fail("Unable to find an importable path for %r" % cls)
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+def _load_class(env, class_path):
+    if class_path.startswith('*'):
+        cookbook, classname = class_path[1:].split('.')
+        return getattr(env.cookbooks[cookbook], classname)
+
+    mod_path, class_name = class_path.rsplit('.', 1)
+    mod = __import__(mod_path, {}, {}, [class_name])
+    return getattr(mod, class_name)
+
+def _encode(value, where):
+    if isinstance(value, AttributeDictionary):
+        value = value._dict
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, dict):
+        return dict((_encode(k, where), _encode(v, where)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(_encode(v, where) for v in value)
+    if isinstance(value, datetime):
+        return {"__kokki__": "datetime", "value": value.timetuple()[:6] + (value.microsecond,)}
+    if isinstance(value, Guard):
+        return {"__kokki__": "guard", "type": "%s.%s" % (value.__class__.__module__, value.__class__.__name__),
+                "value": _encode(value.__dict__, where)}
+    if isinstance(value, Source):
+        return _encode_source(value, where)
+    raise Fail("Unable to snapshot %s: unsupported value %r" % (where, value))
+
+def _encode_source(source, where):
+    if type(source) is StaticFile:
+        kind, args = "static", dict(name=source.name)
+    elif type(source) is Template:
+        kind, args = "template", dict(name=source.name, variables=dict(
+            (k, v) for k, v in source.context.items() if k not in _TEMPLATE_BUILTINS))
+    elif type(source) is DownloadSource:
+        kind, args = "download", dict(url=source.url, cache=source.cache,
+            md5sum=source.md5sum, sha256sum=source.sha256sum)
+    else:
+        raise Fail("Unable to snapshot %s: unsupported source %r" % (where, source))
+    return {"__kokki__": "source", "type": kind, "value": _encode(args, where)}
+
+def _decode(value, env=None):
+    if isinstance(value, dict):
+        if value.get("__kokki__") == "source":
+            args = _decode(value["value"], env)
+            return _SOURCE_TYPES[value["type"]](env=env, **args)
+        if value.get("__kokki__") == "datetime":
+            return datetime(*value["value"])
+        if value.get("__kokki__") == "guard":
+            mod_path, class_name = value["type"].rsplit('.', 1)
+            guard = object.__new__(getattr(__import__(mod_path, {}, {}, [class_name]), class_name))
+            guard.__dict__.update(_decode(value["value"], env))
+            return guard
+        return dict((k, _decode(v, env)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return type(value)(_decode(v, env) for v in value)
+    return value
+
+def _resource_key(resource):
+    return (resource.__class__.__name__, resource.name)
+
+def dump_snapshot(kitchen, cookbook_paths=None):
+    """Return a compact, versioned binary snapshot of a kitchen.
+
+    All included recipes are sourced first so the snapshot contains the
+    complete resource list and can run without any recipe code. Providers
+    are left unresolved, nodes resolve them for their own platform when
+    compiling the loaded kitchen, and sources are built again there so
+    templates render with the node's facts. cookbook_paths replaces the kitchen's
+    own paths, for when cookbooks are shipped elsewhere with the snapshot.
+    """
+    kitchen.source_recipes()
+
+    resources = []
+    for res in kitchen.resource_list:
+        provider = res.provider
+        if provider is not None and not isinstance(provider, basestring):
+            provider = _class_path(kitchen, provider)
+        arguments = dict(
+            (key, _encode(value, "%s argument %s" % (res, key)))
+            for key, value in res.arguments.items()
+            if key not in _SUBSCRIPTION_ARGUMENTS)
+        subscriptions = sorted(
+            (timing, action, _resource_key(target))
+            for timing in ("immediate", "delayed")
+            for action, target in res.subscriptions[timing])
+        resources.append(dict(
+            type = _class_path(kitchen, res.__class__),
+            name = res.name,
+            provider = provider,
+            arguments = arguments,
+            subscriptions = subscriptions,
+            recipe = res.recipe,
+        ))
+
+    state = dict(
+        version = SNAPSHOT_VERSION,
+        config = _encode(kitchen.config, "config"),
+        cookbook_paths = cookbook_paths if cookbook_paths is not None else [x[0] for x in kitchen.cookbook_paths],
+        recipes = list(kitchen.included_recipes_order),
+        resources = resources,
+    )
+    return SNAPSHOT_MAGIC + marshal.dumps(state, 2)
+
+def _merge_config(config, values, prefix=""):
+    """Apply the snapshot config over the node's defaults and kokki.conf"""
+    for key, value in values.items():
+        name = prefix + key
+        if name in _RUN_SCOPED_CONFIG:
+            continue
+        if isinstance(value, dict) and isinstance(config.get(key), (dict, AttributeDictionary)):
+            _merge_config(config[key], value, name + ".")
+        else:
+            config[key] = value
+
+def load_snapshot(data, verbose_logging=False):
+    """Build a ready to run Kitchen from the output of dump_snapshot."""
+    from kokki.kitchen import Kitchen
+
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise Fail("Not a kokki snapshot")
+    try:
+        state = marshal.loads(data[len(SNAPSHOT_MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        raise Fail("Corrupt kokki snapshot")
+    if not isinstance(state, dict) or state.get("version") != SNAPSHOT_VERSION:
+        raise Fail("Unsupported snapshot version %r (expected %d)" % (
+            isinstance(state, dict) and state.get("version"), SNAPSHOT_VERSION))
+    missing = [k for k in SNAPSHOT_SCHEMA if k not in state]
+    if missing:
+        raise Fail("Snapshot is missing %s" % ", ".join(missing))
+
+    kit = Kitchen(verbose_logging)
+    _merge_config(kit.config, _decode(state["config"]))
+    kit.add_cookbook_path(*state["cookbook_paths"])
+    for name in state["recipes"]:
+        kit.include_recipe(name)
+        cb, recipe = kit.included_recipes[name]
+        # Resources are already in the snapshot, never source them again
+        kit.sourced_recipes.add("%s.%s" % (cb.name, recipe))
+
+    with kit:
+        for res in state["resources"]:
+            cls = _load_class(kit, res["type"])
+            obj = cls(res["name"], env=kit, provider=res["provider"], **_decode(res["arguments"], kit))
+            obj.recipe = res.get("recipe")
+        for res in state["resources"]:
+            obj = kit.resources[res["type"].rsplit('.', 1)[-1]][res["name"]]
+            for timing, action, (r_type, r_name) in res["subscriptions"]:
+                obj.subscribe(action, kit.resources[r_type][r_name], timing == "immediate")
+
+    log.debug("Loaded snapshot with %d resources" % len(kit.resource_list))
+    return kit
@@ -3,12 +3,11 @@ import logging
 
 __all__ = ["Source", "Template", "StaticFile", "DownloadSource"]
 
-import hashlib
 import os
-import urllib2
-import urlparse
 from kokki import environment
+from kokki.download import DownloadManager
 from kokki.exceptions import Fail
+from kokki.filecache import FileCache
 
 def load_class(class_name, *args, **kwargs):
     parts = class_name.split('.')
@@ -33,15 +32,20 @@ class StaticFile(Source):
         self.name = name
         self.env = env or environment.Environment.get_instance()
 
-    def get_content(self):
+    @property
+    def path(self):
         try:
             cookbook, name = self.name.split('/', 1)
         except ValueError:
             raise Fail("[StaticFile(%s)] Path must include cookbook name (e.g. 'nginx/nginx.conf')" % self.name)
         cb = self.env.cookbooks[cookbook]
-        path = os.path.join(cb.path, "files", name)
-        with open(path, "rb") as fp:
-            return fp.read()
+        return os.path.join(cb.path, "files", name)
+
+    def get_content(self):
+        return FileCache.get_instance().read(self.path)[1]
+
+    def get_checksum(self):
+        return FileCache.get_instance().digest(self.path)
 
 try:
     from jinja2 import Environment, BaseLoader, TemplateNotFound
@@ -64,8 +68,7 @@ else:
             if not os.path.exists(path):
                 raise TemplateNotFound("%s at %s" % (template, path))
             mtime = os.path.getmtime(path)
-            with open(path, "rb") as fp:
-                source = fp.read().decode('utf-8')
+            source = FileCache.get_instance().read(path)[1].decode('utf-8')
             return source, path, lambda:mtime == os.path.getmtime(path)
 
     class Template(Source):
@@ -73,7 +76,12 @@ else:
             self.name = name
             self.env = env or environment.Environment.get_instance()
             self.context = variables.copy() if variables else {}
-            self.template_env = Environment(loader=TemplateLoader(self.env), autoescape=False)
+            # Share one jinja environment per kokki environment so every
+            # template is only loaded and compiled once
+            try:
+                self.template_env = self.env._jinja2_env
+            except AttributeError:
+                self.template_env = self.env._jinja2_env = Environment(loader=TemplateLoader(self.env), autoescape=False)
             self.template = self.template_env.get_template(self.name)
 
         def get_content(self):
@@ -87,34 +95,24 @@ else:
             return rendered + "\n" if not rendered.endswith('\n') else rendered
 
 class DownloadSource(Source):
-    def __init__(self, url, cache=True, md5sum=None, env=None):
+    def __init__(self, url, cache=True, md5sum=None, sha256sum=None, env=None):
         self.env = env or environment.Environment.get_instance()
         self.url = url
         self.md5sum = md5sum
+        self.sha256sum = sha256sum
         self.cache = cache
-        if not 'download_path' in env.config:
-            env.config.download_path = '/var/tmp/downloads'
-        if not os.path.exists(env.config.download_path):
-            os.makedirs(self.env.config.download_path)
+
+    @property
+    def manager(self):
+        config = self.env.config
+        path = config.get('download_path') or config.kokki.download.path
+        return DownloadManager.get_instance(path, config.kokki.download.max_size)
+
+    def prefetch_key(self):
+        return (self.url, self.sha256sum, self.md5sum)
 
     def get_content(self):
-        filepath = os.path.basename(urlparse.urlparse(self.url).path)
-        content = None
-        if not self.cache or not os.path.exists(os.path.join(self.env.config.download_path, filepath)):
-            web_file = urllib2.urlopen(self.url)
-            content = web_file.read()
-        else:
-            update = False
-            with open(os.path.join(self.env.config.download_path, filepath)) as fp:
-                content = fp.read()
-            if self.md5sum:
-                m = hashlib.md5(content)
-                md5 = m.hexdigest()
-                if md5 != self.md5sum:
-                    web_file = urllib2.urlopen(self.url)
-                    content = web_file.read()
-                    update = True
-            if self.cache and update:
-                with open(os.path.join(self.env.config.download_path, filepath), 'w') as fp:
-                    fp.write(content)
-        return content
+        return self.manager.fetch_content(self.url, self.sha256sum, self.md5sum, self.cache)
+
+    def get_checksum(self):
+        return self.sha256sum
@@ -124,3 +124,9 @@ class System(object):
         except AttributeError:
             cls._instance = cls()
         return cls._instance
+
+    @classmethod
+    def reset(cls):
+        """Forget the facts gathered so far, they are looked up again when needed"""
+        if '_instance' in cls.__dict__:
+            del cls._instance
@@ -1,3 +1,9 @@
+import os
+import stat
+import sys
+import tempfile
+import threading
+from Queue import Queue, Empty
 
 class AttributeDictionary(object):
     def __init__(self, *args, **kwargs):
@@ -66,3 +72,72 @@ class AttributeDictionary(object):
 
     def __setstate__(self, state):
         super(AttributeDictionary, self).__setattr__("_dict", state)
+
+def atomic_write(path, content):
+    """Replace path with content through a rename so readers never see a
+    partial file. Ownership and mode of an existing file are preserved.
+
+    Symlinks, files with other hardlinks and anything that isn't a regular
+    file are written in place instead, so the link (or the other names of
+    the inode) keep pointing at the new content.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        st = None
+    if st is not None and (not stat.S_ISREG(st.st_mode) or st.st_nlink != 1):
+        with open(path, "wb") as fp:
+            fp.write(content)
+        return
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".%s." % basename, dir=dirname)
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+        if st is None:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0666 & ~umask)
+        else:
+            os.chmod(tmp, st.st_mode & 07777)
+            if os.getuid() == 0:
+                os.chown(tmp, st.st_uid, st.st_gid)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def parallel_map(func, items, workers=1):
+    """Apply func to every item using up to workers threads, results keep
+    the order of items. The first exception raised by func is re-raised."""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while not errors:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
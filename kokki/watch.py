@@ -0,0 +1,160 @@
+__all__ = ["DriftWatcher"]
+
+import logging
+import os
+import select
+import time
+from datetime import datetime
+
+from kokki import inotify
+from kokki.inotify import Inotify
+from kokki.mounts import MountTable
+from kokki.plan import PATH_ARGUMENTS, resource_key
+
+WATCH_MASK = (inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE
+    | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF
+    | inotify.IN_ONLYDIR)
+
+class DriftWatcher(object):
+    """Re-converge the resources whose paths are changed behind kokki's back.
+
+    The parent directory of every path managed by the plan (File,
+    Directory, Link, Mount, ...) is watched with inotify, so edits,
+    removals, renames and ownership or mode changes are all seen. Events
+    are debounced: once one arrives, more are collected until none came
+    for debounce seconds (max_delay at most). Then only the affected
+    resources run again, with the resources they notify. Mount resources
+    also follow fstab and the mount table. Events caused by the watcher's
+    own writes are discarded. While idle, the watcher just waits in select.
+    """
+
+    mountinfo_path = MountTable.mountinfo_path
+
+    def __init__(self, env, debounce=1.0, max_delay=30.0):
+        self.env = env
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.log = logging.getLogger("kokki.watch")
+        plan = env.plan if env.plan is not None else env.compile()
+
+        self.paths = {}
+        self.mount_keys = set()
+        for step in plan:
+            for name in PATH_ARGUMENTS:
+                path = step.arguments.get(name)
+                if path:
+                    self.paths.setdefault(os.path.normpath(os.path.abspath(path)), set()).add(step.key)
+            if step.resource.__class__.__name__ == "Mount":
+                self.mount_keys.add(step.key)
+                self.paths.setdefault(os.path.abspath(env.mount_table.fstab_path), set()).add(step.key)
+
+        self.inotify = Inotify()
+        self.watches = {}
+        self.directories = {}
+        self.pending = set()
+        self.mountinfo = None
+        if self.mount_keys and os.path.exists(self.mountinfo_path):
+            # The mount table signals changes as an exceptional condition
+            self.mountinfo = open(self.mountinfo_path, "rb")
+            self.mountinfo.read()
+        self.update_watches()
+
+    def update_watches(self):
+        """Watch the nearest existing directory above every path"""
+        wanted = set()
+        for path in self.paths:
+            directory = os.path.dirname(path)
+            while directory != "/" and not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            wanted.add(directory)
+
+        for directory in sorted(set(self.directories) - wanted):
+            wd = self.directories.pop(directory)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+        for directory in sorted(wanted - set(self.directories)):
+            try:
+                wd = self.inotify.add_watch(directory, WATCH_MASK)
+            except OSError, exc:
+                self.log.warning("Not watching %s: %s" % (directory, exc))
+                continue
+            self.watches[wd] = directory
+            self.directories[directory] = wd
+        self.log.debug("Watching %d directories for %d paths" % (len(self.directories), len(self.paths)))
+
+    def affected(self, events):
+        """Keys of the resources whose paths events touched"""
+        keys = set()
+        for wd, mask, _cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self.log.warning("inotify queue overflowed, checking every resource")
+                for path_keys in self.paths.values():
+                    keys |= path_keys
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & inotify.IN_IGNORED:
+                # The directory itself went away
+                self.directories.pop(directory, None)
+                self.watches.pop(wd, None)
+            changed = os.path.join(directory, name) if name else directory
+            prefix = changed.rstrip("/") + "/"
+            for path, path_keys in self.paths.items():
+                # A created or removed directory above a path affects it too
+                if path == changed or path.startswith(prefix):
+                    keys |= path_keys
+        return keys
+
+    def _wait(self, timeout):
+        """Wait for events, returns (inotify events, whether mounts changed)"""
+        xlist = [self.mountinfo] if self.mountinfo is not None else []
+        readable, _, exceptional = select.select([self.inotify], [], xlist, timeout)
+        mounts_changed = bool(exceptional)
+        if mounts_changed:
+            self.mountinfo.seek(0)
+            self.mountinfo.read()
+        return (self.inotify.read_events() if readable else []), mounts_changed
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for drift, returns the keys of the affected resources"""
+        keys, self.pending = self.pending, set()
+        if not keys:
+            events, mounts_changed = self._wait(timeout)
+            keys = self.affected(events) | (self.mount_keys if mounts_changed else set())
+            if not keys:
+                return keys
+        start = time.time()
+        while time.time() - start < self.max_delay:
+            events, mounts_changed = self._wait(self.debounce)
+            if not events and not mounts_changed:
+                break
+            keys |= self.affected(events) | (self.mount_keys if mounts_changed else set())
+        return keys
+
+    def converge(self, keys):
+        """Run the resources of keys again, returns the ones that were updated"""
+        self.log.info("Drift detected on %s" % ", ".join("%s['%s']" % key for key in sorted(keys)))
+        # Keep the backups of every correction apart
+        self.env.update_config({'kokki.backup.prefix': datetime.now().strftime("%Y%m%d%H%M%S")})
+        self.env.rerun(keys)
+        updated = [r for r in self.env.resource_list if r.is_updated]
+
+        # Our own writes come back as events, only keep the ones for other resources
+        events, mounts_changed = self._wait(0)
+        touched = set(keys) | set(resource_key(r) for r in updated)
+        self.pending |= (self.affected(events) | (self.mount_keys if mounts_changed else set())) - touched
+        self.update_watches()
+        return updated
+
+    def run(self, stop=None):
+        """Correct drift until stop (a threading.Event) is set"""
+        while stop is None or not stop.is_set():
+            keys = self.poll(1.0 if stop is not None else None)
+            if keys:
+                self.converge(keys)
+
+    def close(self):
+        self.inotify.close()
+        if self.mountinfo is not None:
+            self.mountinfo.close()
@@ -1,10 +1,36 @@
 #!/usr/bin/env python
 
+import BaseHTTPServer
+import base64
+import fnmatch
+import hashlib
 import os
 import shutil
+import socket
+import struct
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
 from kokki import *
+from kokki.agent import Agent, AgentServer, request
+from kokki.backup import BackupStore
+from kokki.buildcache import BuildCache
+from kokki.distributions import DistributionIndex, scan_distributions
+from kokki.download import DownloadManager
+from kokki.fileedit import FileEditor
+from kokki.mounts import parse_mountinfo
+from kokki.plan import Selector
+from kokki.providers.package import PackageProvider
+from kokki.providers.package.easy_install import EasyInstallProvider
+from kokki.readiness import parse_check, TCPCheck
+from kokki.providers.package.apt import AptRepositoryProvider, key_fingerprints, update_package_indexes
+from kokki.filecache import FileCache
+from kokki.fleet import FleetRunner, LocalTransport
+from kokki.utils import AttributeDictionary, atomic_write
+from kokki.watch import DriftWatcher
 
 class TestKitchen(unittest.TestCase):
     def setUp(self):
@@ -31,6 +57,126 @@ class TestKitchen(unittest.TestCase):
         self.failUnlessEqual("manchu", self.kit.config.test.config2)
         self.failUnlessEqual("manchu", self.kit._test)
 
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.kit = Kitchen()
+        self.kit.add_cookbook_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookbooks"))
+
+    def testRoundTrip(self):
+        self.kit.include_recipe("test")
+        with self.kit:
+            restart = Execute("restart", action="nothing")
+            File("/tmp/kokki-snapshot-test", content="hello", mode=0644,
+                notifies=[("run", restart, True)])
+        self.kit.config.kokki.backup.prefix = "controller-run"
+        self.kit.config.kokki.backup.keep = 3
+        data = dump_snapshot(self.kit)
+
+        kit = load_snapshot(data)
+        # Run scoped values are the node's own, the rest is applied over its defaults
+        self.failIfEqual("controller-run", kit.config.kokki.backup.prefix)
+        self.failUnlessEqual(3, kit.config.kokki.backup.keep)
+        self.failUnlessEqual("/tmp/kokki/backup", kit.config.kokki.backup.path)
+        self.failUnlessEqual(["Execute['restart']", "File['/tmp/kokki-snapshot-test']"],
+            [repr(r) for r in kit.resource_list])
+        res = kit.resources["File"]["/tmp/kokki-snapshot-test"]
+        self.failUnlessEqual("hello", res.content)
+        self.failUnlessEqual(0644, res.mode)
+        self.failUnlessEqual(set([("run", kit.resources["Execute"]["restart"])]), res.subscriptions['immediate'])
+        self.failUnlessEqual("fu", kit.config.test.config1)
+        self.failUnlessEqual(["test.default"], sorted(kit.sourced_recipes))
+
+    def testSourcesAreBuiltOnTheNode(self):
+        self.kit.include_recipe("test")
+        with self.kit:
+            File("/tmp/kokki-snapshot-system", content=Template("test/system.j2"))
+        data = dump_snapshot(self.kit)
+
+        kit = load_snapshot(data)
+        kit.system = AttributeDictionary(os="node-os")
+        content = kit.resources["File"]["/tmp/kokki-snapshot-system"].content
+        self.failUnless(isinstance(content, Template))
+        self.failUnlessEqual("node-os\n", content.get_content())
+
+    def testUnsupportedVersion(self):
+        data = dump_snapshot(self.kit)
+        self.failUnlessRaises(Fail, load_snapshot, data[:8] + data[8:].replace("version", "vers1on"))
+        self.failUnlessRaises(Fail, load_snapshot, "garbage")
+
+class RecordingProvider(Provider):
+    def action_create(self):
+        self.resource.env.performed.append(("create", self.resource.name))
+        self.resource.updated()
+
+    def action_reload(self):
+        self.resource.env.performed.append(("reload", self.resource.name))
+
+class TestPlan(unittest.TestCase):
+    def testCompile(self):
+        with Environment() as env:
+            reload = File("reload", action="nothing", provider=RecordingProvider)
+            File("/tmp/a", provider=RecordingProvider, notifies=[("reload", reload)])
+            Link("/tmp/a", to="/tmp/b", provider=RecordingProvider)
+            plan = env.compile()
+
+        self.failUnlessEqual(3, len(plan))
+        step = plan.get_step(("File", "/tmp/a"))
+        self.failUnlessEqual(RecordingProvider, step.provider)
+        self.failUnlessEqual(("create",), step.actions)
+        self.failUnlessEqual("/tmp/a", step.arguments["path"])
+        self.failUnlessEqual((("reload", ("File", "reload")),), step.delayed)
+        self.failUnlessEqual([("/tmp/a", (("File", "/tmp/a"), ("Link", "/tmp/a")))], list(plan.duplicates))
+        self.failUnless("notifies reload File['reload'] (delayed)" in plan.describe())
+
+        # Notifications are sent as compiled
+        env.resources["File"]["/tmp/a"].subscriptions["delayed"].clear()
+        env.performed = []
+        env.run()
+        self.failUnlessEqual([("create", "/tmp/a"), ("create", "/tmp/a"), ("reload", "reload")], env.performed)
+
+    def testOnlySelectedResourcesAndWhatTheyNeed(self):
+        with Environment() as env:
+            reload = File("reload", action="nothing", provider=RecordingProvider)
+            restart = File("restart", action="create", provider=RecordingProvider)
+            Directory("/srv/www", provider=RecordingProvider)
+            env.current_recipe = "nginx.site"
+            File("/srv/www/site", provider=RecordingProvider, tags=["hotfix"], notifies=[("reload", reload)])
+            env.current_recipe = "nginx.default"
+            File("/srv/www/other", provider=RecordingProvider, notifies=[("create", restart)])
+            env.current_recipe = None
+
+            env.only = ["tag:hotfix"]
+            plan = env.compile()
+            self.failUnlessEqual([("File", "reload", ()), ("Directory", "/srv/www", ("create",)), ("File", "/srv/www/site", ("create",))],
+                [step.key + (step.actions,) for step in plan])
+            self.failUnless("File['reload'] (when notified)" in plan.describe())
+
+            for only, count in ((["File[/srv/www/*]"], 5), (["recipe:nginx"], 5), (["recipe:nginx.default"], 3), (["Directory"], 1)):
+                env.only = only
+                self.failUnlessEqual(count, len(env.compile()), only)
+            env.only = ["tag:missing"]
+            self.failUnlessRaises(Fail, env.compile)
+            self.failUnlessRaises(Fail, Selector, "File[")
+
+            env.only = ["File['/srv/www/site']"]
+            env.compile()
+            env.performed = []
+            env.run()
+        self.failUnlessEqual([("create", "/srv/www"), ("create", "/srv/www/site"), ("reload", "reload")], env.performed)
+
+    def testUnknownNotificationAction(self):
+        with Environment() as env:
+            target = File("target", action="nothing", provider=RecordingProvider)
+            File("source", provider=RecordingProvider, notifies=[("restart", target)])
+            self.failUnlessRaises(Fail, env.compile)
+
+    def testNewResourceInvalidatesPlan(self):
+        with Environment() as env:
+            File("one", provider=RecordingProvider)
+            env.compile()
+            File("two", provider=RecordingProvider)
+            self.failUnlessEqual(None, env.plan)
+
 class ResourceTestBase(unittest.TestCase):
     def setUp(self):
         self.temp_path = tempfile.mkdtemp(suffix="kokki-tests")
@@ -56,5 +202,1212 @@ class TestExecute(ResourceTestBase):
         self.failUnless(os.path.exists(temp_file+"-lambda-true"))
         self.failUnless(os.path.exists(temp_file+"-cmd-true"))
 
+class TestGuards(ResourceTestBase):
+    def testBuiltinGuards(self):
+        path = os.path.join(self.temp_path, "conf")
+        with open(path, "w") as fp:
+            fp.write("listen 80\nuser www\n")
+        with Environment() as env:
+            self.failUnless(env._check_condition(PathExists(path)))
+            self.failIf(env._check_condition(PathExists(path + ".missing")))
+            self.failUnless(env._check_condition(FileContains(path, "user www")))
+            self.failUnless(env._check_condition(FileContains(path, r"^listen \d+$", regex=True)))
+            self.failIf(env._check_condition(FileContains(path + ".missing", "user")))
+            self.failUnless(env._check_condition(CommandSucceeds("true")))
+
+    def testShellGuardsAreCached(self):
+        counter = os.path.join(self.temp_path, "counter")
+        guard = "echo x >> %s; false" % counter
+        with Environment() as env:
+            Execute("first", command="true", provider=RecordingProvider, only_if=guard, action="create")
+            Execute("second", command="true", provider=RecordingProvider, only_if=guard, action="create")
+            env.performed = []
+            env.run()
+        with open(counter) as fp:
+            self.failUnlessEqual(1, len(fp.readlines()))
+        # Another run checks again
+        env.run()
+        with open(counter) as fp:
+            self.failUnlessEqual(2, len(fp.readlines()))
+
+    def testPortListeningOnlyUsesLocalSocketsForThisHost(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        try:
+            port = listener.getsockname()[1]
+            with Environment() as env:
+                self.failUnless(env._check_condition(PortListening(port)))
+                self.failIf(env._check_condition(PortListening(port, "remote.invalid")))
+        finally:
+            listener.close()
+
+    def testInstalledPackagesAreReadAgainAfterInstalls(self):
+        status = os.path.join(self.temp_path, "status")
+        with open(status, "w") as fp:
+            fp.write("Package: foo\nStatus: install ok installed\n")
+        StatusFileProvider.status_path = status
+        installed = PackageInstalled("bar")
+        installed.DPKG_STATUS = status
+        with Environment() as env:
+            bar = Package("bar", provider=StatusFileProvider)
+            self.failIf(env._check_condition(installed))
+            env.run_action(bar, "install")
+            self.failUnless(env._check_condition(installed))
+            self.failUnlessEqual({}, env.guard_cache)
+
+    def testCacheClearedOnUpdate(self):
+        with Environment() as env:
+            env.guard_cache["true"] = False
+            File("changed", provider=RecordingProvider)
+            env.performed = []
+            env.run()
+        self.failUnlessEqual({}, env.guard_cache)
+
+class StatusFileProvider(PackageProvider):
+    """Installs packages by adding them to a dpkg status file"""
+
+    status_path = None
+
+    def get_current_status(self):
+        self.current_version = None
+        self.candidate_version = "1.0"
+
+    def install_package(self, name, version):
+        mtime = os.path.getmtime(self.status_path)
+        with open(self.status_path, "a") as fp:
+            fp.write("\nPackage: %s\nStatus: install ok installed\n" % name)
+        # Within the same second as the previous write
+        os.utime(self.status_path, (mtime, mtime))
+        return True
+
+class TouchProvider(Provider):
+    def action_create(self):
+        with open(self.resource.path, "w") as fp:
+            fp.write(self.resource.content or "")
+        self.resource.updated()
+
+class TestFleet(ResourceTestBase):
+    def testLocalTransport(self):
+        kit = Kitchen()
+        kit.add_cookbook_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookbooks"))
+        kit.include_recipe("test")
+        with kit:
+            File("converged", content="yes", provider=TouchProvider)
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        command = "PYTHONPATH=%s %s -m kokki.command -q" % (os.pathsep.join([root] + sys.path), sys.executable)
+        runner = FleetRunner(kit, ["node1", "node2", "node3"], LocalTransport(self.temp_path),
+            concurrency=2, batch_size=2, kokki_command=command)
+        results = runner.run()
+
+        self.failUnlessEqual(["node1", "node2", "node3"], [r.node for r in results])
+        self.failUnless(all(r.success for r in results), [r.output for r in results])
+        for node in ("node1", "node2", "node3"):
+            with open(os.path.join(self.temp_path, node, "converged")) as fp:
+                self.failUnlessEqual("yes", fp.read())
+            self.failUnless(os.path.exists(os.path.join(self.temp_path, node, "kokki-fleet", "cookbooks", "test", "metadata.py")))
+
+    def testStopsAfterFailedBatch(self):
+        kit = Kitchen()
+        runner = FleetRunner(kit, ["a", "b", "c"], LocalTransport(self.temp_path),
+            batch_size=1, kokki_command="false")
+        results = runner.run()
+        self.failUnlessEqual(["a"], [r.node for r in results])
+        self.failIf(results[0].success)
+
+class TestFileCache(ResourceTestBase):
+    def setUp(self):
+        super(TestFileCache, self).setUp()
+        self.kit = Kitchen()
+        self.kit.add_cookbook_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookbooks"))
+        self.kit.load_cookbook("test")
+
+    def testStaticFileChecksum(self):
+        with self.kit:
+            source = StaticFile("test/static.txt")
+        content = source.get_content()
+        self.failUnlessEqual(hashlib.sha256(content).hexdigest(), source.get_checksum())
+        self.failUnless(content is StaticFile("test/static.txt", env=self.kit).get_content())
+
+    def testCacheFollowsChanges(self):
+        cache = FileCache()
+        path = os.path.join(self.temp_path, "blob")
+        with open(path, "w") as fp:
+            fp.write("one")
+        self.failUnlessEqual("one", cache.read(path)[1])
+        with open(path, "w") as fp:
+            fp.write("three")
+        self.failUnlessEqual((hashlib.sha256("three").hexdigest(), "three"), cache.read(path))
+
+    def testLeastRecentlyUsedBlobsAreEvicted(self):
+        cache = FileCache(max_size=10, max_digests=2)
+        paths = []
+        for name in "abc":
+            paths.append(os.path.join(self.temp_path, name))
+            with open(paths[-1], "w") as fp:
+                fp.write(name * 4)
+        cache.read(paths[0])
+        cache.read(paths[1])
+        cache.read(paths[0])
+        cache.read(paths[2])
+        self.failUnlessEqual(sorted(hashlib.sha256(c * 4).hexdigest() for c in "ac"), sorted(cache._blobs))
+        self.failUnlessEqual(2, len(cache._digests))
+        self.failUnlessEqual("bbbb", cache.read(paths[1])[1])
+
+    def testFileFromStaticFile(self):
+        path = os.path.join(self.temp_path, "static")
+        with self.kit:
+            File(path, content=StaticFile("test/static.txt"))
+            self.kit.run()
+            with open(path) as fp:
+                self.failUnlessEqual(StaticFile("test/static.txt").get_content(), fp.read())
+
+class FileServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Range")))
+        try:
+            body = self.files[self.path]
+        except KeyError:
+            self.send_error(404)
+            return
+        code = 200
+        if self.headers.get("Range"):
+            body = body[int(self.headers["Range"][6:-1]):]
+            code = 206
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestDownloadManager(ResourceTestBase):
+    def setUp(self):
+        super(TestDownloadManager, self).setUp()
+        FileServerHandler.files = {
+            "/a/pkg.tar.gz": "a" * 1000,
+            "/b/pkg.tar.gz": "b" * 1000,
+        }
+        FileServerHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileServerHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self.manager = DownloadManager(os.path.join(self.temp_path, "cache"))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestDownloadManager, self).tearDown()
+
+    def testFetchIsCachedPerUrl(self):
+        sha = hashlib.sha256("a" * 1000).hexdigest()
+        self.failUnlessEqual("a" * 1000, self.manager.fetch_content(self.url + "/a/pkg.tar.gz", sha))
+        self.failUnlessEqual("a" * 1000, self.manager.fetch_content(self.url + "/a/pkg.tar.gz", sha))
+        self.failUnlessEqual("b" * 1000, self.manager.fetch_content(self.url + "/b/pkg.tar.gz"))
+        self.failUnlessEqual([("/a/pkg.tar.gz", None), ("/b/pkg.tar.gz", None)], FileServerHandler.requests)
+
+    def testResume(self):
+        url = self.url + "/a/pkg.tar.gz"
+        with open(self.manager.cache_path(url) + ".part", "w") as fp:
+            fp.write("a" * 400)
+        self.failUnlessEqual("a" * 1000, self.manager.fetch_content(url))
+        self.failUnlessEqual([("/a/pkg.tar.gz", "bytes=400-")], FileServerHandler.requests)
+
+    def testChecksumMismatch(self):
+        self.failUnlessRaises(Fail, self.manager.fetch, self.url + "/a/pkg.tar.gz", "0" * 64)
+        self.failIf(os.path.exists(self.manager.cache_path(self.url + "/a/pkg.tar.gz")))
+
+    def testEviction(self):
+        self.manager.max_size = 1500
+        first = self.manager.fetch(self.url + "/a/pkg.tar.gz")
+        os.utime(first, (0, 0))
+        second = self.manager.fetch(self.url + "/b/pkg.tar.gz")
+        self.failIf(os.path.exists(first))
+        self.failUnless(os.path.exists(second))
+
+    def testEvictionSkipsEntriesInUse(self):
+        self.manager.max_size = 1500
+        first = self.manager.fetch(self.url + "/a/pkg.tar.gz")
+        os.utime(first, (0, 0))
+        # Gone between listing and stat
+        os.symlink(os.path.join(self.temp_path, "missing"), os.path.join(self.manager.path, "dangling"))
+        with self.manager._path_lock(first):
+            second = self.manager.fetch(self.url + "/b/pkg.tar.gz")
+        self.failUnless(os.path.exists(first))
+        self.failUnless(os.path.exists(second))
+        self.manager.evict(keep=second)
+        self.failIf(os.path.exists(first))
+
+    def testPrefetch(self):
+        failures = self.manager.prefetch([
+            (self.url + "/a/pkg.tar.gz", None, None),
+            (self.url + "/b/pkg.tar.gz", None, None),
+            (self.url + "/missing", None, None),
+        ])
+        self.failUnlessEqual([self.url + "/missing"], [url for url, _exc in failures])
+        self.failUnless(os.path.exists(self.manager.cache_path(self.url + "/b/pkg.tar.gz")))
+
+    def testRunPrefetchesOnlyNeededDownloads(self):
+        current = os.path.join(self.temp_path, "current")
+        with open(current, "w") as fp:
+            fp.write("a" * 1000)
+        with Environment() as env:
+            env.config.kokki.download.path = self.manager.path
+            sha = hashlib.sha256("a" * 1000).hexdigest()
+            File(current, content=DownloadSource(self.url + "/a/pkg.tar.gz", sha256sum=sha))
+            File(os.path.join(self.temp_path, "guarded"), content=DownloadSource(self.url + "/b/pkg.tar.gz"),
+                only_if=lambda:False)
+            env.run()
+        self.failUnlessEqual([], FileServerHandler.requests)
+
+    def testUnreachableUrlFails(self):
+        self.failUnlessRaises(Fail, self.manager.fetch, "http://127.0.0.1:1/missing")
+
+class TestBackupStore(ResourceTestBase):
+    def setUp(self):
+        super(TestBackupStore, self).setUp()
+        self.store = BackupStore(os.path.join(self.temp_path, "backup"))
+        self.path = os.path.join(self.temp_path, "managed")
+
+    def write(self, content):
+        with open(self.path, "w") as fp:
+            fp.write(content)
+
+    def testDeduplicatesAndRestores(self):
+        self.write("v1")
+        digest = self.store.backup("run1", self.path)
+        atomic_write(self.path, "v2")
+        self.store.backup("run2", self.path)
+        atomic_write(self.path, "v1")
+        self.failUnlessEqual(digest, self.store.backup("run3", self.path))
+        self.failUnlessEqual(2, sum(len(files) for _d, _s, files in os.walk(self.store.blob_path)))
+
+        atomic_write(self.path, "v3")
+        self.failUnlessEqual([self.path], self.store.restore("run2"))
+        with open(self.path) as fp:
+            self.failUnlessEqual("v2", fp.read())
+
+    def testPrune(self):
+        for i, content in enumerate(["a", "b", "c"]):
+            self.write(content)
+            self.store.backup("run%d" % i, self.path)
+        self.failUnlessEqual(["run0", "run1"], self.store.prune(keep=1))
+        self.failUnlessEqual(["run2"], self.store.runs())
+        self.failUnlessEqual(1, sum(len(files) for _d, _s, files in os.walk(self.store.blob_path)))
+
+    def testLinksAreWrittenInPlace(self):
+        self.write("old")
+        link = os.path.join(self.temp_path, "link")
+        other = os.path.join(self.temp_path, "other-name")
+        os.symlink(self.path, link)
+        os.link(self.path, other)
+        with Environment() as env:
+            env.config.kokki.backup.path = os.path.join(self.temp_path, "backup")
+            File(link, content="new")
+            env.run()
+        self.failUnless(os.path.islink(link))
+        self.failUnlessEqual("new", open(other).read())
+        # The backup doesn't follow later edits of the live file
+        with open(self.path, "w") as fp:
+            fp.write("edited")
+        self.store.restore(env.config.kokki.backup.prefix)
+        self.failUnlessEqual("old", open(self.path).read())
+
+    def testFileProviderBacksUp(self):
+        self.write("old")
+        with Environment() as env:
+            env.config.kokki.backup.path = os.path.join(self.temp_path, "backup")
+            File(self.path, content="new")
+            env.run()
+        self.failUnlessEqual([self.path], [e['path'] for e in self.store.manifest(env.config.kokki.backup.prefix)])
+        self.store.restore(env.config.kokki.backup.prefix)
+        with open(self.path) as fp:
+            self.failUnlessEqual("old", fp.read())
+
+class TestDirectorySync(ResourceTestBase):
+    def setUp(self):
+        super(TestDirectorySync, self).setUp()
+        self.source = os.path.join(self.temp_path, "source")
+        self.target = os.path.join(self.temp_path, "target")
+        os.makedirs(os.path.join(self.source, "sub"))
+        for name, content in (("a.conf", "a"), ("sub/b.conf", "bb")):
+            with open(os.path.join(self.source, name), "w") as fp:
+                fp.write(content)
+
+    def sync(self, **kwargs):
+        with Environment() as env:
+            res = DirectorySync(self.target, source=self.source, **kwargs)
+            env.run()
+        return res
+
+    def testSync(self):
+        os.makedirs(self.target)
+        with open(os.path.join(self.target, "extra"), "w") as fp:
+            fp.write("x")
+
+        res = self.sync(mode=0600, purge=True, workers=2)
+        self.failUnless(res.is_updated)
+        with open(os.path.join(self.target, "sub", "b.conf")) as fp:
+            self.failUnlessEqual("bb", fp.read())
+        self.failUnlessEqual(0600, os.stat(os.path.join(self.target, "a.conf")).st_mode & 07777)
+        self.failIf(os.path.exists(os.path.join(self.target, "extra")))
+
+        self.failIf(self.sync(mode=0600, purge=True).is_updated)
+
+    def testChangedContent(self):
+        self.sync()
+        with open(os.path.join(self.source, "a.conf"), "w") as fp:
+            fp.write("z")
+        os.utime(os.path.join(self.source, "a.conf"), (0, 0))
+        self.failUnless(self.sync().is_updated)
+        with open(os.path.join(self.target, "a.conf")) as fp:
+            self.failUnlessEqual("z", fp.read())
+
+    def testModeChangesOnlyTouchMetadata(self):
+        self.sync()
+        inode = os.stat(os.path.join(self.target, "sub", "b.conf")).st_ino
+        self.failUnless(self.sync(mode=0640, dir_mode=0750).is_updated)
+        self.failUnlessEqual(inode, os.stat(os.path.join(self.target, "sub", "b.conf")).st_ino)
+        self.failUnlessEqual(0640, os.stat(os.path.join(self.target, "sub", "b.conf")).st_mode & 07777)
+        self.failUnlessEqual(0750, os.stat(os.path.join(self.target, "sub")).st_mode & 07777)
+        self.failIf(self.sync(mode=0640, dir_mode=0750).is_updated)
+
+class TestDirectory(ResourceTestBase):
+    def testRecursiveMetadata(self):
+        root = os.path.join(self.temp_path, "data")
+        os.makedirs(os.path.join(root, "a", "b"))
+        for name in ("top", "a/one", "a/b/two"):
+            with open(os.path.join(root, name), "w") as fp:
+                fp.write(name)
+        os.chmod(os.path.join(root, "a", "one"), 0600)
+        os.symlink("/etc/passwd", os.path.join(root, "a", "link"))
+
+        with Environment() as env:
+            res = Directory(root, mode=0750, file_mode=0640, recursive_metadata=True, metadata_workers=2)
+            env.run()
+        self.failUnless(res.is_updated)
+        for name in ("a", "a/b"):
+            self.failUnlessEqual(0750, os.stat(os.path.join(root, name)).st_mode & 07777)
+        for name in ("top", "a/one", "a/b/two"):
+            self.failUnlessEqual(0640, os.stat(os.path.join(root, name)).st_mode & 07777)
+        self.failIfEqual(0640, os.stat("/etc/passwd").st_mode & 07777)
+
+        with Environment() as env:
+            res = Directory(root, mode=0750, file_mode=0640, recursive_metadata=True)
+            env.run()
+        self.failIf(res.is_updated)
+
+class TestFileCoalescing(ResourceTestBase):
+    def testWritesToOnePathAreCoalesced(self):
+        path = os.path.join(self.temp_path, "site.conf")
+        with open(path, "w") as fp:
+            fp.write("old\n")
+        with Environment() as env:
+            reload = Execute("reload", command="true", action="nothing", provider=RecordingProvider)
+            File(path, action="delete")
+            File("site", path=path, content="first\n", notifies=[("reload", reload)])
+            Directory(os.path.join(self.temp_path, "other"))
+            File("site-final", path=path, content="final\n")
+            File("site-mode", path=path, mode=0600)
+            plan = env.compile()
+            # A step with notifications ends its run
+            self.failUnlessEqual([
+                (path, (("File", path),), ("File", "site")),
+                (path, (("File", "site-final"),), ("File", "site-mode")),
+            ], list(plan.coalesced))
+            self.failUnlessEqual([(path, (("File", "site"), ("File", "site-mode")))], list(plan.duplicates))
+            self.failUnlessEqual((("reload", ("Execute", "reload")),), plan.get_step(("File", "site")).delayed)
+            self.failUnlessEqual((), plan.get_step(("File", "site-mode")).delayed)
+            # Merging only happens in the plan
+            final = env.resources["File"]["site-mode"]
+            self.failUnlessEqual(None, final.content)
+            self.failUnlessEqual(plan.steps, env.compile().steps)
+            env.performed = []
+            env.run()
+        with open(path) as fp:
+            self.failUnlessEqual("final\n", fp.read())
+        self.failUnlessEqual(0600, os.stat(path).st_mode & 07777)
+        self.failUnlessEqual([("reload", "reload")], env.performed)
+        self.failUnless(final.is_updated)
+
+    def testNotificationsOfDeletedFiles(self):
+        path = os.path.join(self.temp_path, "site.conf")
+        with Environment() as env:
+            reload = Execute("reload", command="true", action="nothing", provider=RecordingProvider)
+            File(path, content="first\n", notifies=[("reload", reload)])
+            File("gone", path=path, action="delete")
+            plan = env.compile()
+            self.failUnlessEqual([], list(plan.coalesced))
+            env.performed = []
+            env.run()
+        self.failIf(os.path.exists(path))
+        self.failUnlessEqual([("reload", "reload")], env.performed)
+
+    def testCommandsBreakCoalescing(self):
+        path = os.path.join(self.temp_path, "script")
+        with Environment() as env:
+            File(path, content="one")
+            Execute("cp %s %s.copy" % (path, path))
+            File("again", path=path, content="two")
+            plan = env.compile()
+            self.failUnlessEqual([], list(plan.coalesced))
+            env.run()
+        with open(path + ".copy") as fp:
+            self.failUnlessEqual("one", fp.read())
+
+class TestFileEdits(ResourceTestBase):
+    def testLinesAndBlocks(self):
+        path = os.path.join(self.temp_path, "fstab")
+        with open(path, "w") as fp:
+            fp.write("proc /proc proc defaults 0 0\n/dev/sdb /data ext3 defaults 0 2\nold\n")
+
+        with Environment() as env:
+            FileLine("/dev/sdc /logs xfs noatime 0 2", path=path)
+            FileLine("data", line="/dev/sdb /data xfs noatime 0 2", match=r"^\S+ /data ", path=path)
+            FileLine("old", path=path, action="absent")
+            FileBlock("tuning", path=path, content="a\nb\n")
+            env.run()
+            self.failUnlessEqual({}, env.file_editors)
+
+        with open(path) as fp:
+            self.failUnlessEqual(
+                "proc /proc proc defaults 0 0\n"
+                "/dev/sdb /data xfs noatime 0 2\n"
+                "/dev/sdc /logs xfs noatime 0 2\n"
+                "# BEGIN kokki block tuning\na\nb\n# END kokki block tuning\n", fp.read())
+
+        with Environment() as env:
+            line = FileLine("/dev/sdc /logs xfs noatime 0 2", path=path)
+            block = FileBlock("tuning", path=path, action="absent")
+            env.run()
+        self.failIf(line.is_updated)
+        self.failUnless(block.is_updated)
+        with open(path) as fp:
+            self.failIf("kokki block" in fp.read())
+
+    def testSingleWrite(self):
+        path = os.path.join(self.temp_path, "conf")
+        writes = []
+        with Environment() as env:
+            for i in range(5):
+                FileLine("line %d" % i, path=path)
+            original = FileEditor.flush
+            def flush(editor, env=None):
+                writes.append(editor.dirty)
+                return original(editor, env)
+            FileEditor.flush = flush
+            try:
+                env.run()
+            finally:
+                FileEditor.flush = original
+        self.failUnlessEqual([True], writes)
+
+    def testEditsAreWrittenWhenALaterResourceFails(self):
+        path = os.path.join(self.temp_path, "conf")
+        with Environment() as env:
+            FileLine("kept", path=path)
+            FileLine("broken", path=path, match="(")
+            self.failUnlessRaises(Exception, env.run)
+        with open(path) as fp:
+            self.failUnlessEqual("kept\n", fp.read())
+
+class TestMount(ResourceTestBase):
+    def testParseMountinfo(self):
+        mounts = parse_mountinfo(
+            "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro\n"
+            "40 22 8:17 / /mnt/my\\040data rw,noatime - xfs /dev/sdb1 rw,attr2\n")
+        self.failUnlessEqual(["/", "/mnt/my data"], [m['mount_point'] for m in mounts])
+        self.failUnlessEqual(dict(device="/dev/sdb1", mount_point="/mnt/my data", fstype="xfs",
+            options=["rw", "noatime", "attr2"]), mounts[1])
+
+    def testEnableAndDisable(self):
+        fstab = os.path.join(self.temp_path, "fstab")
+        with open(fstab, "w") as fp:
+            fp.write("# /etc/fstab\n/dev/sda1 / ext4 defaults 0 1\n/dev/sdb1 /mnt/old ext4 defaults 0 2\n")
+        with Environment() as env:
+            env.mount_table.fstab_path = fstab
+            Mount("/mnt/my data", device="/dev/sdc1", fstype="xfs", action="enable")
+            Mount("enabled", mount_point="/mnt/my data", action="enable")
+            Mount("/mnt/old", action="disable")
+            env.run()
+            self.failUnless(env.mount_table.is_enabled("/mnt/my data"))
+            self.failIf(env.mount_table.is_enabled("/mnt/old"))
+        with open(fstab) as fp:
+            self.failUnlessEqual("# /etc/fstab\n/dev/sda1 / ext4 defaults 0 1\n/dev/sdc1 /mnt/my\\040data xfs defaults 0 2\n", fp.read())
+
+    def testMountSeesTheEnabledEntry(self):
+        fstab = os.path.join(self.temp_path, "fstab")
+        mountinfo = os.path.join(self.temp_path, "mountinfo")
+        device = os.path.join(self.temp_path, "sdc1")
+        mount_point = os.path.join(self.temp_path, "data")
+        seen = os.path.join(self.temp_path, "seen")
+        for path in (fstab, mountinfo, device):
+            open(path, "w").close()
+        # A mount that records the fstab it was run with
+        bin_path = os.path.join(self.temp_path, "bin")
+        os.mkdir(bin_path)
+        with open(os.path.join(bin_path, "mount"), "w") as fp:
+            fp.write("#!/bin/sh\ncp %s %s\n" % (fstab, seen))
+        os.chmod(os.path.join(bin_path, "mount"), 0755)
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_path + os.pathsep + old_path
+        try:
+            with Environment() as env:
+                env.mount_table.fstab_path = fstab
+                env.mount_table.mountinfo_path = mountinfo
+                Mount(mount_point, device=device, fstype="xfs", action=["enable", "mount"])
+                env.run()
+        finally:
+            os.environ["PATH"] = old_path
+        with open(seen) as fp:
+            self.failUnlessEqual("%s %s xfs defaults 0 2\n" % (device, mount_point), fp.read())
+
+class FakeAttachment(object):
+    def __init__(self):
+        self.instance_id = None
+        self.device = None
+        self.status = None
+
+class FakeVolume(object):
+    def __init__(self, ec2, id, size):
+        self.ec2 = ec2
+        self.id = id
+        self.size = size
+        self.status = "creating"
+        self.tags = {}
+        self.attach_data = FakeAttachment()
+
+    def add_tag(self, key, value):
+        self.tags[key] = value
+
+    def attach(self, instance_id, device):
+        self.ec2.calls.append(("attach", self.id))
+        self.status = "attaching"
+        self.attach_data.instance_id = instance_id
+        self.attach_data.device = device
+        self.attach_data.status = "attaching"
+
+    def attachment_state(self):
+        return self.attach_data.status
+
+class FakeEC2(object):
+    """Just enough of boto's EC2Connection, volumes move one state further on every poll"""
+
+    def __init__(self):
+        self.volumes = []
+        self.calls = []
+
+    def create_volume(self, size, zone, snapshot=None):
+        vol = FakeVolume(self, "vol-%d" % (len(self.volumes) + 1), size)
+        self.volumes.append(vol)
+        self.calls.append(("create", vol.id))
+        return vol
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        if volume_ids is not None:
+            self.calls.append(("poll", tuple(volume_ids)))
+            for vol in self.volumes:
+                if vol.id not in volume_ids:
+                    continue
+                if vol.status == "creating":
+                    vol.status = "available"
+                elif vol.status == "attaching":
+                    vol.status = vol.attach_data.status = "in-use"
+                    vol.attach_data.status = "attached"
+                    open(vol.attach_data.device, "w").close()
+            return [vol for vol in self.volumes if vol.id in volume_ids]
+
+        self.calls.append(("list", tuple(sorted(filters.items()))))
+        volumes = self.volumes
+        if "attachment.instance-id" in filters:
+            volumes = [vol for vol in volumes if vol.attach_data.instance_id == filters["attachment.instance-id"]]
+        if "tag:Name" in filters:
+            volumes = [vol for vol in volumes if any(fnmatch.fnmatch(vol.tags.get("Name", ""), pattern) for pattern in filters["tag:Name"])]
+        return volumes
+
+class FakeAWS(object):
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+class TestEBSVolume(ResourceTestBase):
+    def testVolumesAreCreatedAndAttachedTogether(self):
+        ec2 = FakeEC2()
+        kit = Kitchen()
+        kit.add_cookbook_path("kokki.cookbooks")
+        kit.load_cookbook("aws")
+        kit.update_config({"aws.resources": FakeAWS(ec2), "aws.instance_id": "i-1", "aws.availability_zone": "zone-a"})
+        kit.cookbooks.aws.EBSVolumeProvider.poll_interval = 0
+        with kit:
+            volumes = [kit.cookbooks.aws.EBSVolume("data%d" % i, size=10,
+                device=os.path.join(self.temp_path, "sd%s" % c), action=["create", "attach"])
+                for i, c in ((1, "f"), (2, "g"))]
+        kit.run()
+
+        self.failUnlessEqual([
+            ("list", (("attachment.instance-id", "i-1"),)),
+            ("list", (("tag:Name", ["data1", "data2"]),)),
+            ("create", "vol-1"), ("create", "vol-2"),
+            ("poll", ("vol-1", "vol-2")),
+            ("attach", "vol-1"), ("attach", "vol-2"),
+            ("poll", ("vol-1", "vol-2")),
+        ], ec2.calls)
+        self.failUnless(all(vol.is_updated for vol in volumes))
+        self.failUnlessEqual(["data1", "data2"], [vol.tags["Name"] for vol in ec2.volumes])
+
+    def testIndexedNamesPickTheNextFreeVolume(self):
+        ec2 = FakeEC2()
+        taken = ec2.create_volume(10, "zone-a")
+        taken.add_tag("Name", "data1")
+        taken.status = "in-use"
+        taken.attach_data.instance_id = "i-2"
+        kit = Kitchen()
+        kit.add_cookbook_path("kokki.cookbooks")
+        kit.load_cookbook("aws")
+        kit.update_config({"aws.resources": FakeAWS(ec2), "aws.instance_id": "i-1", "aws.availability_zone": "zone-a"})
+        kit.cookbooks.aws.EBSVolumeProvider.poll_interval = 0
+        with kit:
+            volume = kit.cookbooks.aws.EBSVolume("data{index}", size=10,
+                device=os.path.join(self.temp_path, "sdf"), action=["create", "attach"])
+        kit.run()
+        self.failUnless(volume.is_updated)
+        # The resource keeps its name, the volume gets the next free one
+        self.failUnlessEqual("data{index}", volume.name)
+        self.failUnlessEqual(["data1", "data2"], [vol.tags["Name"] for vol in ec2.volumes])
+        self.failUnlessEqual(("i-1", "in-use"), (ec2.volumes[1].attach_data.instance_id, ec2.volumes[1].status))
+
+    def testEveryVolumeWaitsForItsOwnTimeout(self):
+        ec2 = FakeEC2()
+        slow, fast = ec2.create_volume(10, "zone-a"), ec2.create_volume(10, "zone-a")
+        kit = Kitchen()
+        kit.add_cookbook_path("kokki.cookbooks")
+        kit.load_cookbook("aws")
+        polls = []
+        def ready(vol):
+            polls.append(vol.id)
+            return vol is fast and vol.status == "available"
+        try:
+            kit.cookbooks.aws.wait_for_volumes(ec2, [slow, fast], ready, {slow.id: 0.01, fast.id: None}, interval=0)
+        except Fail, exc:
+            self.failUnless("vol-1" in str(exc) and "vol-2" not in str(exc), str(exc))
+        else:
+            self.fail("The slow volume should time out")
+        self.failUnlessEqual("available", fast.status)
+
+class TestSSHKnownHosts(ResourceTestBase):
+    def setUp(self):
+        super(TestSSHKnownHosts, self).setUp()
+        self.kit = Kitchen()
+        self.kit.add_cookbook_path("kokki.cookbooks")
+        self.kit.load_cookbook("ssh")
+        self.path = os.path.join(self.temp_path, "known_hosts")
+
+    def testHostsAreAddedAndRemovedInOneWrite(self):
+        existing = self.kit.cookbooks.ssh.SSHKnownHostsFile()
+        existing.add_host("old.example.com", "ssh-rsa", "AAAAold")
+        existing.add_host("plain.example.com", "ssh-rsa", "AAAAplain", hashed=False)
+        existing.add_host("other.example.com", "ssh-rsa", "AAAAplain", hashed=False)
+        with open(self.path, "w") as fp:
+            fp.write("# managed by kokki\n" + existing.content)
+
+        with self.kit:
+            for i in range(3):
+                self.kit.cookbooks.ssh.SSHKnownHost("host%d.example.com" % i, keytype="ssh-rsa", key="AAAA%d" % i, path=self.path)
+            self.kit.cookbooks.ssh.SSHKnownHost("old.example.com,plain.example.com", path=self.path, action="exclude")
+            plan = self.kit.compile()
+            self.failUnlessEqual([], list(plan.duplicates))
+        self.kit.run()
+
+        hosts = self.kit.cookbooks.ssh.SSHKnownHostsFile(self.path)
+        for i in range(3):
+            self.failUnless(hosts.includes("HOST%d.example.com" % i))
+        self.failIf(hosts.includes("old.example.com"))
+        self.failIf(hosts.includes("plain.example.com"))
+        self.failUnless(hosts.includes("other.example.com"))
+        # Every new entry gets its own salt
+        self.failUnlessEqual(3, len(set(salt for salt, _hash in hosts.hashed)))
+        # A host is only hashed again with salts it wasn't looked up with yet
+        hosts.hash = None
+        self.failUnless(hosts.includes("host0.example.com"))
+        with open(self.path) as fp:
+            lines = fp.read().splitlines()
+        self.failUnlessEqual(["# managed by kokki", "other.example.com ssh-rsa AAAAplain"], lines[:2])
+        self.failUnlessEqual(5, len(lines))
+
+    def testAuthorizedKeysKeepOrderAndOptions(self):
+        path = os.path.join(self.temp_path, "authorized_keys")
+        with open(path, "w") as fp:
+            fp.write('# keys\ncommand="echo hi there",no-pty ssh-rsa AAAAbackup backup@host\nssh-rsa AAAAold old@host\n'
+                'ssh-rsa AAAAbackup  repeated@host\nssh-rsa AAAAold old@other\n')
+
+        def converge():
+            kit = Kitchen()
+            kit.add_cookbook_path("kokki.cookbooks")
+            kit.load_cookbook("ssh")
+            with kit:
+                for name, key in (("new", "AAAAnew"), ("backup", "AAAAbackup"), ("zed", "AAAAzed")):
+                    kit.cookbooks.ssh.SSHAuthorizedKey(name, keytype="ssh-rsa", key=key, path=path)
+                kit.cookbooks.ssh.SSHAuthorizedKey("old", keytype="ssh-rsa", key="AAAAold", path=path, action="exclude")
+            kit.run()
+            return [r.is_updated for r in kit.resource_list]
+
+        self.failUnlessEqual([True, False, True, True], converge())
+        with open(path) as fp:
+            content = fp.read()
+        # Repeated keys are kept as they are, unless the key is removed
+        self.failUnlessEqual('# keys\ncommand="echo hi there",no-pty ssh-rsa AAAAbackup backup@host\n'
+            'ssh-rsa AAAAbackup  repeated@host\nssh-rsa AAAAnew new\nssh-rsa AAAAzed zed\n', content)
+        self.failUnlessEqual([False, False, False, False], converge())
+        with open(path) as fp:
+            self.failUnlessEqual(content, fp.read())
+
+class TestAptRepository(ResourceTestBase):
+    def testSourceListAndKey(self):
+        body = "\x04" + struct.pack(">I", 0) + "\x01" + "\x00\x08\xff" + "\x00\x02\x03"
+        packet = "\x99" + struct.pack(">H", len(body)) + body
+        fingerprint = hashlib.sha1(packet).hexdigest().upper()
+        armored = ("-----BEGIN PGP PUBLIC KEY BLOCK-----\nVersion: test\n\n%s\n=abcd\n"
+            "-----END PGP PUBLIC KEY BLOCK-----\n" % base64.b64encode(packet))
+        self.failUnlessEqual([fingerprint], key_fingerprints(armored))
+
+        path = os.path.join(self.temp_path, "test.list")
+        keyring = os.path.join(self.temp_path, "test.gpg")
+        with Environment() as env:
+            repo = AptRepository("test", path=path, keyring=keyring,
+                uri="http://example.com/debian", distribution="stable", components=["main"], deb_src=True,
+                key=armored, key_fingerprint=fingerprint)
+            AptRepositoryProvider(repo).action_add()
+            self.failUnless(repo.is_updated)
+            self.failUnlessEqual(set([path]), env.run_cache['apt.update'])
+            self.failUnlessEqual([update_package_indexes], env.finalizers)
+            with open(path) as fp:
+                self.failUnlessEqual("deb http://example.com/debian stable main\ndeb-src http://example.com/debian stable main\n", fp.read())
+            with open(keyring) as fp:
+                self.failUnlessEqual(packet, fp.read())
+
+            # Nothing changed, no index refresh
+            env.run_cache.clear()
+            repo.is_updated = False
+            AptRepositoryProvider(repo).action_add()
+            self.failIf(repo.is_updated)
+            self.failIf('apt.update' in env.run_cache)
+
+            self.failUnlessRaises(Fail, AptRepository, "short-id", uri="http://example.com/debian",
+                distribution="stable", key=armored, key_fingerprint=fingerprint[-8:])
+
+            # Without a key to install the fingerprint must already be trusted
+            trusted = AptRepository("trusted", path=path, keyring=keyring,
+                uri="http://example.com/debian", distribution="stable", key_fingerprint=fingerprint)
+            AptRepositoryProvider(trusted).action_add()
+            untrusted = AptRepository("untrusted", path=path, keyring=keyring + ".missing",
+                uri="http://example.com/debian", distribution="stable", key_fingerprint="0" * 40)
+            self.failUnlessRaises(Fail, AptRepositoryProvider(untrusted).action_add)
+
+class FakeRepositoryProvider(PackageProvider):
+    """Packages are files in repository, downloaded to archive and installed to root"""
+
+    repository = archive = root = None
+    overlapped = threading.Event()
+    other_step_done = threading.Event()
+
+    @classmethod
+    def prefetch(cls, env, steps):
+        # Only continue once another resource ran, which proves the overlap
+        if cls.other_step_done.wait(5):
+            cls.overlapped.set()
+        for name, version in cls.prefetch_packages(steps):
+            shutil.copy(os.path.join(cls.repository, "%s-%s" % (name, version or "1.0")), cls.archive)
+
+    def get_current_status(self):
+        self.candidate_version = "1.0"
+        self.current_version = "1.0" if os.path.exists(os.path.join(self.root, self.resource.package_name)) else None
+
+    def install_package(self, name, version):
+        # Installs only ever use the local archive
+        shutil.copy(os.path.join(self.archive, "%s-%s" % (name, version)), os.path.join(self.root, name))
+        return True
+
+class GateProvider(Provider):
+    def action_run(self):
+        FakeRepositoryProvider.other_step_done.set()
+
+class TestPackagePrefetch(ResourceTestBase):
+    def testDownloadsOverlapOtherResources(self):
+        for name in ("repository", "archive", "root"):
+            os.mkdir(os.path.join(self.temp_path, name))
+            setattr(FakeRepositoryProvider, name, os.path.join(self.temp_path, name))
+        for name in ("nginx", "redis"):
+            with open(os.path.join(self.temp_path, "repository", name + "-1.0"), "w") as fp:
+                fp.write(name)
+
+        with Environment() as env:
+            Execute("gate", provider=GateProvider, action="run")
+            Package("nginx", provider=FakeRepositoryProvider)
+            Package("redis", provider=FakeRepositoryProvider)
+            env.run()
+
+        self.failUnless(FakeRepositoryProvider.overlapped.is_set())
+        self.failUnlessEqual(["nginx", "redis"], sorted(os.listdir(os.path.join(self.temp_path, "root"))))
+        self.failUnlessEqual({}, env.prefetches)
+
+class TestBuildCache(ResourceTestBase):
+    def testStoreAndLookup(self):
+        cache = BuildCache(os.path.join(self.temp_path, "cache"))
+        key = BuildCache.key(name="nginx", version="1.0", build_vars=["WITH_SSL=1"], arch="amd64", distro=["Ubuntu", "lucid"])
+        self.failIfEqual(key, BuildCache.key(name="nginx", version="1.0", build_vars=[], arch="amd64", distro=["Ubuntu", "lucid"]))
+        self.failUnlessEqual(None, cache.lookup("nginx", key))
+
+        debs = []
+        for name in ("nginx_1.0_amd64.deb", "nginx-dbg_1.0_amd64.deb"):
+            debs.append(os.path.join(self.temp_path, name))
+            with open(debs[-1], "w") as fp:
+                fp.write(name)
+        cached = cache.store("nginx", key, debs)
+        self.failUnlessEqual(sorted(os.path.basename(deb) for deb in debs), [os.path.basename(deb) for deb in cached])
+        self.failUnlessEqual(cached, cache.lookup("nginx", key))
+        # A second store of the same build keeps the first one
+        self.failUnlessEqual(cached, cache.store("nginx", key, debs[:1]))
+        self.failUnlessEqual(["nginx"], os.listdir(cache.path))
+        self.failUnlessEqual([key], os.listdir(os.path.join(cache.path, "nginx")))
+
+class TestSourceBuild(ResourceTestBase):
+    def setUp(self):
+        super(TestSourceBuild, self).setUp()
+        src = os.path.join(self.temp_path, "hello-1.0")
+        os.mkdir(src)
+        with open(os.path.join(src, "Makefile"), "w") as fp:
+            fp.write("all:\n\techo $(GREETING) > hello\n"
+                "install:\n\tmkdir -p $(DESTDIR)/bin\n\tcp hello $(DESTDIR)/bin/hello$(SUFFIX)\n")
+        self.tarball = os.path.join(self.temp_path, "hello-1.0.tar.gz")
+        with tarfile.open(self.tarball, "w:gz") as tf:
+            tf.add(src, arcname="hello-1.0")
+        self.root = os.path.join(self.temp_path, "root")
+
+    def converge(self, root=None, **kwargs):
+        with Environment() as env:
+            for name in ("download", "build_cache", "source_build"):
+                env.config.kokki[name].path = os.path.join(self.temp_path, name)
+            build = SourceBuild("hello", url="file://" + self.tarball, root=root or self.root,
+                make_flags=["GREETING=hi"], **kwargs)
+            env.run()
+        return build.is_updated
+
+    def testBuildIsCachedAndKeyedByArguments(self):
+        self.failUnless(self.converge())
+        with open(os.path.join(self.root, "bin", "hello")) as fp:
+            self.failUnlessEqual("hi\n", fp.read())
+        self.failIf(self.converge())
+
+        # Another root unpacks the cached tree, the source isn't needed anymore
+        os.rename(self.tarball, self.tarball + ".moved")
+        for name in os.listdir(os.path.join(self.temp_path, "download")):
+            os.unlink(os.path.join(self.temp_path, "download", name))
+        other = os.path.join(self.temp_path, "other")
+        os.makedirs(os.path.join(other, "bin"), 0750)
+        self.failUnless(self.converge(root=other))
+        self.failUnless(os.path.exists(os.path.join(other, "bin", "hello")))
+        # Existing directories keep their metadata
+        self.failUnlessEqual(0750, os.stat(os.path.join(other, "bin")).st_mode & 07777)
+
+        # Changed arguments rebuild, files of the previous build go away
+        os.rename(self.tarball + ".moved", self.tarball)
+        self.failUnless(self.converge(root=other, install_command="make install DESTDIR=%(destdir)s SUFFIX=2"))
+        self.failUnlessEqual(["hello2"], os.listdir(os.path.join(other, "bin")))
+
+FAKE_PIP = """#!/bin/sh
+echo "$@" >> %(log)s
+[ "$1" = install ] || exit 0
+for arg in "$@"; do
+    case "$arg" in *==*)
+        rm -rf %(site)s/${arg%%%%==*}-*.dist-info
+        mkdir %(site)s/${arg%%%%==*}-${arg#*==}.dist-info;;
+    esac
+done
+"""
+
+class TestPythonDistributions(ResourceTestBase):
+    def setUp(self):
+        super(TestPythonDistributions, self).setUp()
+        self.site = os.path.join(self.temp_path, "site-packages")
+        os.mkdir(self.site)
+
+    def testScanMetadata(self):
+        os.mkdir(os.path.join(self.site, "simple_json-2.1.dist-info"))
+        os.makedirs(os.path.join(self.site, "boto-2.0-py2.7.egg", "EGG-INFO"))
+        with open(os.path.join(self.site, "Jinja2.egg-info"), "w") as fp:
+            fp.write("Metadata-Version: 1.0\nName: Jinja2\nVersion: 2.5\n\nDescription: Version: 0\n")
+        egg = os.path.join(self.temp_path, "boto-1.9-py2.7.egg")
+        os.makedirs(os.path.join(egg, "EGG-INFO"))
+
+        dists = scan_distributions(["", egg, self.site, os.path.join(self.temp_path, "missing")])
+        self.failUnlessEqual(["boto", "jinja2", "simple-json"], sorted(dists))
+        # Eggs put on the path by easy-install.pth come first
+        self.failUnlessEqual(("boto", "1.9", egg), dists["boto"])
+        self.failUnlessEqual("2.5", dists["jinja2"][1])
+        self.failUnlessEqual("2.1", DistributionIndex([self.site]).get_version("Simple.JSON"))
+
+    def testPipInstallsConsecutivePackagesTogether(self):
+        log = os.path.join(self.temp_path, "pip.log")
+        pip = os.path.join(self.temp_path, "pip")
+        with open(pip, "w") as fp:
+            fp.write(FAKE_PIP % dict(log=log, site=self.site))
+        os.chmod(pip, 0755)
+        for name in ("a-1.0", "c-0.9"):
+            os.mkdir(os.path.join(self.site, name + ".dist-info"))
+
+        kit = Kitchen()
+        kit.add_cookbook_path("kokki.cookbooks")
+        kit.load_cookbook("pip")
+        site = self.site
+        class FakePipProvider(kit.cookbooks.pip.PipPackageProvider):
+            pip_binary_path = pip
+
+            @classmethod
+            def distribution_index(cls, env):
+                return env.run_cache.setdefault('test.pip', DistributionIndex([site]))
+
+        kit.config.kokki.download.path = os.path.join(self.temp_path, "downloads")
+        with kit:
+            packages = [kit.cookbooks.pip.PipPackage(name, version=version, provider=FakePipProvider)
+                for name, version in (("a", "1.0"), ("b", "2.0"), ("c", "1.0"))]
+            Execute("true")
+            packages.append(kit.cookbooks.pip.PipPackage("d", version="1.0", provider=FakePipProvider))
+        kit.run()
+
+        with open(log) as fp:
+            installs = [[arg for arg in line.split() if "==" in arg] for line in fp if line.startswith("install")]
+        self.failUnlessEqual([["b==2.0", "c==1.0"], ["d==1.0"]], installs)
+        self.failUnlessEqual([False, True, True, True], [p.is_updated for p in packages])
+        self.failUnlessEqual(["a-1.0.dist-info", "b-2.0.dist-info", "c-1.0.dist-info", "d-1.0.dist-info"], sorted(os.listdir(self.site)))
+
+FAKE_EASY_INSTALL = """#!/bin/sh
+printf '%%s\\n' "$*" >> %(log)s
+case "$1" in
+    -n) echo "Best match: $2 2.1";;
+    -U) rm -rf %(site)s/${2%%%%==*}-*.egg && mkdir %(site)s/${2%%%%==*}-${2#*==}-py2.7.egg;;
+esac
+"""
+
+class TestEasyInstall(ResourceTestBase):
+    def testCandidatesAreLookedUpOncePerRun(self):
+        self.site = os.path.join(self.temp_path, "site-packages")
+        os.mkdir(self.site)
+        log = os.path.join(self.temp_path, "easy_install.log")
+        easy_install = os.path.join(self.temp_path, "easy_install")
+        with open(easy_install, "w") as fp:
+            fp.write(FAKE_EASY_INSTALL % dict(log=log, site=self.site))
+        os.chmod(easy_install, 0755)
+        os.mkdir(os.path.join(self.site, "boto-2.0-py2.7.egg"))
+
+        site = self.site
+        class FakeEasyInstallProvider(EasyInstallProvider):
+            easy_install_binary_path = easy_install
+
+            @classmethod
+            def distribution_index(cls, env):
+                return env.run_cache.setdefault('test.easy_install', DistributionIndex([site]))
+
+        with Environment() as env:
+            first = Package("boto", action="upgrade", provider=FakeEasyInstallProvider)
+            second = Package("boto-again", package_name="boto", action="upgrade", provider=FakeEasyInstallProvider)
+            env.run()
+
+        with open(log) as fp:
+            self.failUnlessEqual(["-n boto", "-U boto==2.1"], fp.read().splitlines())
+        self.failUnless(first.is_updated)
+        self.failIf(second.is_updated)
+        self.failUnlessEqual(["boto-2.1-py2.7.egg"], os.listdir(self.site))
+
+AGENT_KITCHEN = """
+import os
+from kokki import File
+
+def web(kit):
+    kit.add_cookbook_path(%(cookbooks)r)
+    kit.include_recipe("test")
+    with kit:
+        File(%(path)r, content=lambda:kit.config.motd)
+"""
+
+class TestAgent(ResourceTestBase):
+    def setUp(self):
+        super(TestAgent, self).setUp()
+        self.path = os.path.join(self.temp_path, "motd")
+        self.kitchen = os.path.join(self.temp_path, "kitchen.py")
+        with open(self.kitchen, "w") as fp:
+            fp.write(AGENT_KITCHEN % dict(path=self.path,
+                cookbooks=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookbooks")))
+        self.agent = Agent(self.kitchen, {"motd": "hello", "kokki.backup.path": os.path.join(self.temp_path, "backup")})
+        self.socket = os.path.join(self.temp_path, "kokki.sock")
+        self.server = AgentServer(self.agent, self.socket)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestAgent, self).tearDown()
+
+    def testConvergesWithWarmCookbooks(self):
+        result = request(self.socket, dict(command="converge", roles=["web"]))
+        self.failUnless(result['ok'], result)
+        self.failUnlessEqual(["File['%s']" % self.path], result['updated'])
+        cookbook = self.agent.cookbooks.values()[0]
+
+        result = request(self.socket, dict(command="converge", roles=["web"], overrides={"motd": "hi"}))
+        self.failUnlessEqual(["File['%s']" % self.path], result['updated'])
+        with open(self.path) as fp:
+            self.failUnlessEqual("hi", fp.read())
+        result = request(self.socket, dict(command="converge", roles=["web"], overrides={"motd": "hi"}))
+        self.failUnlessEqual([], result['updated'])
+        self.failUnless(cookbook is self.agent.cookbooks.values()[0])
+
+        result = request(self.socket, dict(command="converge", roles=["db"]))
+        self.failIf(result['ok'])
+        self.failUnless("'db'" in result['error'])
+
+        status = request(self.socket, dict(command="status"))
+        self.failUnlessEqual((3, ["test"], False), (status['runs'], status['cookbooks'], status['running']))
+        self.failUnlessRaises(Fail, AgentServer, self.agent, self.socket)
+
+    def testSystemFactsAreRefreshed(self):
+        facts = System.get_instance()
+        self.failUnless(request(self.socket, dict(command="converge", roles=["web"]))['ok'])
+        self.failUnless(facts is System.get_instance())
+        request(self.socket, dict(command="reload"))
+        self.failIf(facts is System.get_instance())
+
+        facts = System.get_instance()
+        self.agent.facts_max_age = 0
+        self.failUnless(request(self.socket, dict(command="converge", roles=["web"]))['ok'])
+        self.failIf(facts is System.get_instance())
+
+class TestDriftWatcher(ResourceTestBase):
+    def testOnlyDriftedResourcesRunAgain(self):
+        conf = os.path.join(self.temp_path, "etc", "app.conf")
+        other = os.path.join(self.temp_path, "other.conf")
+        marker = os.path.join(self.temp_path, "reloaded")
+        with Environment() as env:
+            env.config.kokki.backup.path = os.path.join(self.temp_path, "backup")
+            Directory(os.path.dirname(conf))
+            reload = Execute("echo reload >> %s" % marker, action="nothing")
+            File(conf, content="good", notifies=[("run", reload)])
+            File(other, content="other")
+            env.run()
+        self.failUnlessEqual(["reload"], open(marker).read().split())
+
+        watcher = DriftWatcher(env, debounce=0.05)
+        try:
+            self.failUnlessEqual(set(), watcher.poll(0.05))
+            with open(conf, "w") as fp:
+                fp.write("edited by hand")
+            os.chmod(conf, 0600)
+            keys = watcher.poll(5)
+            self.failUnlessEqual(set([("File", conf)]), keys)
+            updated = watcher.converge(keys)
+            self.failUnlessEqual([conf, "echo reload >> %s" % marker], sorted(r.name for r in updated))
+            self.failUnlessEqual("good", open(conf).read())
+            self.failUnlessEqual(["reload", "reload"], open(marker).read().split())
+            # The watcher's own write isn't drift
+            self.failUnlessEqual(set(), watcher.poll(0.2))
+
+            # Recreating a removed directory is noticed through its parent
+            shutil.rmtree(os.path.dirname(conf))
+            keys = watcher.poll(5)
+            self.failUnlessEqual(set([("Directory", os.path.dirname(conf)), ("File", conf)]), keys)
+            watcher.converge(keys)
+            self.failUnlessEqual("good", open(conf).read())
+        finally:
+            watcher.close()
+
+class TestWaitFor(ResourceTestBase):
+    def setUp(self):
+        super(TestWaitFor, self).setUp()
+        FileServerHandler.files = {}
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileServerHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/health" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestWaitFor, self).tearDown()
+
+    def testParseTargets(self):
+        self.failUnlessEqual(TCPCheck(80), parse_check(80))
+        self.failUnlessEqual(TCPCheck(5432, "db"), parse_check("tcp:db:5432"))
+        self.failUnlessEqual("unix:/run/app.sock", str(parse_check("unix:/run/app.sock")))
+        self.failUnlessEqual(self.url, str(parse_check(self.url)))
+        self.failUnlessRaises(Fail, parse_check, "udp:53")
+
+    def testTargetsAreWaitedForBeforeTheNextResource(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        unix_path = os.path.join(self.temp_path, "app.sock")
+        unix_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        ready_file = os.path.join(self.temp_path, "ready")
+        pidfile = os.path.join(self.temp_path, "app.pid")
+        seen = []
+
+        def start():
+            listener.listen(1)
+            unix_listener.bind(unix_path)
+            unix_listener.listen(1)
+            open(ready_file, "w").close()
+            with open(pidfile, "w") as fp:
+                fp.write("%d\n" % os.getpid())
+            FileServerHandler.files["/health"] = "ok"
+        timer = threading.Timer(0.3, start)
+        try:
+            with Environment() as env:
+                WaitFor("tcp:127.0.0.1:%d" % listener.getsockname()[1])
+                WaitFor("app", targets=["unix:" + unix_path, "file:" + ready_file, "pidfile:" + pidfile, self.url])
+                File(os.path.join(self.temp_path, "after"),
+                    content=lambda:seen.append(os.path.exists(ready_file) and "/health" in FileServerHandler.files) or "")
+                timer.start()
+                env.run()
+            self.failUnlessEqual([True], seen)
+        finally:
+            timer.join()
+            listener.close()
+            unix_listener.close()
+
+    def testConcurrentTimeout(self):
+        with Environment() as env:
+            WaitFor("file:" + os.path.join(self.temp_path, "a"), timeout=0.5)
+            WaitFor("file:" + os.path.join(self.temp_path, "b"), timeout=0.5)
+            start = time.time()
+            try:
+                env.run()
+            except Fail, exc:
+                self.failUnless("a (WaitFor" in str(exc) and "b (WaitFor" in str(exc), str(exc))
+            else:
+                self.fail("WaitFor should time out")
+            # Both waits ran at the same time
+            self.failUnless(time.time() - start < 0.9)
+
+    def testServiceWaitsAfterStarting(self):
+        ready_file = os.path.join(self.temp_path, "ready")
+        seen = []
+        with Environment() as env:
+            Service("app", provider="kokki.providers.service.ServiceProvider",
+                start_command="(sleep 0.3; touch %s) &" % ready_file,
+                status_command=lambda:False,
+                wait_for="file:" + ready_file,
+                action="start")
+            File(os.path.join(self.temp_path, "after"),
+                content=lambda:seen.append(os.path.exists(ready_file)) or "")
+            env.run()
+        self.failUnlessEqual([True], seen)
+
 if __name__ == '__main__':
     unittest.main()